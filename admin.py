@@ -0,0 +1,50 @@
+"""
+Admin helper for a running chat server.
+
+    python admin.py stats [--host 127.0.0.1] [--port 5555]
+
+Prints the server's STATS snapshot (metrics, per-client queues, write-behind
+and cache statistics) as JSON. The server only answers from localhost.
+"""
+
+import argparse
+import json
+import socket
+import sys
+
+from protocol import PORT, FramedConnection
+
+
+def fetch_stats(host="127.0.0.1", port=PORT, timeout=5.0):
+    """Sends a STATS request and returns the server's reply content."""
+    sock = socket.create_connection((host, port), timeout=timeout)
+    conn = FramedConnection(sock)
+    try:
+        conn.send({"type": "STATS"})
+        reply = conn.receive()
+    finally:
+        conn.close()
+    if reply is None:
+        raise ConnectionError("server closed the connection")
+    if reply.get("type") != "STATS":
+        raise RuntimeError(reply.get("content"))
+    return reply["content"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server admin tool")
+    parser.add_argument("command", choices=["stats"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    try:
+        stats = fetch_stats(args.host, args.port)
+    except (OSError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+# Messages per compressed block; a block never mixes streams
+ARCHIVE_BLOCK_ROWS = 500
+# A new segment file is started once the current one is this large
+SEGMENT_BYTES = 64 * 1024 * 1024
+# Decompressed blocks kept in memory for paging back through the archive
+BLOCK_CACHE_SIZE = 32
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".zblk"
+
+
+def stream_key(msg_type, sender, recipient):
+    """
+    (msg_type, peer_a, peer_b) naming the stream a message belongs to: the
+    group chat, one channel or one private conversation (unordered pair).
+    """
+    if msg_type == "PRIVATE":
+        return (msg_type, *sorted((sender, recipient)))
+    if msg_type == "CHANNEL":
+        return (msg_type, recipient, "")
+    return (msg_type, "", "")
+
+
+class ArchiveStore:
+    """
+    Messages moved out of the messages table by retention. Segment files in
+    `directory` are append-only runs of zlib-compressed JSON blocks, each
+    holding up to ARCHIVE_BLOCK_ROWS messages of one stream in id order.
+    The archive_blocks table of the main database indexes every block by
+    stream and id range, so a history page reads the index and decompresses
+    only the blocks it needs.
+
+    Blocks are written (and synced) before their index rows are committed,
+    so a crash can only leave unreferenced bytes at the end of a segment.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.blocks = OrderedDict()  # (segment, offset) -> rows, LRU order
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create_index(cursor):
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS archive_blocks (
+                msg_type TEXT,
+                peer_a TEXT,
+                peer_b TEXT,
+                last_id INTEGER,
+                first_id INTEGER,
+                rows INTEGER,
+                segment TEXT,
+                offset INTEGER,
+                length INTEGER,
+                PRIMARY KEY (msg_type, peer_a, peer_b, last_id)
+            ) WITHOUT ROWID
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_archive_blocks_last_id ON archive_blocks(last_id)"
+        )
+
+    @staticmethod
+    def newest_id(conn):
+        """Id of the newest archived message, 0 if nothing is archived."""
+        return conn.execute(
+            "SELECT COALESCE(MAX(last_id), 0) FROM archive_blocks"
+        ).fetchone()[0]
+
+    def write(self, rows):
+        """
+        Appends messages (id, sender, recipient, msg_type, content, timestamp),
+        in id order, to the current segment. Returns the archive_blocks rows
+        to commit for them.
+        """
+        streams = {}
+        for row in rows:
+            streams.setdefault(stream_key(row[3], row[1], row[2]), []).append(row)
+
+        os.makedirs(self.directory, exist_ok=True)
+        segment = self.current_segment()
+        entries = []
+        with open(os.path.join(self.directory, segment), "ab") as f:
+            offset = f.tell()
+            for key, messages in streams.items():
+                for start in range(0, len(messages), ARCHIVE_BLOCK_ROWS):
+                    block = messages[start : start + ARCHIVE_BLOCK_ROWS]
+                    data = zlib.compress(
+                        json.dumps(
+                            [[m[0], m[1], m[2], m[4], m[5]] for m in block],
+                            separators=(",", ":"),
+                        ).encode()
+                    )
+                    f.write(data)
+                    entries.append(
+                        (*key, block[-1][0], block[0][0], len(block))
+                        + (segment, offset, len(data))
+                    )
+                    offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return entries
+
+    def current_segment(self):
+        """Name of the segment to append to, starting a new one when it is full."""
+        segments = self.segments()
+        if segments:
+            last = segments[-1]
+            if os.path.getsize(os.path.join(self.directory, last)) < SEGMENT_BYTES:
+                return last
+            number = int(last[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]) + 1
+        else:
+            number = 1
+        return f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}"
+
+    def segments(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            name
+            for name in names
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def page(self, conn, key, limit, before_id):
+        """
+        Up to `limit` archived messages of stream `key` older than before_id,
+        as (id, sender, content, timestamp), oldest first.
+        """
+        blocks = conn.execute(
+            """
+            SELECT segment, offset, length FROM archive_blocks
+            WHERE msg_type = ? AND peer_a = ? AND peer_b = ? AND first_id < ?
+            ORDER BY last_id DESC
+        """,
+            (*key, before_id),
+        )
+        page = []
+        for segment, offset, length in blocks:
+            older = [
+                (row[0], row[1], row[3], row[4])
+                for row in self.read_block(segment, offset, length)
+                if row[0] < before_id
+            ]
+            page[:0] = older[-(limit - len(page)) :]
+            if len(page) >= limit:
+                break
+        return page
+
+    def read_block(self, segment, offset, length):
+        with self.lock:
+            rows = self.blocks.get((segment, offset))
+            if rows is not None:
+                self.blocks.move_to_end((segment, offset))
+                return rows
+        with open(os.path.join(self.directory, segment), "rb") as f:
+            f.seek(offset)
+            rows = json.loads(zlib.decompress(f.read(length)))
+        with self.lock:
+            self.blocks[(segment, offset)] = rows
+            while len(self.blocks) > BLOCK_CACHE_SIZE:
+                self.blocks.popitem(last=False)
+        return rows
+
+    def stats(self):
+        segments = self.segments()
+        return {
+            "segments": len(segments),
+            "bytes": sum(
+                os.path.getsize(os.path.join(self.directory, name)) for name in segments
+            ),
+        }
@@ -0,0 +1,665 @@
+import asyncio
+import logging
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from database import DatabaseManager, HISTORY_PAGE_SIZE, SEARCH_PAGE_SIZE
+from heartbeat import IdleReaper, PING_FRAME, enable_keepalive
+from protocol import (
+    PORT,
+    HEADER_LENGTH,
+    CHANNEL_JOIN,
+    CHANNEL_LEAVE,
+    CHANNEL_JOINED,
+    CHANNEL_LEFT,
+    CHANNEL_LIST,
+    CHANNEL_NAME,
+    FEATURE_HEARTBEAT,
+    FEATURE_HISTORY_BATCH,
+    FEATURE_PRESENCE,
+    FEATURE_ZLIB,
+    FILE_DATA,
+    FILE_DONE,
+    FILE_GET,
+    FILE_OFFER,
+    FILE_OFFSET,
+    FILE_PUT,
+    FILE_READY,
+    HISTORY_REQUEST,
+    MAX_CHANNELS,
+    MAX_CONTENT_LENGTH,
+    PRESENCE_JOIN,
+    PRESENCE_LEAVE,
+    RESUME_LIMIT,
+    SEARCH,
+    USER_LIST_REQUEST,
+    build_history_frames,
+    build_history_page,
+    encode_message,
+    file_message,
+    history_messages,
+    is_channel,
+    missed_by_chat,
+    parse_content,
+    parse_file_offer,
+    parse_header,
+    parse_history_request,
+    parse_resume,
+    parse_search_request,
+    presence_event,
+    resumed,
+    search_results,
+    user_list_snapshot,
+    username_problem,
+    decode_message,
+)
+from transfer import FILE_CHUNK_SIZE, TRANSFER_TIMEOUT, FileStore, Pacer
+
+
+logger = logging.getLogger("chat.server")
+
+# Bytes a client may leave unsent in its transport before it is dropped as
+# a slow consumer, the asyncio counterpart of a full ClientSession queue
+MAX_OUTBOUND_BYTES = 4 * 1024 * 1024
+
+
+class AsyncChatServer:
+    """
+    Single-threaded asyncio implementation of the chat server.
+    Speaks exactly the same protocol as ChatServer, but every connection is a
+    coroutine instead of a thread, so idle users only cost a few KB each.
+    """
+
+    def __init__(self, host="0.0.0.0", port=PORT, db=None, reaper=None, files=None):
+        self.host = host
+        self.port = port
+
+        self.clients = {}  # Maps username -> StreamWriter
+        self.features = {}  # Maps username -> features announced at LOGIN
+        self.presence_version = 0
+        # Channel -> {username: StreamWriter} of its connected members, and
+        # username -> joined channels
+        self.channels = {}
+        self.memberships = {}
+        self.db = db if db is not None else DatabaseManager()
+        self.reaper = reaper if reaper is not None else IdleReaper()
+        self.files = files if files is not None else FileStore()
+        # SQLite calls are blocking, run them on a few worker threads so the
+        # event loop never waits on disk. One per pooled reader, plus one
+        # for the (serialized) writer.
+        self.db_executor = ThreadPoolExecutor(
+            max_workers=self.db.pool.size + 1, thread_name_prefix="db"
+        )
+        self.server = None
+        self.reaper_task = None
+        self.running = True
+
+    async def run_db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, func, *args)
+
+    async def receive_message(self, reader):
+        """Reads one frame from the stream, returns None if connection closed."""
+        try:
+            header = await reader.readexactly(HEADER_LENGTH)
+            data = await reader.readexactly(parse_header(header))
+            return decode_message(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        except Exception:
+            return None
+
+    async def send_message(self, writer, message_dict):
+        return await self.send_frame(writer, encode_message(message_dict))
+
+    async def send_frame(self, writer, frame):
+        try:
+            writer.write(frame)
+            await writer.drain()
+            return True
+        except Exception as e:
+            logger.warning("Error sending message: %s", e)
+            return False
+
+    def push_frame(self, writer, frame):
+        """
+        Writes a frame to another client without waiting for it to drain, so
+        a slow reader never holds up the sender or the other recipients. A
+        client with more than MAX_OUTBOUND_BYTES unsent is disconnected.
+        Returns False if the frame was not written.
+        """
+        if writer.is_closing():
+            return False
+        writer.write(frame)
+        unsent = writer.transport.get_write_buffer_size()
+        if unsent > MAX_OUTBOUND_BYTES:
+            logger.warning(
+                "[SLOW] Dropping %s with %d bytes unsent",
+                writer.get_extra_info("peername"),
+                unsent,
+            )
+            writer.transport.abort()
+            return False
+        return True
+
+    def broadcast(self, message_dict, exclude_user=None):
+        """Send a message to all connected clients."""
+        # Encode once, every recipient gets the same immutable frame
+        frame = encode_message(message_dict)
+        for user, writer in list(self.clients.items()):
+            if user != exclude_user:
+                self.push_frame(writer, frame)
+
+    def publish_presence(self, event, user, new_writer=None):
+        """
+        Writes a versioned join/leave delta to every client, or the full list
+        to clients without FEATURE_PRESENCE and to `new_writer` (a new login).
+        Never awaits, so deltas cannot interleave and versions stay in order.
+        """
+        self.presence_version += 1
+        delta = encode_message(presence_event(event, user, self.presence_version))
+        snapshot = None
+        for name, writer in list(self.clients.items()):
+            if writer is not new_writer and FEATURE_PRESENCE in self.features[name]:
+                self.push_frame(writer, delta)
+                continue
+            if snapshot is None:
+                snapshot = encode_message(
+                    user_list_snapshot(list(self.clients), self.presence_version)
+                )
+            self.push_frame(writer, snapshot)
+
+    async def close_writer(self, writer):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    async def handle_client(self, reader, writer):
+        """Coroutine handling a single client connection."""
+        address = writer.get_extra_info("peername")
+        logger.info("[NEW CONNECTION] %s connected.", address)
+        enable_keepalive(writer.get_extra_info("socket"))
+        username = None
+        # Aborting the transport ends the pending read, like a disconnect
+        watch = self.reaper.watch(writer.transport.abort)
+
+        try:
+            # First message should be LOGIN
+            first_msg = await self.receive_message(reader)
+            self.reaper.unwatch(watch)
+            watch = None
+
+            # File data travels over separate connections, never the chat one
+            if first_msg and first_msg.get("type") in (FILE_PUT, FILE_GET):
+                await self.handle_transfer(reader, writer, first_msg, address)
+                return
+
+            if not first_msg or first_msg.get("type") != "LOGIN":
+                logger.warning("[ERROR] %s did not send LOGIN.", address)
+                return
+
+            username = first_msg.get("content")
+
+            error = username_problem(username)
+            if error:
+                await self.send_message(writer, {"type": "ERROR", "content": error})
+                username = None
+                return
+
+            # Check IP Restriction
+            client_ip = address[0]
+            stored_ip = await self.run_db(self.db.get_user_ip, username)
+            if stored_ip and stored_ip != client_ip:
+                logger.warning(
+                    "[REJECTED] %s from %s (Expected: %s)",
+                    username,
+                    client_ip,
+                    stored_ip,
+                )
+                await self.send_message(
+                    writer,
+                    {
+                        "type": "ERROR",
+                        "content": f"Access Denied: Account bound to {stored_ip}",
+                    },
+                )
+                username = None
+                return
+
+            # Check if username taken. No await between this check and the
+            # claim below, so two logins with the same name cannot both pass.
+            if username in self.clients:
+                await self.send_message(
+                    writer, {"type": "ERROR", "content": "Username taken"}
+                )
+                username = None
+                return
+
+            # Register user
+            features = first_msg.get("features", ())
+            self.clients[username] = writer
+            self.features[username] = features
+            if FEATURE_HEARTBEAT in features:
+                watch = self.reaper.watch(
+                    writer.transport.abort, lambda: writer.write(PING_FRAME)
+                )
+            await self.run_db(self.db.add_user, username, client_ip)
+
+            logger.info("[LOGIN] User: %s", username)
+
+            await self.send_message(
+                writer, {"type": "INFO", "content": f"Welcome {username}!"}
+            )
+
+            # Full user list to the new client, a join to everyone else
+            self.publish_presence(PRESENCE_JOIN, username, writer)
+
+            # Back into the channels this user is a member of
+            channels = await self.run_db(self.db.get_channels, username)
+            self.memberships[username] = set()
+            self.subscribe(username, writer, channels)
+            await self.send_message(writer, {"type": CHANNEL_LIST, "content": channels})
+
+            # Public history, or only what a reconnecting client missed
+            await self.send_login_history(
+                writer, username, features, parse_resume(first_msg)
+            )
+
+            # Main Loop
+            while self.running:
+                msg = await self.receive_message(reader)
+                if msg is None:
+                    break  # Connection closed
+                if watch is not None:
+                    watch.seen()
+
+                msg_type = msg.get("type")
+                content = msg.get("content")
+                recipient = msg.get("to")  # 'all' or specific username
+
+                if msg_type == HISTORY_REQUEST:
+                    await self.send_history_page(writer, username, msg, features)
+                    continue
+                if msg_type in (CHANNEL_JOIN, CHANNEL_LEAVE):
+                    await self.handle_channel_request(writer, username, msg)
+                    continue
+                if msg_type == SEARCH:
+                    await self.send_search_results(writer, username, msg)
+                    continue
+                if msg_type == USER_LIST_REQUEST:
+                    await self.send_message(
+                        writer,
+                        user_list_snapshot(list(self.clients), self.presence_version),
+                    )
+                    continue
+                if msg_type == FILE_OFFER:
+                    await self.handle_file_offer(writer, username, msg)
+                    continue
+                if msg_type == "MSG":
+                    if parse_content(msg) is None:
+                        await self.send_message(
+                            writer,
+                            {
+                                "type": "ERROR",
+                                "content": f"Messages are limited to {MAX_CONTENT_LENGTH} characters",
+                            },
+                        )
+                        continue
+                    await self.handle_chat_message(writer, username, recipient, content)
+
+        except Exception as e:
+            logger.exception("[EXCEPTION] %s: %s", address, e)
+        finally:
+            # Cleanup
+            logger.info("[DISCONNECT] %s %s", address, username)
+            if watch is not None:
+                self.reaper.unwatch(watch)
+            if username is not None and self.clients.get(username) is writer:
+                del self.clients[username]
+                del self.features[username]
+                self.unsubscribe(username, list(self.memberships.pop(username, ())))
+                self.publish_presence(PRESENCE_LEAVE, username)
+            await self.close_writer(writer)
+
+    async def handle_chat_message(self, writer, username, recipient, content):
+        if recipient == "all":
+            logger.debug("[%s -> ALL]: %s", username, content)
+            message_id = await self.run_db(
+                self.db.store_message, username, "all", "BROADCAST", content
+            )
+            self.broadcast(
+                {
+                    "type": "MSG",
+                    "id": message_id,
+                    "from": username,
+                    "to": "all",
+                    "content": content,
+                }
+            )
+        elif is_channel(recipient):
+            await self.send_channel_message(writer, username, recipient, content)
+        else:
+            target_writer = self.clients.get(recipient)
+            if target_writer:
+                logger.debug("[%s -> %s]: %s", username, recipient, content)
+                message_id = await self.run_db(
+                    self.db.store_message,
+                    username,
+                    recipient,
+                    "PRIVATE",
+                    content,
+                )
+                frame = encode_message(
+                    {
+                        "type": "MSG",
+                        "id": message_id,
+                        "from": username,
+                        "to": recipient,
+                        "content": content,
+                        "private": True,
+                    }
+                )
+                # Send to recipient, and back to sender for their UI
+                self.push_frame(target_writer, frame)
+                await self.send_frame(writer, frame)
+            else:
+                await self.send_message(
+                    writer,
+                    {
+                        "type": "ERROR",
+                        "content": f"User {recipient} not found.",
+                    },
+                )
+
+    async def handle_file_offer(self, writer, username, msg):
+        """Registers a file to share in a chat; FILE_READY says how to upload it."""
+        offer = parse_file_offer(msg, self.files.max_size)
+        if offer is None:
+            await self.send_message(
+                writer, {"type": "ERROR", "content": "Bad file offer"}
+            )
+            return
+        to, name, size = offer
+        if is_channel(to) and to not in self.memberships.get(username, ()):
+            await self.send_message(
+                writer, {"type": "ERROR", "content": f"Join {to} first."}
+            )
+            return
+        if to != "all" and not is_channel(to) and to not in self.clients:
+            await self.send_message(
+                writer, {"type": "ERROR", "content": f"User {to} not found."}
+            )
+            return
+        key = secrets.token_hex(16)
+        file_id = await self.run_db(self.db.add_file, username, to, name, size, key)
+        if file_id is None:
+            await self.send_message(
+                writer, {"type": "ERROR", "content": "Could not store the file"}
+            )
+            return
+        logger.info("[FILE] %s offers %s (%d bytes) to %s", username, name, size, to)
+        await self.send_message(
+            writer,
+            {"type": FILE_READY, "file_id": file_id, "key": key, "ref": msg.get("ref")},
+        )
+
+    async def handle_transfer(self, reader, writer, msg, address):
+        """
+        A data connection: receives (FILE_PUT) or sends (FILE_GET) the bytes
+        of one file. File writes go to the default executor and sends to
+        loop.sendfile, so the event loop keeps serving chat in between.
+        """
+        row = await self.run_db(self.db.get_file, msg.get("file_id"))
+        error = self.files.transfer_error(row, msg)
+        if error:
+            await self.send_message(writer, {"type": "ERROR", "content": error})
+            return
+        file_id, sender, recipient, name, size, key, _ = row
+        try:
+            if msg.get("type") == FILE_GET:
+                offset = msg.get("offset", 0)
+                await self.send_message(
+                    writer,
+                    {"type": FILE_DATA, "name": name, "size": size, "offset": offset},
+                )
+                await self.send_file(writer, file_id, offset, size)
+                return
+
+            part = self.files.begin_upload(file_id)
+            if part is None:
+                await self.send_message(
+                    writer, {"type": "ERROR", "content": "Upload already running"}
+                )
+                return
+            try:
+                await self.send_message(
+                    writer, {"type": FILE_OFFSET, "offset": self.files.received(part)}
+                )
+                done = await self.receive_file(reader, part, file_id, size)
+            finally:
+                self.files.end_upload(file_id, part)
+            if done:
+                await self.run_db(self.db.complete_file, file_id)
+                await self.send_message(writer, {"type": FILE_DONE, "file_id": file_id})
+                await self.file_uploaded(sender, recipient, name, size, file_id, key)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning(
+                "[FILE] Transfer of file %s with %s broke off: %s", file_id, address, e
+            )
+
+    async def receive_file(self, reader, part, file_id, size):
+        """FileStore.receive for a stream. Returns True once the upload is complete."""
+        loop = asyncio.get_running_loop()
+        offset = self.files.received(part)
+        pacer = Pacer(self.files.rate)
+        while offset < size:
+            data = await asyncio.wait_for(
+                reader.read(min(FILE_CHUNK_SIZE, size - offset)), TRANSFER_TIMEOUT
+            )
+            if not data:
+                return False
+            await loop.run_in_executor(None, part.write, data)
+            offset += len(data)
+            self.files.count("bytes_in", len(data))
+            await asyncio.sleep(pacer.delay(len(data)))
+        await loop.run_in_executor(None, self.files.finish, part, file_id)
+        return True
+
+    async def send_file(self, writer, file_id, offset, size):
+        """FileStore.send for a stream, with the zero-copy loop.sendfile."""
+        loop = asyncio.get_running_loop()
+        pacer = Pacer(self.files.rate)
+        with open(self.files.path(file_id), "rb") as f:
+            while offset < size:
+                count = await asyncio.wait_for(
+                    loop.sendfile(
+                        writer.transport,
+                        f,
+                        offset,
+                        min(FILE_CHUNK_SIZE, size - offset),
+                    ),
+                    TRANSFER_TIMEOUT,
+                )
+                if not count:
+                    raise OSError(f"file {file_id} is shorter than {size} bytes")
+                offset += count
+                self.files.count("bytes_out", count)
+                await asyncio.sleep(pacer.delay(count))
+        self.files.count("downloads", 1)
+
+    async def file_uploaded(self, sender, recipient, name, size, file_id, key):
+        """Announces a complete upload in its chat, as a message from its sender."""
+        logger.info("[FILE] %s uploaded %s (%d bytes)", sender, name, size)
+        writer = self.clients.get(sender)
+        if writer is None:
+            logger.warning("[FILE] %s left before %s was uploaded", sender, name)
+            return
+        await self.handle_chat_message(
+            writer, sender, recipient, file_message(name, size, file_id, key)
+        )
+
+    def subscribe(self, username, writer, channels):
+        for channel in channels:
+            self.channels.setdefault(channel, {})[username] = writer
+            self.memberships[username].add(channel)
+
+    def unsubscribe(self, username, channels):
+        for channel in channels:
+            self.memberships.get(username, set()).discard(channel)
+            members = self.channels.get(channel, {})
+            members.pop(username, None)
+            if not members:
+                self.channels.pop(channel, None)
+
+    async def handle_channel_request(self, writer, username, msg):
+        """JOIN or LEAVE a channel. Memberships are stored and outlive the session."""
+        channel = msg.get("channel")
+        if not isinstance(channel, str) or not CHANNEL_NAME.fullmatch(channel):
+            await self.send_message(
+                writer,
+                {
+                    "type": "ERROR",
+                    "content": "Channel names are # and up to 32 letters, digits, _ or -",
+                },
+            )
+            return
+        if msg.get("type") == CHANNEL_JOIN:
+            channels = self.memberships.get(username, ())
+            if channel not in channels and len(channels) >= MAX_CHANNELS:
+                await self.send_message(
+                    writer,
+                    {
+                        "type": "ERROR",
+                        "content": f"You can be in at most {MAX_CHANNELS} channels",
+                    },
+                )
+                return
+            await self.run_db(self.db.join_channel, username, channel)
+            self.subscribe(username, writer, [channel])
+            await self.send_message(
+                writer, {"type": CHANNEL_JOINED, "channel": channel}
+            )
+        else:
+            await self.run_db(self.db.leave_channel, username, channel)
+            self.unsubscribe(username, [channel])
+            await self.send_message(writer, {"type": CHANNEL_LEFT, "channel": channel})
+
+    async def send_channel_message(self, writer, username, channel, content):
+        if channel not in self.memberships.get(username, ()):
+            await self.send_message(
+                writer, {"type": "ERROR", "content": f"Join {channel} first."}
+            )
+            return
+        logger.debug("[%s -> %s]: %s", username, channel, content)
+        message_id = await self.run_db(
+            self.db.store_message, username, channel, "CHANNEL", content
+        )
+        frame = encode_message(
+            {
+                "type": "MSG",
+                "id": message_id,
+                "from": username,
+                "to": channel,
+                "content": content,
+            }
+        )
+        for member_writer in list(self.channels.get(channel, {}).values()):
+            self.push_frame(member_writer, frame)
+
+    async def send_login_history(self, writer, username, features, resume):
+        """
+        Sends a new login the latest group chat page, or a resuming client
+        the messages of all its chats after `resume`, then RESUMED.
+        """
+        chats = None
+        if resume is not None:
+            rows, complete = await self.run_db(
+                self.db.get_missed_messages, username, resume, RESUME_LIMIT
+            )
+            if complete:
+                chats = missed_by_chat(rows, username)
+        if chats is None:
+            chats = {"all": await self.run_db(self.db.get_public_history)}
+
+        for chat, history in chats.items():
+            messages = history_messages(history, chat)
+            if FEATURE_HISTORY_BATCH in features:
+                messages = build_history_frames(
+                    messages, chat, FEATURE_ZLIB in features
+                )
+            for message in messages:
+                writer.write(encode_message(message))
+        if resume is not None:
+            writer.write(encode_message(resumed(resume, len(rows), complete)))
+        await writer.drain()
+
+    async def send_history_page(self, writer, username, msg, features):
+        """Answers a HISTORY_REQ with one page of older messages."""
+        request = parse_history_request(msg, HISTORY_PAGE_SIZE)
+        if request is None:
+            await self.send_message(
+                writer, {"type": "ERROR", "content": "Bad history request"}
+            )
+            return
+        chat, before_id, limit = request
+        if is_channel(chat) and chat not in self.memberships.get(username, ()):
+            await self.send_message(
+                writer, {"type": "ERROR", "content": f"Join {chat} first."}
+            )
+            return
+        if chat == "all":
+            rows = await self.run_db(self.db.get_public_history, limit, before_id)
+        elif is_channel(chat):
+            rows = await self.run_db(
+                self.db.get_channel_history, chat, limit, before_id
+            )
+        else:
+            rows = await self.run_db(
+                self.db.get_private_history, username, chat, limit, before_id
+            )
+        compress = FEATURE_ZLIB in features
+        await self.send_message(
+            writer, build_history_page(rows, chat, before_id, compress)
+        )
+
+    async def send_search_results(self, writer, username, msg):
+        """Answers a SEARCH with one page of ranked hits the user may see."""
+        request = parse_search_request(msg, SEARCH_PAGE_SIZE)
+        if request is None:
+            await self.send_message(
+                writer, {"type": "ERROR", "content": "Bad search request"}
+            )
+            return
+        query, offset, limit = request
+        rows, more = await self.run_db(
+            self.db.search_messages, username, query, limit, offset
+        )
+        await self.send_message(writer, search_results(rows, query, offset, more))
+
+    async def reap_loop(self):
+        """Pings quiet clients and disconnects dead ones, once per reaper tick."""
+        while self.running:
+            await asyncio.sleep(self.reaper.wait_time())
+            _, closed = self.reaper.reap()
+            if closed:
+                logger.info("[REAPER] Closed %d idle connections", closed)
+
+    async def serve(self):
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, reuse_address=True
+        )
+        # Keep a reference, the loop only holds tasks weakly
+        self.reaper_task = asyncio.create_task(self.reap_loop())
+        logger.info("[STARTING] Server listens on %s:%s", self.host, self.port)
+        logger.info("[SERVER CONNECTED] Waiting for connections...")
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.running = False
+            self.db_executor.shutdown(wait=True)
+            self.db.close()
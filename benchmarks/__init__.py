@@ -0,0 +1,4 @@
+"""
+Benchmarks and load tools for the chat server.
+Run them from the repository root as modules, e.g. `python -m benchmarks.bench_broadcast`.
+"""
@@ -0,0 +1,139 @@
+"""
+Microbenchmark: CPU cost of one broadcast as the number of connected users grows.
+
+Compares encoding the frame once per recipient (the old fan-out) with
+encoding it once and sharing the bytes (ChatServer.broadcast).
+Sessions are stubs that only keep a reference to the frame, so the numbers
+isolate serialization and fan-out from socket I/O.
+
+A channel message is timed the same way: a scan over every connected
+session for members, against ChatServer.send_channel_frame, which looks the
+`--members` subscribers up in the channel index.
+
+    python -m benchmarks.bench_broadcast [--users 10 100 1000] [--members 50] [--json out.json]
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from metrics import Metrics
+from protocol import encode_message
+from server import ChatServer
+
+CHANNEL = "#bench"
+
+
+class StubSession:
+    def __init__(self):
+        self.last = None
+        self.channels = set()
+
+    def send(self, message_dict, block=None):
+        return self.send_frame(encode_message(message_dict), block)
+
+    def send_frame(self, frame, block=None):
+        self.last = frame
+        return True
+
+
+class StubServer:
+    """Just enough of ChatServer to run its real fan-out methods."""
+
+    broadcast = ChatServer.broadcast
+    broadcast_frame = ChatServer.broadcast_frame
+    send_channel_frame = ChatServer.send_channel_frame
+
+    def __init__(self, users, members=0):
+        self.clients = {f"user{i}": StubSession() for i in range(users)}
+        self.metrics = Metrics()
+        self.channels_lock = threading.Lock()
+        self.channels = {CHANNEL: {}}
+        for user, session in list(self.clients.items())[:members]:
+            session.channels.add(CHANNEL)
+            self.channels[CHANNEL][user] = session
+
+
+def per_recipient_broadcast(server, message_dict, exclude_user=None):
+    """The pre encode-once fan-out: one json/base64/header pass per recipient."""
+    for user, session in list(server.clients.items()):
+        if user != exclude_user:
+            session.send(message_dict)
+
+
+def scan_channel(server, message_dict):
+    """A channel fan-out without the index: every session is checked."""
+    frame = encode_message(message_dict)
+    for session in list(server.clients.values()):
+        if CHANNEL in session.channels:
+            session.send_frame(frame)
+
+
+def indexed_channel(server, message_dict):
+    server.send_channel_frame(CHANNEL, encode_message(message_dict))
+
+
+def measure(fn, server, message, rounds):
+    start = time.process_time()
+    for _ in range(rounds):
+        fn(server, message)
+    return (time.process_time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--size", type=int, default=200, help="message content length")
+    parser.add_argument(
+        "--members", type=int, default=50, help="subscribers of the channel case"
+    )
+    parser.add_argument(
+        "--budget", type=float, default=0.5, help="CPU seconds per case"
+    )
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    message = {"type": "MSG", "from": "bench", "to": "all", "content": "x" * args.size}
+    channel_message = dict(message, to=CHANNEL)
+    results = []
+
+    print(
+        f"{'users':>8} {'per-recipient us':>18} {'encode-once us':>16} {'speedup':>8}"
+        f" {'channel scan us':>16} {'channel index us':>17}"
+    )
+    for users in args.users:
+        server = StubServer(users, min(args.members, users))
+        rounds = max(3, int(args.budget / max(users * 5e-6, 1e-6)))
+
+        old = measure(per_recipient_broadcast, server, message, rounds)
+        new = measure(StubServer.broadcast, server, message, rounds)
+        scan = measure(scan_channel, server, channel_message, rounds)
+        indexed = measure(indexed_channel, server, channel_message, rounds)
+        results.append(
+            {
+                "users": users,
+                "per_recipient_cpu_us": old * 1e6,
+                "encode_once_cpu_us": new * 1e6,
+                "speedup": old / new if new else None,
+                "channel_members": min(args.members, users),
+                "channel_scan_cpu_us": scan * 1e6,
+                "channel_index_cpu_us": indexed * 1e6,
+            }
+        )
+        print(
+            f"{users:>8} {old * 1e6:>18.1f} {new * 1e6:>16.1f} {old / new:>7.1f}x"
+            f" {scan * 1e6:>16.1f} {indexed * 1e6:>17.1f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"benchmark": "broadcast", "size": args.size, "results": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Relay latency across federated servers.
+
+Starts --nodes servers on localhost, each linked to the previous one (a
+chain, so node k is k relay hops from node0) or to all others with --mesh.
+Logs --users bots into every node, then node0's bots send broadcasts and
+private messages to users on the other nodes at a fixed rate. Reports the
+delivery latency seen on each node: node0 is local delivery (plus the echo
+of private messages), every other node adds its relay hops.
+
+    python -m benchmarks.bench_federation --nodes 3 --users 10 --rate 200
+"""
+
+import argparse
+import json
+import os
+import random
+import secrets
+import tempfile
+import time
+
+from admin import fetch_stats
+from benchmarks.bot import ChatBot
+from benchmarks.load import free_port, percentile, start_server, to_ms
+
+
+def wait_for_federation(ports, users, timeout=30.0):
+    """Waits until every node knows every other node and its users."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        converged = True
+        for port in ports:
+            known = fetch_stats(port=port)["federation"]["nodes"]
+            if len(known) != len(ports) - 1 or any(n != users for n in known.values()):
+                converged = False
+                break
+        if converged:
+            return
+        time.sleep(0.2)
+    raise RuntimeError("federation did not converge")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--mesh", action="store_true", help="link every pair of nodes")
+    parser.add_argument("--users", type=int, default=10, help="bots per node")
+    parser.add_argument(
+        "--rate", type=float, default=100, help="messages/s sent from node0"
+    )
+    parser.add_argument("--duration", type=float, default=10, help="seconds of traffic")
+    parser.add_argument("--private-ratio", type=float, default=0.2)
+    parser.add_argument("--size", type=int, default=100, help="content padding bytes")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to drain")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    names = [f"node{i}" for i in range(args.nodes)]
+    ports = [free_port() for _ in names]
+    os.environ["CHAT_PEER_SECRET"] = secrets.token_hex(16)  # Inherited by servers
+
+    servers = []
+    bots = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for index, name in enumerate(names):
+                earlier = (
+                    ports[:index] if args.mesh else ports[max(0, index - 1) : index]
+                )
+                server_args = ["--node", name]
+                for port in earlier:
+                    server_args += ["--peer", f"127.0.0.1:{port}"]
+                workdir = os.path.join(tmp, name)
+                os.mkdir(workdir)
+                servers.append(
+                    start_server(ports[index], "threaded", server_args, workdir)
+                )
+
+            for name, port in zip(names, ports):
+                bots[name] = [
+                    ChatBot(f"{name}-bot{i}", port=port) for i in range(args.users)
+                ]
+                for bot in bots[name]:
+                    bot.login()
+                    bot.start()
+            wait_for_federation(ports, args.users)
+
+            senders = bots[names[0]]
+            remote = [(bot, name) for name in names[1:] for bot in bots[name]]
+            interval = 1.0 / args.rate
+            padding = "x" * args.size
+            broadcasts = privates = 0
+            start = time.perf_counter()
+            next_send = start
+            while time.perf_counter() - start < args.duration:
+                now = time.perf_counter()
+                if now < next_send:
+                    time.sleep(next_send - now)
+                next_send += interval
+
+                sender = rng.choice(senders)
+                if remote and rng.random() < args.private_ratio:
+                    target, node = rng.choice(remote)
+                    sender.send_private(f"{target.username}@{node}", padding)
+                    privates += 1
+                else:
+                    sender.send_broadcast(padding)
+                    broadcasts += 1
+            time.sleep(args.settle)
+
+            per_node = {}
+            for hops, name in enumerate(names):
+                latencies = []
+                for bot in bots[name]:
+                    with bot.lock:
+                        latencies.extend(bot.latencies_ns)
+                latencies.sort()
+                per_node[name] = {
+                    "hops": 1 if args.mesh and hops else hops,
+                    "received": len(latencies),
+                    "p50_ms": to_ms(percentile(latencies, 0.50)),
+                    "p99_ms": to_ms(percentile(latencies, 0.99)),
+                    "max_ms": to_ms(latencies[-1] if latencies else None),
+                }
+        finally:
+            for node_bots in bots.values():
+                for bot in node_bots:
+                    bot.close()
+            for server in servers:
+                server.terminate()
+                server.wait(timeout=30)
+
+    results = {
+        "config": vars(args),
+        "sent": {"broadcasts": broadcasts, "private": privates},
+        "expected_broadcast_deliveries_per_node": broadcasts * args.users,
+        "nodes": per_node,
+    }
+    print(f"{broadcasts} broadcasts, {privates} private messages from {names[0]}")
+    print(f"{'node':>8}  {'hops':>4}  {'received':>8}  {'p50 ms':>8}  {'p99 ms':>8}")
+    for name, node in per_node.items():
+        print(
+            f"{name:>8}  {node['hops']:>4}  {node['received']:>8}  "
+            f"{node['p50_ms'] or 0:>8.2f}  {node['p99_ms'] or 0:>8.2f}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
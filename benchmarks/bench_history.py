@@ -0,0 +1,121 @@
+"""
+Benchmark: login-time history cost as the messages table grows.
+
+Fills a scratch database up to each requested size and times the
+keyset-paginated queries (latest page, a page deep in the past, a private
+conversation page) against the legacy full-table query that returned every
+broadcast sorted by timestamp.
+
+    python -m benchmarks.bench_history [--sizes 10000 100000 1000000] [--json out.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from database import DatabaseManager
+
+LEGACY_PUBLIC_QUERY = """
+    SELECT sender, content, timestamp FROM messages
+    WHERE msg_type = 'BROADCAST'
+    ORDER BY timestamp ASC
+"""
+
+
+def fill(db, start_id, count, users, rng):
+    """Appends `count` rows: ~80% broadcasts, the rest private between random users."""
+    rows = []
+    for message_id in range(start_id, start_id + count):
+        sender = f"user{rng.randrange(users)}"
+        if rng.random() < 0.8:
+            rows.append(
+                (message_id, sender, "all", "BROADCAST", f"message {message_id}")
+            )
+        else:
+            recipient = f"user{rng.randrange(users)}"
+            rows.append((message_id, sender, recipient, "PRIVATE", f"dm {message_id}"))
+    with db.conn:
+        db.conn.executemany(
+            "INSERT INTO messages (id, sender, recipient, msg_type, content) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+def time_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--no-legacy", action="store_true", help="skip the full-scan query"
+    )
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, "bench.db"))
+        rows = 0
+
+        print(
+            f"{'rows':>10} {'latest ms':>10} {'deep page ms':>13} "
+            f"{'private ms':>11} {'legacy ms':>10}"
+        )
+        for size in sorted(args.sizes):
+            fill(db, rows + 1, size - rows, args.users, rng)
+            rows = size
+
+            latest = time_ms(lambda: db.get_public_history(), args.repeat)
+            deep = time_ms(
+                lambda: db.get_public_history(before_id=rows // 2), args.repeat
+            )
+            private = time_ms(
+                lambda: db.get_private_history("user1", "user2"), args.repeat
+            )
+            legacy = None
+            if not args.no_legacy:
+                legacy = time_ms(
+                    lambda: db.conn.execute(LEGACY_PUBLIC_QUERY).fetchall(),
+                    max(1, args.repeat // 10),
+                )
+
+            results.append(
+                {
+                    "rows": rows,
+                    "latest_page_ms": latest,
+                    "deep_page_ms": deep,
+                    "private_page_ms": private,
+                    "legacy_full_scan_ms": legacy,
+                }
+            )
+            legacy_text = f"{legacy:>10.2f}" if legacy is not None else f"{'-':>10}"
+            print(
+                f"{rows:>10} {latest:>10.3f} {deep:>13.3f} {private:>11.3f} {legacy_text}"
+            )
+
+        db.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "history", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Login-path database cost: a reconnect storm of returning users, with and without the user directory.
+
+Registers `--users` users (each bound to an IP) in a scratch database,
+then opens it again the way a restarted server would and runs every
+user's LOGIN checks: the IP-binding lookup (get_user_ip) and the
+registration (add_user). This is done once from a single thread and once
+from `--threads` threads at the same time. Without the user directory,
+every login costs a SELECT plus an INSERT OR IGNORE, an UPDATE and a
+commit. With the directory, returning users are answered from memory.
+
+    python -m benchmarks.bench_login [--users 1000 10000] [--threads 32] [--json out.json]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from database import DatabaseManager
+
+IP_ADDRESS = "192.168.1.20"
+
+
+def login(db, username):
+    stored_ip = db.get_user_ip(username)
+    if stored_ip not in (None, IP_ADDRESS):
+        raise RuntimeError(f"{username} is bound to {stored_ip}")
+    db.add_user(username, IP_ADDRESS)
+
+
+def storm(db, usernames, threads):
+    """Logs every user in from `threads` threads; returns logins per second."""
+    shares = [usernames[index::threads] for index in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def run(share):
+        barrier.wait()
+        for username in share:
+            login(db, username)
+
+    workers = [threading.Thread(target=run, args=(share,)) for share in shares]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return len(usernames) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(
+        f"{'users':>7} {'directory':>10} {'open ms':>8} {'logins/s 1 thread':>18} "
+        f"{f'logins/s {args.threads} threads':>20}"
+    )
+    for users in args.users:
+        usernames = [f"user{index}" for index in range(users)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            db = DatabaseManager(path, user_directory=False)
+            with db.conn:
+                db.conn.executemany(
+                    "INSERT INTO users (username, ip_address) VALUES (?, ?)",
+                    [(username, IP_ADDRESS) for username in usernames],
+                )
+            db.close()
+
+            for directory in (False, True):
+                start = time.perf_counter()
+                db = DatabaseManager(path, user_directory=directory)
+                open_ms = (time.perf_counter() - start) * 1000
+                single = storm(db, usernames, 1)
+                concurrent = storm(db, usernames, args.threads)
+                stats = db.user_stats()
+                db.close()
+
+                results.append(
+                    {
+                        "users": users,
+                        "directory": directory,
+                        "open_ms": open_ms,
+                        "logins_per_s_1_thread": single,
+                        "logins_per_s_concurrent": concurrent,
+                        "threads": args.threads,
+                        "db_reads": stats["db_reads"],
+                        "db_writes": stats["db_writes"],
+                    }
+                )
+                print(
+                    f"{users:>7} {'on' if directory else 'off':>10} {open_ms:>8.1f} "
+                    f"{single:>18.0f} {concurrent:>20.0f}"
+                )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "login", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
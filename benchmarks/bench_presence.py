@@ -0,0 +1,162 @@
+"""
+Presence traffic of a login storm, delta clients against full-list clients.
+
+Each run starts a fresh server.py and logs N clients in at once. It waits
+until every client sees all N users online, then disconnects half of them
+and waits until the rest see them gone. Reports the presence bytes and
+frames received in total (USER_LIST and PRESENCE) and how long the lists
+took to converge. Clients that announce presence_delta get one small
+PRESENCE frame per change; the others get the whole USER_LIST every time.
+
+    python -m benchmarks.bench_presence [--users 100,500] [--mode asyncio]
+"""
+
+import argparse
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.load import free_port, start_server
+from protocol import (
+    FEATURE_PRESENCE,
+    PRESENCE,
+    USER_LIST_REQUEST,
+    FramedConnection,
+    encode_message,
+)
+from sidebar import PresenceRoster
+
+
+def parse_counts(text):
+    return [int(count) for count in text.split(",") if count.strip()]
+
+
+class PresenceClient:
+    """Logs in and keeps a PresenceRoster, counting the presence traffic."""
+
+    def __init__(self, username, port, deltas):
+        self.username = username
+        self.port = port
+        self.features = [FEATURE_PRESENCE] if deltas else []
+        self.roster = PresenceRoster()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.frames = 0
+        self.resyncs = 0
+        self.conn = None
+
+    def connect(self):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        self.conn = FramedConnection(sock)
+        self.conn.send(
+            {"type": "LOGIN", "content": self.username, "features": self.features}
+        )
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+
+    def receive_loop(self):
+        while True:
+            msg = self.conn.receive()
+            if msg is None:
+                return
+            m_type = msg.get("type")
+            if m_type not in ("USER_LIST", PRESENCE):
+                continue
+            with self.lock:
+                # Re-encoding gives the exact frame size, encoding is deterministic
+                self.bytes += len(encode_message(msg))
+                self.frames += 1
+                if m_type == "USER_LIST":
+                    self.roster.load(msg.get("content", []), msg.get("version"))
+                elif not self.roster.apply(
+                    msg.get("event"), msg.get("user"), msg.get("version")
+                ):
+                    self.resyncs += 1
+                    self.conn.send({"type": USER_LIST_REQUEST})
+
+    def sees(self, users):
+        with self.lock:
+            return self.roster.users.keys() == users
+
+    def close(self):
+        self.conn.shutdown()
+        self.conn.close()
+
+
+def wait_until(condition, timeout):
+    """Seconds until condition() held, or None on timeout."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if condition():
+            return time.perf_counter() - start
+        time.sleep(0.005)
+    return None
+
+
+def run(users, deltas, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(port, args.mode, args.server_args, workdir)
+        try:
+            clients = [PresenceClient(f"user{i}", port, deltas) for i in range(users)]
+            names = {client.username for client in clients}
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.login_concurrency) as pool:
+                list(pool.map(PresenceClient.connect, clients))
+            joined = wait_until(
+                lambda: all(client.sees(names) for client in clients), args.timeout
+            )
+            join_seconds = time.perf_counter() - start if joined is not None else None
+
+            leaving = clients[: users // 2]
+            staying = clients[users // 2 :]
+            names = {client.username for client in staying}
+            for client in leaving:
+                client.close()
+            leave_seconds = wait_until(
+                lambda: all(client.sees(names) for client in staying), args.timeout
+            )
+
+            total_bytes = sum(client.bytes for client in clients)
+            frames = sum(client.frames for client in clients)
+            resyncs = sum(client.resyncs for client in clients)
+            for client in staying:
+                client.close()
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    return total_bytes, frames, resyncs, join_seconds, leave_seconds
+
+
+def ms(seconds):
+    return f"{seconds * 1000:.0f}" if seconds is not None else "timeout"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--users", type=parse_counts, default=[50, 200, 500], help="e.g. 100,500"
+    )
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--login-concurrency", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("server_args", nargs="*", help="extra server.py arguments")
+    args = parser.parse_args()
+
+    print(
+        f"{'users':>6}  {'clients':>8}  {'presence KB':>12}  {'frames':>9}  "
+        f"{'resyncs':>7}  {'join ms':>8}  {'leave ms':>8}"
+    )
+    for users in args.users:
+        for deltas in (False, True):
+            total_bytes, frames, resyncs, join_s, leave_s = run(users, deltas, args)
+            print(
+                f"{users:>6}  {'delta' if deltas else 'full':>8}  "
+                f"{total_bytes / 1024:>12.0f}  {frames:>9}  {resyncs:>7}  "
+                f"{ms(join_s):>8}  {ms(leave_s):>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
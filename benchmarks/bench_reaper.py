@@ -0,0 +1,299 @@
+"""
+Idle-connection reaping: timer wheel cost and thousands of silent connections.
+
+The first part runs in-process. It watches `--watches` fake connections, a
+share of which talk every simulated second, and times one
+IdleReaper.reap() tick against a reaper without the wheel, which checks
+every connection on every tick.
+
+The second part starts a fresh server.py with short heartbeat timeouts and
+opens `--connections` silent connections: half never send LOGIN, the other
+half log in announcing heartbeat support and then never answer a PING (they
+read and discard what the server sends, like a peer whose end has gone
+away). One observer client answers its PINGs. Reports when the silent
+connections were closed, the presence leaves the observer saw, and the
+server's thread count before, at the peak and after reaping.
+
+    python -m benchmarks.bench_reaper [--watches 100000] [--connections 2000] [--mode asyncio]
+"""
+
+import argparse
+import queue
+import random
+import selectors
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+from admin import fetch_stats
+from benchmarks.load import free_port, start_server
+from heartbeat import IdleReaper
+from protocol import (
+    FEATURE_HEARTBEAT,
+    FEATURE_PRESENCE,
+    PING,
+    PONG,
+    PRESENCE,
+    PRESENCE_LEAVE,
+    FramedConnection,
+    encode_message,
+)
+
+PING_INTERVAL = 2.0
+IDLE_TIMEOUT = 5.0
+LOGIN_TIMEOUT = 3.0
+
+
+def bench_wheel(watches, active, seconds):
+    """Median and max ms of one reap() tick, and of a full scan, per tick."""
+    reaper = IdleReaper(30.0, 90.0, 10.0)
+    entries = [reaper.watch(lambda: None, lambda: None) for _ in range(watches)]
+    start = entries[0].last_seen
+    rng = random.Random(1)
+    # Connections arrived over the last ping interval, not all at once
+    for entry in entries:
+        entry.last_seen = start - rng.uniform(0, reaper.ping_interval)
+        reaper.wheel.schedule(entry, entry.last_seen + reaper.ping_interval)
+    talkers = entries[: int(watches * active)]
+    pinged = [float("-inf")] * watches  # The scanning reaper's own state
+
+    wheel_ms = []
+    scan_ms = []
+    for second in range(1, seconds + 1):
+        now = start + second
+        for entry in rng.sample(talkers, len(talkers) // 10):
+            entry.last_seen = now
+
+        begin = time.perf_counter()
+        reaper.reap(now)
+        wheel_ms.append((time.perf_counter() - begin) * 1000)
+
+        begin = time.perf_counter()
+        # The same decisions as reap(), for every connection
+        for index, entry in enumerate(entries):
+            idle = now - entry.last_seen
+            if idle < reaper.ping_interval:
+                continue
+            if idle >= reaper.idle_timeout:
+                pass  # Where a scanning reaper would close
+            elif pinged[index] < entry.last_seen:
+                pinged[index] = now  # Not pinged since it went quiet
+        scan_ms.append((time.perf_counter() - begin) * 1000)
+    return wheel_ms, scan_ms
+
+
+def server_threads(pid):
+    """Thread count of a process (Linux /proc), None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class Observer:
+    """A live heartbeat client: answers PING and counts presence leaves."""
+
+    def __init__(self, port):
+        sock = socket.create_connection(("127.0.0.1", port))
+        self.conn = FramedConnection(sock)
+        self.conn.send(
+            {
+                "type": "LOGIN",
+                "content": "observer",
+                "features": [FEATURE_PRESENCE, FEATURE_HEARTBEAT],
+            }
+        )
+        self.pings = 0
+        self.leaves = 0
+        self.connected = True
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+
+    def receive_loop(self):
+        while True:
+            msg = self.conn.receive()
+            if msg is None:
+                self.connected = False
+                return
+            if msg.get("type") == PING:
+                self.pings += 1
+                self.conn.send({"type": PONG})
+            elif msg.get("type") == PRESENCE and msg.get("event") == PRESENCE_LEAVE:
+                self.leaves += 1
+
+    def close(self):
+        self.conn.shutdown()
+        self.conn.close()
+
+
+class SilentPool(threading.Thread):
+    """
+    Silent connections sharing one selector thread. Whatever the server
+    sends is read and dropped; nothing is ever sent back after LOGIN.
+    Records how long each connection lived until the server closed it.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.new = queue.SimpleQueue()
+        self.opened = 0
+        self.lifetimes = {}  # "anonymous" / "logged in" -> [seconds]
+        self.stopped = threading.Event()
+
+    def open(self, port, username=None):
+        sock = socket.create_connection(("127.0.0.1", port))
+        if username is not None:
+            sock.sendall(
+                encode_message(
+                    {
+                        "type": "LOGIN",
+                        "content": username,
+                        "features": [FEATURE_HEARTBEAT, FEATURE_PRESENCE],
+                    }
+                )
+            )
+        sock.setblocking(False)
+        kind = "anonymous" if username is None else "logged in"
+        self.new.put((sock, kind, time.monotonic()))
+        self.opened += 1
+
+    def closed(self):
+        return sum(len(times) for times in self.lifetimes.values())
+
+    def run(self):
+        while not self.stopped.is_set():
+            while not self.new.empty():
+                sock, kind, opened = self.new.get()
+                self.selector.register(sock, selectors.EVENT_READ, (kind, opened))
+            for key, _ in self.selector.select(0.05):
+                try:
+                    data = key.fileobj.recv(65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b""
+                if not data:
+                    kind, opened = key.data
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    lifetime = time.monotonic() - opened
+                    self.lifetimes.setdefault(kind, []).append(lifetime)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+def bench_live(args):
+    server_args = [
+        "--ping-interval",
+        str(PING_INTERVAL),
+        "--idle-timeout",
+        str(IDLE_TIMEOUT),
+        "--login-timeout",
+        str(LOGIN_TIMEOUT),
+    ]
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(port, args.mode, server_args, workdir)
+        try:
+            observer = Observer(port)
+            time.sleep(0.5)
+            baseline = server_threads(server.pid)
+
+            pool = SilentPool()
+            pool.start()
+            started = time.monotonic()
+            half = args.connections // 2
+            for index in range(args.connections):
+                pool.open(port, None if index < half else f"silent{index}")
+            opened = time.monotonic() - started
+            time.sleep(0.5)
+            peak = server_threads(server.pid)
+
+            deadline = time.monotonic() + IDLE_TIMEOUT * 4
+            while pool.closed() < args.connections and time.monotonic() < deadline:
+                time.sleep(0.1)
+            pool.stop()
+            time.sleep(1.0)
+            after = server_threads(server.pid)
+            stats = fetch_stats(port=port) if args.mode == "threaded" else None
+            observer_alive = observer.connected
+            observer.close()
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    def describe(kind, count):
+        times = pool.lifetimes.get(kind, [])
+        if not times:
+            return f"0/{count} closed"
+        return f"{len(times)}/{count} closed after {min(times):.1f}-{max(times):.1f} s"
+
+    print(f"opened {args.connections} connections in {opened:.1f} s ({args.mode})")
+    print(
+        f"  without LOGIN  (login timeout {LOGIN_TIMEOUT:.0f} s): "
+        + describe("anonymous", half)
+    )
+    print(
+        f"  silent logins  (ping {PING_INTERVAL:.0f} s, idle timeout "
+        f"{IDLE_TIMEOUT:.0f} s): " + describe("logged in", args.connections - half)
+    )
+    print(
+        f"  observer: {'still connected' if observer_alive else 'DISCONNECTED'}, "
+        f"answered {observer.pings} pings, saw {observer.leaves} leaves"
+    )
+    print(f"  server threads: {baseline} before, {peak} peak, {after} after")
+    if stats is not None:
+        counters = stats["metrics"]["counters"]
+        tick = stats["metrics"]["latency"].get("reaper_tick", {})
+        print(
+            f"  server: reaped {counters.get('reaped', 0)}, "
+            f"pinged {counters.get('heartbeat_pings', 0)}, "
+            f"reaper tick p99 {tick.get('p99_ms', 0):.2f} ms, "
+            f"max {tick.get('max_ms', 0):.2f} ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--watches", type=int, default=100_000)
+    parser.add_argument(
+        "--active", type=float, default=0.5, help="share of watches that talk"
+    )
+    parser.add_argument(
+        "--seconds", type=int, default=80, help="simulated ticks (< idle timeout)"
+    )
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument(
+        "--no-live", action="store_true", help="only run the in-process part"
+    )
+    args = parser.parse_args()
+
+    wheel_ms, scan_ms = bench_wheel(args.watches, args.active, args.seconds)
+    print(f"{args.watches} watched connections, {args.seconds} ticks")
+    print(
+        f"  timer wheel: median {statistics.median(wheel_ms):.2f} ms, "
+        f"max {max(wheel_ms):.2f} ms per tick"
+    )
+    print(
+        f"  full scan:   median {statistics.median(scan_ms):.2f} ms, "
+        f"max {max(scan_ms):.2f} ms per tick"
+    )
+
+    if not args.no_live:
+        bench_live(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Reconnect cost: resuming from the last message id against logging in afresh.
+
+Fills a scratch database with `--history` messages: broadcasts, plus
+private messages between the reconnecting user and a few friends. Then it
+starts server.py on it and reconnects that user as if it had been away
+for the last `--missed` messages.
+
+- A resuming client sends the id of the newest message it had. It receives
+  everything it missed, in every chat, up to RESUMED.
+- A fresh login gets the latest group chat page. It then has to page back
+  with HISTORY_REQ until it reaches the last message it had. Private
+  messages sent meanwhile are only found by opening each conversation,
+  which the fresh client does not do.
+
+Reports bytes received, round trips, time to ready and how many of the
+missed messages each client ended up with.
+
+    python -m benchmarks.bench_resume [--history 200000] [--missed 10,100,1000] [--mode asyncio]
+"""
+
+import argparse
+import os
+import random
+import socket
+import tempfile
+import time
+
+from benchmarks.load import free_port, start_server
+from database import HISTORY_PAGE_SIZE, DatabaseManager
+from protocol import (
+    FEATURE_HISTORY_BATCH,
+    FEATURE_ZLIB,
+    HISTORY_REQUEST,
+    RESUMED,
+    FramedConnection,
+    unpack_history,
+)
+
+USER = "reader"
+FRIENDS = [f"friend{index}" for index in range(5)]
+
+
+def parse_counts(text):
+    return [int(count) for count in text.split(",") if count.strip()]
+
+
+def fill(path, count, rng):
+    """Messages 1..count, a fifth of them private between USER and a friend."""
+    db = DatabaseManager(path)
+    rows = []
+    for message_id in range(1, count + 1):
+        content = f"message {message_id} " + "lorem ipsum " * 4
+        if rng.random() < 0.2:
+            friend = rng.choice(FRIENDS)
+            sender, recipient = (USER, friend) if rng.random() < 0.5 else (friend, USER)
+            rows.append((message_id, sender, recipient, "PRIVATE", content))
+        else:
+            rows.append((message_id, rng.choice(FRIENDS), "all", "BROADCAST", content))
+    with db.conn:
+        db.conn.executemany(
+            "INSERT INTO messages (id, sender, recipient, msg_type, content) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+    db.close()
+    return {row[0] for row in rows}
+
+
+class CountingSocket:
+    """Socket wrapper that counts the bytes received."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = 0
+
+    def recv_into(self, buffer):
+        n = self.sock.recv_into(buffer)
+        self.received += n
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def connect(port, resume=None):
+    sock = CountingSocket(socket.create_connection(("127.0.0.1", port)))
+    conn = FramedConnection(sock)
+    login = {
+        "type": "LOGIN",
+        "content": USER,
+        "features": [FEATURE_HISTORY_BATCH, FEATURE_ZLIB],
+    }
+    if resume is not None:
+        login["resume"] = resume
+    conn.send(login)
+    return sock, conn
+
+
+def resume_login(port, last_id):
+    """(bytes, round trips, seconds, message ids) of a resumed login."""
+    start = time.perf_counter()
+    sock, conn = connect(port, last_id)
+    ids = set()
+    while True:
+        msg = conn.receive()
+        if msg is None:
+            raise RuntimeError("server closed the connection")
+        if msg.get("type") == "HISTORY":
+            ids.update(m["id"] for m in unpack_history(msg))
+        elif msg.get("type") == RESUMED:
+            if not msg["complete"]:
+                raise RuntimeError("server could not resume, too many missed")
+            break
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return sock.received, 1, elapsed, ids
+
+
+def fresh_login(port, last_id):
+    """The same for a fresh login that pages back to last_id in the group chat."""
+    start = time.perf_counter()
+    sock, conn = connect(port)
+    ids = set()
+    round_trips = 1
+    oldest = None
+    while True:
+        msg = conn.receive()
+        if msg is None:
+            raise RuntimeError("server closed the connection")
+        if msg.get("type") != "HISTORY":
+            continue
+        page = unpack_history(msg)
+        ids.update(m["id"] for m in page)
+        if "before_id" in msg and len(page) < HISTORY_PAGE_SIZE:
+            break  # Reached the start of the chat
+        if page:
+            oldest = page[0]["id"]
+        if oldest is None or oldest <= last_id + 1:
+            break
+        conn.send(
+            {
+                "type": HISTORY_REQUEST,
+                "to": "all",
+                "before_id": oldest,
+                "limit": HISTORY_PAGE_SIZE,
+            }
+        )
+        round_trips += 1
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return sock.received, round_trips, elapsed, ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--history", type=int, default=200_000)
+    parser.add_argument("--missed", type=parse_counts, default=[10, 100, 1000])
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    args = parser.parse_args()
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        all_ids = fill(
+            os.path.join(workdir, "chat_history.db"), args.history, random.Random(3)
+        )
+        server = start_server(port, args.mode, [], workdir)
+        try:
+            print(f"{args.history} messages in the database ({args.mode})")
+            print(
+                f"{'missed':>7} {'login':>7} {'KB':>8} {'round trips':>12} "
+                f"{'ms':>8} {'missed received':>16}"
+            )
+            for missed in args.missed:
+                last_id = args.history - missed
+                wanted = {i for i in all_ids if i > last_id}
+                for name, run in (("resume", resume_login), ("fresh", fresh_login)):
+                    received, round_trips, elapsed, ids = run(port, last_id)
+                    time.sleep(0.3)  # Until the server has logged USER out
+                    print(
+                        f"{missed:>7} {name:>7} {received / 1024:>8.1f} "
+                        f"{round_trips:>12} {elapsed * 1000:>8.1f} "
+                        f"{len(wanted & ids):>9}/{len(wanted)}"
+                    )
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
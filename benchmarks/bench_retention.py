@@ -0,0 +1,157 @@
+"""
+Retention: archiving old messages while store_message keeps running.
+
+Fills a scratch database with `--rows` messages spread over the last
+`--days` days. Then it moves everything older than `--keep-days` into
+archive segments and gives the freed pages back with incremental_vacuum,
+while another thread calls store_message in a loop. Reports the archive
+throughput, the database and archive sizes, store_message latency with
+and without the pass running, and history page latency for live and
+archived pages.
+
+    python -m benchmarks.bench_retention [--rows 500000] [--keep-days 7] [--write-behind]
+"""
+
+import argparse
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from database import MAX_MESSAGE_ID, DatabaseManager
+
+
+def fill(db, rows, days, rng):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    batch = 50_000
+    for first in range(1, rows + 1, batch):
+        chunk = []
+        for message_id in range(first, min(first + batch, rows + 1)):
+            age = datetime.timedelta(days=days * (1 - message_id / rows))
+            timestamp = (now - age).strftime("%Y-%m-%d %H:%M:%S")
+            sender = f"user{rng.randrange(100)}"
+            if rng.random() < 0.8:
+                chunk.append((message_id, sender, "all", "BROADCAST"))
+            else:
+                chunk.append(
+                    (message_id, sender, f"user{rng.randrange(100)}", "PRIVATE")
+                )
+            chunk[-1] += (f"message {message_id} " + "lorem ipsum " * 8, timestamp)
+        with db.conn:
+            db.conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", chunk)
+
+
+def store_latencies(db, stop):
+    """store_message latency in ms, called back to back until stop is set."""
+    samples = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        db.store_message("writer", "all", "BROADCAST", "live message")
+        samples.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.001)
+    return samples
+
+
+def run_with_storer(db, work):
+    stop = threading.Event()
+    result = {}
+    storer = threading.Thread(
+        target=lambda: result.setdefault("samples", store_latencies(db, stop))
+    )
+    storer.start()
+    try:
+        value = work()
+    finally:
+        stop.set()
+        storer.join()
+    return value, result["samples"]
+
+
+def describe(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return (
+        f"p50 {statistics.median(samples):.2f} ms, p99 {p99:.2f} ms, "
+        f"max {samples[-1]:.2f} ms ({len(samples)} calls)"
+    )
+
+
+def file_size(path):
+    return sum(
+        os.path.getsize(path + suffix)
+        for suffix in ("", "-wal")
+        if os.path.exists(path + suffix)
+    )
+
+
+def time_page(db, before_id, repeat=20):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.get_public_history(50, before_id)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples[0], statistics.median(samples[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--keep-days", type=float, default=7)
+    parser.add_argument("--write-behind", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        db = DatabaseManager(path)
+        fill(db, args.rows, args.days, random.Random(7))
+        db.close()
+        # Reopened, so message ids continue after the filled rows
+        db = DatabaseManager(path, write_behind=args.write_behind)
+        size_before = file_size(path)
+
+        _, idle = run_with_storer(db, lambda: time.sleep(2))
+
+        cutoff = (
+            datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(days=args.keep_days)
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        start = time.perf_counter()
+        archived, during = run_with_storer(db, lambda: db.archive_messages(cutoff))
+        archive_s = time.perf_counter() - start
+        start = time.perf_counter()
+        freed, vacuuming = run_with_storer(db, db.vacuum_free_pages)
+        vacuum_s = time.perf_counter() - start
+        db.flush()
+        db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size_after = file_size(path)
+        archive_bytes = db.archive.stats()["bytes"]
+
+        live = time_page(db, MAX_MESSAGE_ID)
+        archived_page = time_page(db, archived // 2)
+        db.close()
+
+    print(f"{args.rows} messages over {args.days:g} days, keeping {args.keep_days:g}")
+    print(
+        f"  archived {archived} messages in {archive_s:.1f} s "
+        f"({archived / archive_s:.0f}/s), freed {freed} pages in {vacuum_s:.1f} s"
+    )
+    print(
+        f"  database {size_before / 2**20:.1f} MB -> {size_after / 2**20:.1f} MB, "
+        f"archive segments {archive_bytes / 2**20:.1f} MB"
+    )
+    mode = "write-behind" if args.write_behind else "synchronous"
+    print(f"  store_message ({mode}), idle:      {describe(idle)}")
+    print(f"  store_message, while archiving:    {describe(during)}")
+    print(f"  store_message, while vacuuming:    {describe(vacuuming)}")
+    print(
+        f"  history page: live {live[1]:.2f} ms, archived {archived_page[1]:.2f} ms "
+        f"({archived_page[0]:.2f} ms cold)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Benchmark: full-text SEARCH latency as the messages table grows.
+
+Fills a scratch database up to each requested size with messages drawn from
+a Zipf-distributed vocabulary (the FTS5 index is maintained by the insert
+triggers, so the fill rate includes indexing). Then it times
+DatabaseManager.search_messages for a common, a mid-frequency and a rare
+word, a two-word query and a prefix query. A LIKE scan for the rare word
+is timed next to them for comparison.
+
+    python -m benchmarks.bench_search [--sizes 100000 1000000 3000000] [--json out.json]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from database import DatabaseManager
+
+LIKE_QUERY = """
+    SELECT id, sender, recipient, msg_type, content, timestamp FROM messages
+    WHERE content LIKE ?
+    AND (msg_type = 'BROADCAST' OR (msg_type = 'PRIVATE' AND ? IN (sender, recipient)))
+    ORDER BY id DESC
+    LIMIT 20
+"""
+
+VOCABULARY = 20_000
+SEARCHER = "user1"
+
+
+def word(rank):
+    return f"w{rank}"
+
+
+# Queries by how many messages they match: rank 1 is in most of them
+QUERIES = {
+    "common": word(1),
+    "mid": word(100),
+    "rare": word(15_000),
+    "two words": f"{word(100)} {word(300)}",
+    "prefix": f"{word(1234)}*",
+}
+
+
+def fill(db, start_id, count, users, rng, cum_weights):
+    """Appends `count` rows of 4-12 words: ~80% broadcasts, the rest private."""
+    ranks = range(1, VOCABULARY + 1)
+    batch = 50_000
+    for first in range(start_id, start_id + count, batch):
+        last = min(first + batch, start_id + count)
+        lengths = [rng.randint(4, 12) for _ in range(last - first)]
+        words = iter(rng.choices(ranks, cum_weights=cum_weights, k=sum(lengths)))
+        rows = []
+        for message_id, length in zip(range(first, last), lengths):
+            content = " ".join(word(rank) for rank in itertools.islice(words, length))
+            sender = f"user{rng.randrange(users)}"
+            if rng.random() < 0.8:
+                rows.append((message_id, sender, "all", "BROADCAST", content))
+            else:
+                recipient = f"user{rng.randrange(users)}"
+                rows.append((message_id, sender, recipient, "PRIVATE", content))
+        with db.conn:
+            db.conn.executemany(
+                "INSERT INTO messages (id, sender, recipient, msg_type, content) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+
+def time_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--no-like", action="store_true", help="skip the LIKE scan")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    cum_weights = list(
+        itertools.accumulate(1 / rank for rank in range(1, VOCABULARY + 1))
+    )
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, "bench.db"))
+        rows = 0
+
+        print(
+            f"{'rows':>10} {'fill rows/s':>12} "
+            + " ".join(f"{name + ' ms':>13}" for name in QUERIES)
+            + f" {'LIKE ms':>10}"
+        )
+        for size in sorted(args.sizes):
+            start = time.perf_counter()
+            fill(db, rows + 1, size - rows, args.users, rng, cum_weights)
+            fill_rate = (size - rows) / (time.perf_counter() - start)
+            rows = size
+
+            timings = {
+                name: time_ms(
+                    lambda query=query: db.search_messages(SEARCHER, query),
+                    args.repeat,
+                )
+                for name, query in QUERIES.items()
+            }
+            like = None
+            if not args.no_like:
+                pattern = f"%{QUERIES['rare']}%"
+                like = time_ms(
+                    lambda: db.conn.execute(LIKE_QUERY, (pattern, SEARCHER)).fetchall(),
+                    max(1, args.repeat // 5),
+                )
+
+            results.append(
+                {
+                    "rows": rows,
+                    "fill_rows_per_s": fill_rate,
+                    "search_ms": timings,
+                    "like_scan_ms": like,
+                }
+            )
+            like_text = f"{like:>10.1f}" if like is not None else f"{'-':>10}"
+            print(
+                f"{rows:>10} {fill_rate:>12.0f} "
+                + " ".join(f"{timings[name]:>13.2f}" for name in QUERIES)
+                + f" {like_text}"
+            )
+
+        db.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "search", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
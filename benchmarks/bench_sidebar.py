@@ -0,0 +1,81 @@
+"""
+Cost of a sidebar update against the number of online users (headless).
+
+Replays the events that redraw the sidebar (a user joining, an unread
+counter going up, switching chats) through sidebar.SidebarModel and reports
+the time per update and how many buttons each update touches, next to the
+old destroy-and-rebuild approach, which destroys and recreates every button
+each time.
+
+    python -m benchmarks.bench_sidebar [--users 10,100,1000,5000]
+"""
+
+import argparse
+import time
+
+from sidebar import SidebarModel, sidebar_entries
+
+ME = "me"
+
+
+def parse_counts(text):
+    return [int(count) for count in text.split(",") if count.strip()]
+
+
+def touched(diff):
+    """Buttons created, destroyed or reconfigured (a re-pack touches all)."""
+    return len(diff.removed) + len(diff.added) + len(diff.changed)
+
+
+def bench(users, rounds):
+    online = [ME] + [f"user{i}" for i in range(users)]
+    unread = {}
+    model = SidebarModel()
+    model.update(sidebar_entries(online, ME, "all", unread))
+
+    def update(current):
+        start = time.perf_counter()
+        entries = sidebar_entries(online, ME, current, unread)
+        diff = model.update(entries)
+        # Rebuild: destroy and create every button, group chat included
+        return time.perf_counter() - start, touched(diff), 2 * len(entries)
+
+    results = {"join": [], "unread": [], "switch": []}
+    current = "all"
+    for i in range(rounds):
+        online.append(f"late{i}")
+        results["join"].append(update(current))
+
+        partner = online[1 + i % users]
+        unread[partner] = unread.get(partner, 0) + 1
+        results["unread"].append(update(current))
+
+        current = partner
+        unread[partner] = 0
+        results["switch"].append(update(current))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=parse_counts, default=[10, 100, 1000, 5000])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    print(
+        f"{'users':>6}  {'event':>7}  {'us/update':>10}  {'buttons touched':>15}  "
+        f"{'rebuild touches':>15}"
+    )
+    for users in args.users:
+        for event, samples in bench(users, args.rounds).items():
+            seconds, buttons, rebuild = (
+                sum(column) / len(samples) for column in zip(*samples)
+            )
+            print(
+                f"{users:>6}  {event:>7}  {seconds * 1e6:>10.1f}  {buttons:>15.1f}  "
+                f"{rebuild:>15.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
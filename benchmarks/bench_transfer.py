@@ -0,0 +1,213 @@
+"""
+File transfer: loopback throughput, and what a transfer costs chat traffic.
+
+Starts server.py in a scratch directory and logs in two users: "sharer",
+who shares a `--size` MB file in the group chat, and "pinger", who keeps
+sending itself private messages. While the file is uploaded and then
+downloaded over their own data connections, the pinger times each echo.
+This shows whether chat latency holds up during a transfer. The server's
+RSS is sampled throughout, to check that file data is never held in
+memory.
+
+It then checks resumption. A second upload is broken off halfway and
+restarted. A download starts from a ".part" file already holding the
+first half, as an interrupted one would leave it. Both should only move
+the missing half.
+
+    python -m benchmarks.bench_transfer [--size 256] [--mode asyncio] [--file-rate 0]
+"""
+
+import argparse
+import filecmp
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+from benchmarks.load import free_port, rss_bytes, start_server
+from protocol import (
+    FILE_OFFER,
+    FILE_OFFSET,
+    FILE_PUT,
+    FILE_READY,
+    FramedConnection,
+    parse_file_link,
+    receive_message,
+    send_message,
+)
+from transfer import download_file, upload_file
+
+
+def login(port, username):
+    conn = FramedConnection(socket.create_connection(("127.0.0.1", port)))
+    conn.send({"type": "LOGIN", "content": username})
+    return conn
+
+
+def wait_for(conn, check):
+    """Receives until check(msg) is true; returns that message."""
+    while True:
+        msg = conn.receive()
+        if msg is None:
+            raise RuntimeError("server closed the connection")
+        if check(msg):
+            return msg
+
+
+def offer(conn, name, size):
+    conn.send({"type": FILE_OFFER, "to": "all", "name": name, "size": size, "ref": 1})
+    reply = wait_for(conn, lambda m: m.get("type") in (FILE_READY, "ERROR"))
+    if reply["type"] == "ERROR":
+        raise RuntimeError(reply["content"])
+    return reply["file_id"], reply["key"]
+
+
+def announced(conn, file_id):
+    """Waits for the chat message announcing file_id."""
+    wait_for(
+        conn,
+        lambda m: m.get("type") == "MSG"
+        and (parse_file_link(m.get("content", "")) or (None,))[0] == file_id,
+    )
+
+
+def ping(conn):
+    """Round trip of one private message to ourselves, in ms."""
+    start = time.perf_counter()
+    conn.send({"type": "MSG", "to": "pinger", "content": "ping"})
+    wait_for(conn, lambda m: m.get("type") == "MSG" and m.get("content") == "ping")
+    return (time.perf_counter() - start) * 1000
+
+
+def while_pinging(conn, pid, work):
+    """
+    Runs work() on a thread and pings until it returns. Returns (seconds,
+    result, ping latencies, peak server RSS).
+    """
+    result = {}
+
+    def run():
+        try:
+            result["value"] = work()
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run)
+    start = time.perf_counter()
+    thread.start()
+    samples, peak = [], 0
+    while thread.is_alive():
+        samples.append(ping(conn))
+        peak = max(peak, rss_bytes(pid) or 0)
+        time.sleep(0.01)
+    thread.join()
+    elapsed = time.perf_counter() - start
+    if "error" in result:
+        raise result["error"]
+    return elapsed, result["value"], samples, peak
+
+
+def describe(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return (
+        f"p50 {statistics.median(samples):.2f} ms, p99 {p99:.2f} ms "
+        f"({len(samples)} pings)"
+    )
+
+
+def upload_half(port, file_id, key, path, size):
+    """Sends the first half of an upload, then drops the connection."""
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        send_message(sock, {"type": FILE_PUT, "file_id": file_id, "key": key})
+        reply = receive_message(sock)
+        if reply is None or reply.get("type") != FILE_OFFSET:
+            raise RuntimeError(f"upload refused: {reply}")
+        with open(path, "rb") as f:
+            sock.sendfile(f, 0, size // 2)
+    time.sleep(0.5)  # Until the server has noticed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--file-rate", type=int, default=0)
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "source.bin")
+        block = os.urandom(1024 * 1024)
+        with open(source, "wb") as f:
+            for _ in range(args.size):
+                f.write(block)
+
+        server = start_server(
+            port, args.mode, ["--file-rate", str(args.file_rate)], workdir
+        )
+        try:
+            sharer = login(port, "sharer")
+            pinger = login(port, "pinger")
+            time.sleep(0.3)
+            idle = [ping(pinger) for _ in range(200)]
+            rss_idle = rss_bytes(server.pid) or 0
+
+            file_id, key = offer(sharer, "source.bin", size)
+            up_s, _, up_pings, up_rss = while_pinging(
+                pinger,
+                server.pid,
+                lambda: upload_file("127.0.0.1", port, file_id, key, source),
+            )
+            announced(sharer, file_id)
+
+            target = os.path.join(workdir, "download.bin")
+            down_s, _, down_pings, down_rss = while_pinging(
+                pinger,
+                server.pid,
+                lambda: download_file("127.0.0.1", port, file_id, key, target),
+            )
+            intact = filecmp.cmp(source, target, shallow=False)
+
+            second_id, second_key = offer(sharer, "again.bin", size)
+            upload_half(port, second_id, second_key, source, size)
+            resumed_up = upload_file("127.0.0.1", port, second_id, second_key, source)
+
+            partial = os.path.join(workdir, "partial.bin")
+            with open(source, "rb") as f, open(partial + ".part", "wb") as out:
+                out.write(f.read(size // 2))
+            resumed_down = download_file("127.0.0.1", port, file_id, key, partial)
+            resumed_intact = filecmp.cmp(source, partial, shallow=False)
+
+            sharer.close()
+            pinger.close()
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    mb = size / 2**20
+    print(f"{args.size} MB file over loopback ({args.mode})")
+    print(f"  upload:   {up_s:.2f} s, {mb / up_s:.0f} MB/s")
+    print(
+        f"  download: {down_s:.2f} s, {mb / down_s:.0f} MB/s, "
+        f"{'intact' if intact else 'CORRUPT'}"
+    )
+    print(f"  chat round trip, idle:            {describe(idle)}")
+    print(f"  chat round trip, while uploading:   {describe(up_pings)}")
+    print(f"  chat round trip, while downloading: {describe(down_pings)}")
+    print(
+        f"  server RSS: idle {rss_idle / 2**20:.1f} MB, peak while uploading "
+        f"{up_rss / 2**20:.1f} MB, while downloading {down_rss / 2**20:.1f} MB"
+    )
+    print(
+        f"  resumed upload sent {resumed_up / 2**20:.1f} MB, resumed download "
+        f"fetched {resumed_down / 2**20:.1f} MB of {mb:.0f} MB "
+        f"({'intact' if resumed_intact else 'CORRUPT'})"
+    )
+
+
+if __name__ == "__main__":
+    main()
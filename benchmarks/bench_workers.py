@@ -0,0 +1,68 @@
+"""
+Throughput of a single server process against N worker processes.
+
+Runs the same load test (benchmarks.load) against `server.py` for each
+worker count: 0 is the plain single-process server, N >= 1 is
+`--workers N` (hub plus N SO_REUSEPORT workers). Prints one line per run and
+optionally writes all results as JSON. Workers only pay off with spare
+cores, and the bots run in this one process, so drive a high rate with
+moderate user counts (or run the bots from another machine) before reading
+too much into the numbers.
+
+    python -m benchmarks.bench_workers --counts 0,1,4 --users 100 --rate 2000
+"""
+
+import argparse
+import copy
+import json
+import os
+
+from benchmarks.load import add_load_arguments, run_load
+
+
+def parse_counts(text):
+    return [int(count) for count in text.split(",") if count.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_load_arguments(parser)
+    parser.add_argument(
+        "--counts",
+        type=parse_counts,
+        default=[0, 1, max(2, os.cpu_count() or 1)],
+        help="comma separated worker counts (0 = single process)",
+    )
+    parser.add_argument("server_args", nargs="*", help="extra server.py arguments")
+    args = parser.parse_args()
+    args.mode = "threaded"  # Workers are threaded servers
+
+    runs = {}
+    print(
+        f"{'workers':>7}  {'sent/s':>9}  {'delivered/s':>11}  "
+        f"{'p50 ms':>8}  {'p99 ms':>8}  {'login p99':>9}  {'RSS MB':>7}"
+    )
+    for count in args.counts:
+        run_args = copy.copy(args)
+        run_args.server_args = list(args.server_args)
+        if count:
+            run_args.server_args += ["--workers", str(count)]
+        results = run_load(run_args)
+        runs[count] = results
+
+        latency = results["latency_ms"]
+        peak = results["server_rss_bytes"]["peak"]
+        print(
+            f"{count:>7}  {results['send_rate']:>9.0f}  {results['delivery_rate']:>11.0f}  "
+            f"{latency['p50'] or 0:>8.2f}  {latency['p99'] or 0:>8.2f}  "
+            f"{results['login_ready_ms']['p99']:>9.1f}  "
+            f"{(peak or 0) / 2**20:>7.1f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(runs, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Headless chat client for load testing, built on protocol.py only (no GUI).
+
+Benchmark traffic carries its send time in the content ("bench|<ns>"), so any
+bot in the same process can compute end-to-end delivery latency.
+"""
+
+import socket
+import threading
+import time
+
+from protocol import (
+    PORT,
+    FEATURE_HISTORY_BATCH,
+    FEATURE_ZLIB,
+    FramedConnection,
+    unpack_history,
+)
+
+BENCH_PREFIX = "bench|"
+
+
+def bench_content(padding=""):
+    """Message content stamped with the current time for latency measurement."""
+    return f"{BENCH_PREFIX}{time.perf_counter_ns()}|{padding}"
+
+
+def sent_at_ns(content):
+    """The send time stamped by bench_content, or None for other messages."""
+    if not isinstance(content, str) or not content.startswith(BENCH_PREFIX):
+        return None
+    try:
+        return int(content.split("|", 2)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+class ChatBot:
+    def __init__(
+        self,
+        username,
+        host="127.0.0.1",
+        port=PORT,
+        features=(FEATURE_HISTORY_BATCH, FEATURE_ZLIB),
+    ):
+        self.username = username
+        self.host = host
+        self.port = port
+        self.features = list(features)
+        self.conn = None
+
+        self.history_messages = 0  # Backlog messages received during login
+        self.login_seconds = None  # Connect until history replay finished
+        self.latencies_ns = []  # End-to-end delivery latency of bench messages
+        self.received = 0
+        self.sent = 0
+        self.error = None
+        self.receiver = None
+        self.lock = threading.Lock()
+
+    def login(self, timeout=30.0):
+        """
+        Connects, logs in and waits until the history replay is over.
+        The end of the replay is detected by sending a private message to
+        ourselves: the server only reads it once the replay is done.
+        Returns the login-to-ready time in seconds.
+        """
+        start = time.perf_counter()
+        sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        self.conn = FramedConnection(sock)
+        self.conn.send(
+            {"type": "LOGIN", "content": self.username, "features": self.features}
+        )
+
+        probe = f"ready-probe|{self.username}|{time.perf_counter_ns()}"
+        self.conn.send({"type": "MSG", "to": self.username, "content": probe})
+
+        while True:
+            msg = self.conn.receive()
+            if msg is None:
+                raise ConnectionError(f"{self.username}: connection closed at login")
+            m_type = msg.get("type")
+            if m_type == "ERROR":
+                raise ConnectionError(f"{self.username}: {msg.get('content')}")
+            if m_type == "HISTORY":
+                self.history_messages += len(unpack_history(msg))
+            elif m_type == "MSG":
+                if msg.get("content") == probe:
+                    break
+                self.history_messages += 1
+
+        self.login_seconds = time.perf_counter() - start
+        sock.settimeout(None)
+        return self.login_seconds
+
+    def start(self):
+        """Starts recording incoming traffic on a background thread."""
+        self.receiver = threading.Thread(
+            target=self.receive_loop, name=f"bot-{self.username}", daemon=True
+        )
+        self.receiver.start()
+
+    def receive_loop(self):
+        while True:
+            msg = self.conn.receive()
+            if msg is None:
+                return
+            if msg.get("type") != "MSG":
+                continue
+            sent_ns = sent_at_ns(msg.get("content"))
+            if sent_ns is None:
+                continue
+            latency = time.perf_counter_ns() - sent_ns
+            with self.lock:
+                self.received += 1
+                self.latencies_ns.append(latency)
+
+    def send_broadcast(self, padding=""):
+        self.sent += 1
+        return self.conn.send(
+            {"type": "MSG", "to": "all", "content": bench_content(padding)}
+        )
+
+    def send_private(self, recipient, padding=""):
+        self.sent += 1
+        return self.conn.send(
+            {"type": "MSG", "to": recipient, "content": bench_content(padding)}
+        )
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.shutdown()
+            self.conn.close()
+        if self.receiver is not None:
+            self.receiver.join(timeout=5)
@@ -0,0 +1,270 @@
+"""
+Load driver: N headless bots against a freshly started local chat server.
+
+Starts `server.py` in a scratch directory (so chat_history.db is untouched),
+optionally seeds some public history, logs the bots in, then replays a mix of
+broadcasts and private messages at a fixed rate. Reports throughput,
+end-to-end delivery latency (p50/p99), login-to-ready time including history
+replay and the server's peak RSS (worker processes included), and writes
+everything as JSON.
+
+    python -m benchmarks.load --users 200 --rate 500 --duration 10 --json run.json
+    python -m benchmarks.load --mode asyncio -- --write-behind   # extra server args
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.bot import ChatBot
+
+SERVER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py"
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start listening on {port}")
+
+
+def rss_bytes(pid):
+    """Resident set size of a process (Linux /proc), None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def tree_rss_bytes(pid):
+    """RSS of a process plus its direct children (cluster workers), None if unknown."""
+    total = rss_bytes(pid)
+    if total is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        total += rss_bytes(child) or 0
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            rss = tree_rss_bytes(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            self.stopped.wait(self.interval)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def to_ms(ns):
+    return ns / 1e6 if ns is not None else None
+
+
+def start_server(port, mode, extra_args, workdir):
+    cmd = [sys.executable, SERVER_SCRIPT, "--host", "127.0.0.1", "--port", str(port)]
+    cmd += ["--mode", mode] + extra_args
+    process = subprocess.Popen(
+        cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_for_port(port)
+    return process
+
+
+def seed_history(port, count, size):
+    if count <= 0:
+        return
+    seeder = ChatBot("history-seeder", port=port)
+    seeder.login()
+    for _ in range(count):
+        seeder.send_broadcast("x" * size)
+    # Private echo to ourselves marks the point where all of the above was handled
+    seeder.conn.send({"type": "MSG", "to": seeder.username, "content": "seeded"})
+    while True:
+        msg = seeder.conn.receive()
+        if msg is None or msg.get("content") == "seeded":
+            break
+    seeder.close()
+
+
+def run_traffic(bots, rate, duration, private_ratio, size, rng):
+    """Sends at a fixed total rate from random bots; returns (broadcasts, privates)."""
+    broadcasts = privates = 0
+    interval = 1.0 / rate
+    padding = "x" * size
+    start = time.perf_counter()
+    next_send = start
+    while True:
+        now = time.perf_counter()
+        if now - start >= duration:
+            break
+        if now < next_send:
+            time.sleep(next_send - now)
+        next_send += interval
+
+        sender = rng.choice(bots)
+        if len(bots) > 1 and rng.random() < private_ratio:
+            recipient = rng.choice(bots)
+            while recipient is sender:
+                recipient = rng.choice(bots)
+            sender.send_private(recipient.username, padding)
+            privates += 1
+        else:
+            sender.send_broadcast(padding)
+            broadcasts += 1
+    return broadcasts, privates
+
+
+def add_load_arguments(parser):
+    """Traffic options shared with the other server-level benchmarks."""
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument(
+        "--rate", type=float, default=200, help="messages/s sent in total"
+    )
+    parser.add_argument("--duration", type=float, default=10, help="seconds of traffic")
+    parser.add_argument("--private-ratio", type=float, default=0.2)
+    parser.add_argument("--size", type=int, default=100, help="content padding bytes")
+    parser.add_argument("--history", type=int, default=0, help="broadcasts to seed")
+    parser.add_argument("--login-concurrency", type=int, default=16)
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--port", type=int, help="default: a free port")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to drain")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+
+
+def run_load(args):
+    """Runs one load test as configured by add_load_arguments; returns the results."""
+    rng = random.Random(args.seed)
+    port = args.port or free_port()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(port, args.mode, args.server_args, workdir)
+        sampler = RssSampler(server.pid)
+        sampler.start()
+        try:
+            seed_history(port, args.history, args.size)
+            rss_before = tree_rss_bytes(server.pid)
+
+            bots = [ChatBot(f"bot{i}", port=port) for i in range(args.users)]
+            with ThreadPoolExecutor(args.login_concurrency) as pool:
+                login_times = sorted(pool.map(lambda bot: bot.login(), bots))
+            for bot in bots:
+                bot.start()
+            rss_logged_in = tree_rss_bytes(server.pid)
+
+            start = time.perf_counter()
+            broadcasts, privates = run_traffic(
+                bots, args.rate, args.duration, args.private_ratio, args.size, rng
+            )
+            send_seconds = time.perf_counter() - start
+            time.sleep(args.settle)
+
+            expected = broadcasts * len(bots) + privates * 2
+            latencies = []
+            for bot in bots:
+                with bot.lock:
+                    latencies.extend(bot.latencies_ns)
+            latencies.sort()
+            delivered = len(latencies)
+
+            for bot in bots:
+                bot.close()
+        finally:
+            sampler.stopped.set()
+            server.terminate()
+            server.wait(timeout=30)
+
+    results = {
+        "config": {
+            "users": args.users,
+            "rate": args.rate,
+            "duration": args.duration,
+            "private_ratio": args.private_ratio,
+            "size": args.size,
+            "history": args.history,
+            "mode": args.mode,
+            "server_args": args.server_args,
+        },
+        "sent": {"broadcasts": broadcasts, "private": privates},
+        "send_rate": (broadcasts + privates) / send_seconds,
+        "deliveries": {"expected": expected, "received": delivered},
+        "delivery_rate": delivered / send_seconds,
+        "latency_ms": {
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+            "mean": to_ms(statistics.fmean(latencies)) if latencies else None,
+        },
+        "login_ready_ms": {
+            "p50": percentile(login_times, 0.50) * 1000,
+            "p99": percentile(login_times, 0.99) * 1000,
+            "max": login_times[-1] * 1000,
+            "history_messages": bots[0].history_messages if bots else 0,
+        },
+        "server_rss_bytes": {
+            "before_login": rss_before,
+            "after_login": rss_logged_in,
+            "peak": sampler.peak,
+        },
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_load_arguments(parser)
+    parser.add_argument("server_args", nargs="*", help="extra server.py arguments")
+    args = parser.parse_args()
+
+    results = run_load(args)
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Stress test for DatabaseManager's connection pool.
+
+Runs hundreds of simulated logins concurrently against a scratch database:
+each one checks the IP binding, registers the user, reads public and
+private history and stores a few broadcasts and private messages. Any error
+logged by DatabaseManager, or a final row count that does not match what was
+stored, fails the run (exit status 1).
+
+    python -m benchmarks.stress_db [--users 300] [--messages 10] [--write-behind]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from database import DatabaseManager
+from history_cache import HistoryCache
+
+
+class ErrorCollector(logging.Handler):
+    """Keeps every ERROR record logged by the database layer."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def simulate_user(db, index, messages, users, barrier, failures):
+    username = f"user{index}"
+    partner = f"user{(index + 1) % users}"
+    try:
+        barrier.wait()
+        stored_ip = db.get_user_ip(username)
+        if stored_ip not in (None, "127.0.0.1"):
+            failures.append(f"{username}: unexpected ip {stored_ip}")
+        db.add_user(username, "127.0.0.1")
+        db.get_public_history()
+        for i in range(messages):
+            if db.store_message(username, "all", "BROADCAST", f"hello {i}") is None:
+                failures.append(f"{username}: broadcast {i} not stored")
+            if db.store_message(username, partner, "PRIVATE", f"psst {i}") is None:
+                failures.append(f"{username}: private {i} not stored")
+            db.get_private_history(username, partner)
+        if db.get_user_ip(username) != "127.0.0.1":
+            failures.append(f"{username}: ip not bound after add_user")
+    except Exception as e:
+        failures.append(f"{username}: {e!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=10, help="per user and kind")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    failures = []
+    errors = ErrorCollector()
+    logging.getLogger("chat.database").addHandler(errors)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(
+            os.path.join(tmp, "stress.db"),
+            write_behind=args.write_behind,
+            cache=None if args.no_cache else HistoryCache(),
+            readers=args.readers,
+        )
+        barrier = threading.Barrier(args.users)
+        threads = [
+            threading.Thread(
+                target=simulate_user,
+                args=(db, i, args.messages, args.users, barrier, failures),
+            )
+            for i in range(args.users)
+        ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.flush()
+        elapsed = time.perf_counter() - start
+
+        with db.pool.read() as conn:
+            stored = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            user_rows = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        db.close()
+
+    expected = args.users * args.messages * 2
+    if stored != expected:
+        failures.append(f"stored {stored} messages, expected {expected}")
+    if user_rows != args.users:
+        failures.append(f"{user_rows} users registered, expected {args.users}")
+    failures.extend(errors.messages)
+
+    operations = args.users * (4 + args.messages * 3)
+    print(
+        f"{args.users} concurrent logins, {expected} messages, "
+        f"{operations} DB operations in {elapsed:.2f}s ({operations / elapsed:.0f} ops/s)"
+    )
+    if failures:
+        print(f"FAILED: {len(failures)} problems")
+        for failure in failures[:20]:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
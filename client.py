@@ -1,35 +1,129 @@
+import argparse
+import itertools
+import os
+import queue
 import socket
 import threading
+import time
+from collections import deque
 import customtkinter as ctk
 import tkinter as tk
+from tkinter import filedialog
 from datetime import datetime
-from protocol import PORT, send_message, receive_message
+from conversation_cache import ConversationCache
+from sidebar import PresenceRoster, SidebarModel, sidebar_entries
+from protocol import (
+    CHANNEL_JOIN,
+    CHANNEL_JOINED,
+    CHANNEL_LEAVE,
+    CHANNEL_LEFT,
+    CHANNEL_LIST,
+    CHANNEL_PREFIX,
+    PORT,
+    FEATURE_HEARTBEAT,
+    FEATURE_HISTORY_BATCH,
+    FEATURE_PRESENCE,
+    FEATURE_ZLIB,
+    FILE_OFFER,
+    FILE_READY,
+    HISTORY_REQUEST,
+    MAX_CONTENT_LENGTH,
+    PING,
+    PONG,
+    PRESENCE,
+    RESUMED,
+    SEARCH,
+    SEARCH_RESULTS,
+    USER_LIST_REQUEST,
+    FramedConnection,
+    is_channel,
+    parse_file_link,
+    unpack_history,
+)
+from transfer import TransferError, download_file, upload_file
 
 # Set theme
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
 
+# Incoming messages are applied to the UI in batches, once per tick
+UI_TICK_MS = 50
+# Upper bound per tick so a huge backlog cannot freeze the window
+MAX_MESSAGES_PER_TICK = 2000
+
+# Lines kept per chat; the oldest are trimmed and fetched again on demand
+DEFAULT_SCROLLBACK = 2000
+# Older messages requested per page when scrolling to the top
+HISTORY_PAGE = 50
+# Search hits requested per page
+SEARCH_PAGE = 20
+
+# Seconds before the first reconnect attempt, doubled up to the maximum
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+CONNECT_TIMEOUT = 5.0
+# Tries per file transfer; each one continues where the last broke off
+TRANSFER_ATTEMPTS = 5
+# Internal: put on the incoming queue by the receive thread after it logged
+# in again, {"type": RECONNECTED, "conn": FramedConnection, "resume": id}
+RECONNECTED = "RECONNECTED"
+
 
 class ChatFrame(ctk.CTkFrame):
     """
     A reusable frame representing a single chat conversation (Group or Private).
     """
 
-    def __init__(self, master, partner_id, sock, **kwargs):
+    def __init__(
+        self,
+        master,
+        partner_id,
+        conn,
+        scrollback=DEFAULT_SCROLLBACK,
+        share_file=None,
+        save_file=None,
+        **kwargs,
+    ):
         super().__init__(master, fg_color="transparent", **kwargs)
-        self.partner_id = partner_id  # 'all' or username
-        self.sock = sock
+        self.partner_id = partner_id  # 'all', a channel or username
+        self.conn = conn
+        # Callbacks into the client: share_file(chat), save_file(id, key, name)
+        self.share_file = share_file
+        self.save_file = save_file
+        self.files = {}  # Label -> (file id, key, name) of files shared here
+
+        # Scrollback window: (message id or None, line count) per shown message
+        self.scrollback = scrollback
+        self.entries = deque()
+        self.shown_ids = set()
+        self.line_count = 0
+        self.has_older = True  # The server may have messages before the first shown
+        self.newest_trimmed = False  # Newest messages dropped while browsing up
+        self.request_pending = None  # "older" or "latest" while a page is on its way
+        self.request_before = None  # before_id of that request
+        # Every message of this chat seen so far, pages are served from here first
+        self.cache = ConversationCache()
 
         # Layout
         self.grid_rowconfigure(1, weight=1)  # Chat area expands
         self.grid_columnconfigure(0, weight=1)
 
         # Header
-        title = "Group Chat" if partner_id == "all" else f"Private Chat: {partner_id}"
+        if partner_id == "all":
+            title = "Group Chat"
+        elif is_channel(partner_id):
+            title = f"Channel: {partner_id}"
+        else:
+            title = f"Private Chat: {partner_id}"
         self.lbl_header = ctk.CTkLabel(
             self, text=title, font=("Roboto", 18, "bold"), anchor="w"
         )
         self.lbl_header.grid(row=0, column=0, sticky="ew", padx=20, pady=10)
+        if is_channel(partner_id):
+            self.btn_leave = ctk.CTkButton(
+                self, text="Leave", width=80, command=self.leave_channel
+            )
+            self.btn_leave.grid(row=0, column=0, sticky="e", padx=20, pady=10)
 
         # Text Area
         self.msg_box = ctk.CTkTextbox(self, state="disabled")
@@ -50,39 +144,325 @@ class ChatFrame(ctk.CTkFrame):
         )
         self.btn_send.pack(side="right")
 
+        self.btn_file = ctk.CTkButton(
+            self.input_frame,
+            text="Send file",
+            width=100,
+            command=lambda: self.share_file(self.partner_id),
+        )
+        self.btn_file.pack(side="right", padx=(0, 10))
+
+        self.menu_files = ctk.CTkOptionMenu(
+            self.input_frame,
+            values=[],
+            width=120,
+            state="disabled",
+            command=self.choose_file,
+        )
+        self.menu_files.set("Save file")
+        self.menu_files.pack(side="right", padx=(0, 10))
+
     def add_message(self, sender, content):
+        self.add_messages([(None, sender, content)])
+
+    def leave_channel(self):
+        self.conn.send({"type": CHANNEL_LEAVE, "channel": self.partner_id})
+
+    def format_messages(self, messages):
+        """(text, entries) for (id, sender, content) tuples not shown yet."""
+        lines = []
+        entries = []
+        for message_id, sender, content in messages:
+            if message_id is not None:
+                if message_id in self.shown_ids:
+                    continue
+                self.shown_ids.add(message_id)
+            link = parse_file_link(content)
+            if link is not None:
+                content = self.add_file(*link)
+            line = f"[{sender}]: {content}\n"
+            lines.append(line)
+            entries.append((message_id, line.count("\n")))
+        return "".join(lines), entries
+
+    def add_file(self, file_id, key, text):
+        """
+        Offers a shared file in the save menu. Returns the text to show in
+        place of its announcement.
+        """
+        label = text.removeprefix("[FILE] ")
+        if label not in self.files:
+            self.files[label] = (file_id, key, label.rsplit(" (", 1)[0])
+            self.menu_files.configure(values=list(self.files), state="normal")
+        return text
+
+    def choose_file(self, label):
+        self.menu_files.set("Save file")
+        self.save_file(*self.files[label])
+
+    def add_messages(self, messages):
+        """Adds a batch of new (id, sender, content) messages to the chat."""
+        self.cache.add_newest(messages)
+        # While the newest messages are trimmed, new ones arrive with the reload
+        if not self.newest_trimmed:
+            self.append_messages(messages)
+
+    def append_messages(self, messages):
+        """Shows messages at the bottom with a single insert."""
+        text, entries = self.format_messages(messages)
+        if not entries:
+            return
+        follow = self.msg_box.yview()[1] >= 1.0  # Only scroll along at the bottom
+        self.msg_box.configure(state="normal")
+        self.msg_box.insert("end", text)
+        self.entries.extend(entries)
+        self.line_count += sum(lines for _, lines in entries)
+        self.trim_oldest()
+        self.msg_box.configure(state="disabled")
+        if follow:
+            self.msg_box.see("end")
+
+    def prepend_messages(self, messages):
+        """Inserts a page of older (id, sender, content) messages at the top."""
+        text, entries = self.format_messages(messages)
+        if not entries:
+            return
+        added = sum(lines for _, lines in entries)
+        self.msg_box.configure(state="normal")
+        self.msg_box.insert("1.0", text)
+        self.entries.extendleft(reversed(entries))
+        self.line_count += added
+        self.trim_newest()
+        self.msg_box.configure(state="disabled")
+        # Keep the previously first line in view instead of jumping to the top
+        self.msg_box.yview(f"{added + 1}.0")
+
+    def trim_oldest(self):
+        """Drops the oldest messages beyond the scrollback cap. Box is editable."""
+        removed = 0
+        while self.line_count > self.scrollback and len(self.entries) > 1:
+            message_id, lines = self.entries.popleft()
+            self.shown_ids.discard(message_id)
+            self.line_count -= lines
+            removed += lines
+        if removed:
+            self.msg_box.delete("1.0", f"{removed + 1}.0")
+            self.has_older = True
+
+    def trim_newest(self):
+        """Drops the newest messages beyond the scrollback cap. Box is editable."""
+        trimmed = False
+        while self.line_count > self.scrollback and len(self.entries) > 1:
+            message_id, lines = self.entries.pop()
+            self.shown_ids.discard(message_id)
+            self.line_count -= lines
+            trimmed = True
+        if trimmed:
+            self.msg_box.delete(f"{self.line_count + 1}.0", "end")
+            self.newest_trimmed = True
+
+    def reset(self):
+        """Forgets everything shown and cached, the chat is loaded again."""
+        self.clear()
+        self.cache = ConversationCache()
+        self.has_older = True
+        self.request_pending = None
+
+    def clear(self):
         self.msg_box.configure(state="normal")
-        self.msg_box.insert("end", f"[{sender}]: {content}\n")
+        self.msg_box.delete("1.0", "end")
         self.msg_box.configure(state="disabled")
-        self.msg_box.see("end")
+        self.entries.clear()
+        self.shown_ids.clear()
+        self.line_count = 0
+        self.newest_trimmed = False
+
+    def check_scroll(self):
+        """
+        Called every UI tick for the visible chat: fetches an older page when
+        scrolled to the top, and the latest page when scrolled back down
+        after the newest messages were trimmed.
+        """
+        if self.request_pending:
+            return
+        top, bottom = self.msg_box.yview()
+        if self.newest_trimmed and bottom >= 1.0:
+            self.request_page("latest", None)
+        elif self.has_older and top <= 0.0:
+            oldest = next((mid for mid, _ in self.entries if mid is not None), None)
+            self.request_page("older", oldest)
+
+    def request_page(self, kind, before_id):
+        """Shows the page from the cache, or asks the server for it."""
+        self.request_pending = kind
+        self.request_before = before_id
+        cached = self.cache.page(before_id, HISTORY_PAGE)
+        if cached is not None:
+            self.show_page(*cached)
+            return
+        self.conn.send(
+            {
+                "type": HISTORY_REQUEST,
+                "to": self.partner_id,
+                "before_id": before_id,
+                "limit": HISTORY_PAGE,
+            }
+        )
+
+    def apply_page(self, messages, truncated=False):
+        """
+        Applies the server's answer to request_page: (id, sender, content)
+        messages. A truncated page was cut to fit a frame, so more are left.
+        """
+        exhausted = not truncated and len(messages) < HISTORY_PAGE
+        self.cache.add_page(messages, self.request_before, exhausted)
+        self.show_page(messages, exhausted)
+
+    def show_page(self, messages, exhausted):
+        kind = self.request_pending
+        self.request_pending = None
+        if kind == "latest":
+            self.clear()
+            self.append_messages(messages)
+            self.msg_box.see("end")
+            return
+        if exhausted:
+            self.has_older = False  # Reached the start of the conversation
+        self.prepend_messages(messages)
 
     def send_message(self):
         text = self.entry_msg.get()
         if not text:
             return
+        if len(text) > MAX_CONTENT_LENGTH:
+            tk.messagebox.showerror(
+                "Error", f"Messages are limited to {MAX_CONTENT_LENGTH} characters"
+            )
+            return
 
-        send_message(self.sock, {"type": "MSG", "to": self.partner_id, "content": text})
+        self.conn.send({"type": "MSG", "to": self.partner_id, "content": text})
         self.entry_msg.delete(0, "end")
 
 
+class SearchWindow(ctk.CTkToplevel):
+    """Results of a message search, a page at a time."""
+
+    def __init__(self, master, conn, username):
+        super().__init__(master)
+        self.conn = conn
+        self.username = username
+        self.query = None
+        self.next_offset = 0
+
+        self.title("Search messages")
+        self.geometry("600x500")
+        self.grid_rowconfigure(1, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+
+        self.lbl_header = ctk.CTkLabel(
+            self, text="", font=("Roboto", 16, "bold"), anchor="w"
+        )
+        self.lbl_header.grid(row=0, column=0, sticky="ew", padx=20, pady=10)
+
+        self.results_box = ctk.CTkTextbox(self, state="disabled")
+        self.results_box.grid(row=1, column=0, sticky="nsew", padx=20)
+
+        self.btn_more = ctk.CTkButton(
+            self, text="More results", command=self.request_more, state="disabled"
+        )
+        self.btn_more.grid(row=2, column=0, pady=20)
+
+    def search(self, query):
+        self.query = query
+        self.next_offset = 0
+        self.lbl_header.configure(text=f"Results for: {query}")
+        self.results_box.configure(state="normal")
+        self.results_box.delete("1.0", "end")
+        self.results_box.configure(state="disabled")
+        self.request_more()
+
+    def request_more(self):
+        self.btn_more.configure(state="disabled")
+        self.conn.send(
+            {
+                "type": SEARCH,
+                "query": self.query,
+                "offset": self.next_offset,
+                "limit": SEARCH_PAGE,
+            }
+        )
+
+    def show_results(self, msg):
+        """Appends a SEARCH_RESULTS page, unless it answers an older query."""
+        if msg.get("query") != self.query or msg.get("offset") != self.next_offset:
+            return
+        results = msg.get("results", [])
+        lines = []
+        for result in results:
+            if result.get("private"):
+                partner = result.get("to")
+                if partner == self.username:
+                    partner = result.get("from")
+                chat = f"Private: {partner}"
+            elif is_channel(result.get("to")):
+                chat = f"Channel: {result['to']}"
+            else:
+                chat = "Group Chat"
+            content = result.get("content")
+            link = parse_file_link(content)
+            if link is not None:
+                content = link[2]
+            lines.append(
+                f"{result.get('timestamp')}  {chat}\n"
+                f"    [{result.get('from')}]: {content}\n"
+            )
+        if not lines and self.next_offset == 0:
+            lines.append("No messages found.\n")
+        self.results_box.configure(state="normal")
+        self.results_box.insert("end", "".join(lines))
+        self.results_box.configure(state="disabled")
+        self.next_offset += len(results)
+        if msg.get("more"):
+            self.btn_more.configure(state="normal")
+
+
 class ChatClient(ctk.CTk):
-    def __init__(self):
+    def __init__(self, scrollback=DEFAULT_SCROLLBACK):
         super().__init__()
+        self.scrollback = scrollback
 
         self.title("Modern LAN Chat")
         self.geometry("900x600")
 
         # Network State
-        self.client_socket = None
+        self.server_ip = None
+        self.conn = None  # FramedConnection to the server
         self.username = ""
         self.connected = False
         self.running = True
+        # Newest message id received: the resume token sent when reconnecting
+        self.last_message_id = None
+        # While a resumed login replays, everything received is held here
+        # and applied in id order once RESUMED arrives
+        self.resume_buffer = None
 
         # UI State
         self.frames = {}  # partner_id -> ChatFrame
         self.current_partner = None
-        self.online_users = []  # List of strings
+        self.roster = PresenceRoster()  # Who is online
+        self.channels = []  # Joined channels, in sidebar order
         self.unread_counts = {}  # username -> int count
+        self.sidebar_model = SidebarModel()
+        self.sidebar_buttons = {}  # 'all' or username -> CTkButton
+        self.search_window = None  # SearchWindow, once the user searched
+        # FILE_OFFER ref -> local path, until the server says FILE_READY
+        self.uploads = {}
+        self.upload_refs = itertools.count(1)
+
+        # Filled by the receive thread, drained by the UI tick
+        self.incoming = queue.SimpleQueue()
+        self.pending_lines = {}  # partner_id -> [(sender, content)] for this tick
+        self.sidebar_dirty = False
 
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
@@ -120,12 +500,9 @@ class ChatClient(ctk.CTk):
             return
 
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((ip, PORT))
-
-            send_message(self.client_socket, {"type": "LOGIN", "content": user})
-
             self.username = user
+            self.server_ip = ip
+            self.conn = self.login()
             self.connected = True
 
             self.login_frame.destroy()
@@ -134,10 +511,65 @@ class ChatClient(ctk.CTk):
             listen_thread = threading.Thread(target=self.receive_loop)
             listen_thread.daemon = True
             listen_thread.start()
+            self.after(UI_TICK_MS, self.drain_incoming)
 
         except Exception as e:
             tk.messagebox.showerror("Connection Failed", f"Could not connect: {e}")
 
+    def login(self, resume=None):
+        """Connects and sends LOGIN, with a resume token when reconnecting."""
+        sock = socket.create_connection((self.server_ip, PORT), CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        conn = FramedConnection(sock)
+        login = {
+            "type": "LOGIN",
+            "content": self.username,
+            "features": [
+                FEATURE_HISTORY_BATCH,
+                FEATURE_ZLIB,
+                FEATURE_PRESENCE,
+                FEATURE_HEARTBEAT,
+            ],
+        }
+        if resume is not None:
+            login["resume"] = resume
+        conn.send(login)
+        return conn
+
+    def reconnect(self):
+        """
+        Receive thread: logs in again after the connection dropped, resuming
+        from the newest message received, with growing delays between
+        attempts. Returns the new connection, or None if the server turned
+        us away.
+        """
+        self.incoming.put(
+            {"type": "INFO", "content": "Connection lost, reconnecting..."}
+        )
+        delay = RECONNECT_DELAY
+        while self.running:
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            resume = self.last_message_id
+            try:
+                conn = self.login(resume)
+            except OSError:
+                continue
+            reply = conn.receive()
+            if reply is None or reply.get("content") == "Username taken":
+                # Down, or our old connection has not been reaped yet
+                conn.close()
+                continue
+            if reply.get("type") == "ERROR":
+                conn.close()
+                self.incoming.put(reply)
+                return None
+            self.conn = conn
+            self.incoming.put({"type": RECONNECTED, "conn": conn, "resume": resume})
+            self.incoming.put(reply)
+            return conn
+        return None
+
     def create_main_ui(self):
         # --- Sidebar ---
         self.sidebar = ctk.CTkFrame(self, width=200, corner_radius=0)
@@ -147,6 +579,18 @@ class ChatClient(ctk.CTk):
             self.sidebar, text=f"User: {self.username}", font=("Roboto", 16, "bold")
         ).pack(pady=20)
 
+        self.entry_search = ctk.CTkEntry(
+            self.sidebar, placeholder_text="Search messages..."
+        )
+        self.entry_search.pack(fill="x", padx=10, pady=(0, 10))
+        self.entry_search.bind("<Return>", lambda e: self.start_search())
+
+        self.entry_channel = ctk.CTkEntry(
+            self.sidebar, placeholder_text="Join #channel..."
+        )
+        self.entry_channel.pack(fill="x", padx=10, pady=(0, 10))
+        self.entry_channel.bind("<Return>", lambda e: self.join_channel())
+
         self.user_list_frame = ctk.CTkScrollableFrame(
             self.sidebar, fg_color="transparent"
         )
@@ -161,9 +605,86 @@ class ChatClient(ctk.CTk):
         self.get_or_create_frame("all")
         self.select_chat("all")
 
+    def start_search(self):
+        query = self.entry_search.get().strip()
+        if not query:
+            return
+        if self.search_window is None or not self.search_window.winfo_exists():
+            self.search_window = SearchWindow(self, self.conn, self.username)
+        self.search_window.search(query)
+        self.search_window.focus()
+
+    def join_channel(self):
+        name = self.entry_channel.get().strip()
+        if not name:
+            return
+        if not name.startswith(CHANNEL_PREFIX):
+            name = CHANNEL_PREFIX + name
+        self.entry_channel.delete(0, "end")
+        self.conn.send({"type": CHANNEL_JOIN, "channel": name})
+
+    def share_file(self, partner_id):
+        """Asks for a file and offers it in a chat; FILE_READY starts the upload."""
+        path = filedialog.askopenfilename(parent=self, title="Send file")
+        if not path:
+            return
+        ref = next(self.upload_refs)
+        self.uploads[ref] = path
+        self.conn.send(
+            {
+                "type": FILE_OFFER,
+                "to": partner_id,
+                "name": os.path.basename(path),
+                "size": os.path.getsize(path),
+                "ref": ref,
+            }
+        )
+
+    def save_file(self, file_id, key, name):
+        path = filedialog.asksaveasfilename(
+            parent=self, title="Save file", initialfile=name
+        )
+        if not path:
+            return
+        self.start_transfer(
+            f"Download of {name}",
+            lambda: download_file(self.server_ip, PORT, file_id, key, path),
+        )
+
+    def start_transfer(self, description, work):
+        """Runs a transfer on its own thread, reporting in the group chat."""
+
+        def run():
+            delay = RECONNECT_DELAY
+            for attempt in range(1, TRANSFER_ATTEMPTS + 1):
+                try:
+                    work()
+                    self.incoming.put(
+                        {"type": "INFO", "content": f"{description} complete."}
+                    )
+                    return
+                except (OSError, TransferError) as e:
+                    error = e
+                if attempt < TRANSFER_ATTEMPTS:
+                    time.sleep(delay)
+                    delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            self.incoming.put(
+                {"type": "INFO", "content": f"{description} failed: {error}"}
+            )
+
+        self.queue_lines("all", [(None, "SYSTEM", f"{description} started.")])
+        threading.Thread(target=run, daemon=True).start()
+
     def get_or_create_frame(self, partner_id):
         if partner_id not in self.frames:
-            frame = ChatFrame(self.main_area, partner_id, self.client_socket)
+            frame = ChatFrame(
+                self.main_area,
+                partner_id,
+                self.conn,
+                scrollback=self.scrollback,
+                share_file=self.share_file,
+                save_file=self.save_file,
+            )
             self.frames[partner_id] = frame
         return self.frames[partner_id]
 
@@ -184,56 +705,99 @@ class ChatClient(ctk.CTk):
         self.render_sidebar()
 
     def render_sidebar(self):
-        """Re-draws all sidebar buttons with current notifications."""
-        for w in self.user_list_frame.winfo_children():
-            w.destroy()
-
-        # Group Chat
-        btn_grp = ctk.CTkButton(
-            self.user_list_frame,
-            text="Group Chat",
-            border_width=1,
-            fg_color=(
-                ["#3B8ED0", "#1F6AA5"]
-                if self.current_partner == "all"
-                else "transparent"
-            ),
-            command=lambda: self.select_chat("all"),
+        """Brings the sidebar buttons up to date, touching only what changed."""
+        diff = self.sidebar_model.update(
+            sidebar_entries(
+                self.roster.online_users(),
+                self.username,
+                self.current_partner,
+                self.unread_counts,
+                self.channels,
+            )
         )
-        btn_grp.pack(pady=2, fill="x")
-
-        # Users
-        for u in self.online_users:
-            if u != self.username:
-                # Construct Label: "User" or "User (N)"
-                count = self.unread_counts.get(u, 0)
-                display_text = f"{u} ({count})" if count > 0 else u
-
-                # Highlight if active
-                is_active = u == self.current_partner
-                color = ["#3B8ED0", "#1F6AA5"] if is_active else "transparent"
-
-                # Highlight if unread and not active
-                if count > 0 and not is_active:
-                    color = "#C0392B"  # Red-ish for notification attention
-
-                btn = ctk.CTkButton(
-                    self.user_list_frame,
-                    text=display_text,
-                    border_width=1,
-                    fg_color=color,
-                    command=lambda u=u: self.select_chat(u),
-                )
+
+        for key in diff.removed:
+            self.sidebar_buttons.pop(key).destroy()
+
+        for entry in diff.added:
+            btn = ctk.CTkButton(
+                self.user_list_frame,
+                text=entry.text,
+                border_width=1,
+                fg_color=entry.color,
+                command=lambda key=entry.key: self.select_chat(key),
+            )
+            self.sidebar_buttons[entry.key] = btn
+            if not diff.reorder:
                 btn.pack(pady=2, fill="x")
 
+        for entry in diff.changed:
+            self.sidebar_buttons[entry.key].configure(
+                text=entry.text, fg_color=entry.color
+            )
+
+        if diff.reorder:
+            for btn in self.sidebar_buttons.values():
+                btn.pack_forget()
+            for key in self.sidebar_model.order:
+                self.sidebar_buttons[key].pack(pady=2, fill="x")
+
     def receive_loop(self):
+        conn = self.conn
+        logged_in = False  # Only a session that got in is worth resuming
         while self.running:
-            msg = receive_message(self.client_socket)
-            if msg:
-                self.after(0, self.process_incoming_message, msg)
-            else:
-                self.after(0, self.on_disconnect)
+            msg = conn.receive()
+            if msg is None and logged_in:
+                conn = self.reconnect()
+                if conn is not None:
+                    continue
+            if msg is not None and msg.get("type") == PING:
+                # Answered here, a busy UI must not make us look dead
+                conn.send({"type": PONG})
+                continue
+            if msg is not None and msg.get("type") == "INFO":
+                logged_in = True  # The welcome
+            self.incoming.put(msg)  # None tells the UI the connection is gone
+            if msg is None:
+                break
+
+    def drain_incoming(self):
+        """
+        UI tick: applies everything received since the last tick, with one
+        insert (and one scroll) per chat and at most one sidebar redraw.
+        """
+        disconnected = False
+        backlog = False
+        for _ in range(MAX_MESSAGES_PER_TICK):
+            try:
+                msg = self.incoming.get_nowait()
+            except queue.Empty:
                 break
+            if msg is None:
+                disconnected = True
+                break
+            self.process_incoming_message(msg)
+        else:
+            backlog = True
+
+        for partner, lines in self.pending_lines.items():
+            self.get_or_create_frame(partner).add_messages(lines)
+        self.pending_lines = {}
+        if self.sidebar_dirty:
+            self.sidebar_dirty = False
+            self.render_sidebar()
+        if self.current_partner in self.frames:
+            self.frames[self.current_partner].check_scroll()
+
+        if disconnected:
+            self.on_disconnect()
+            return
+        # Come back right away while a backlog is being worked off
+        self.after(1 if backlog else UI_TICK_MS, self.drain_incoming)
+
+    def queue_lines(self, partner, lines):
+        """Adds lines to a chat at the end of the current tick."""
+        self.pending_lines.setdefault(partner, []).extend(lines)
 
     def process_incoming_message(self, msg):
         m_type = msg.get("type")
@@ -241,35 +805,137 @@ class ChatClient(ctk.CTk):
         sender = msg.get("from")
         to = msg.get("to")
 
+        if self.resume_buffer is not None:
+            # Live messages may overtake the missed ones, hold both
+            if m_type == "MSG":
+                self.resume_buffer.append(msg)
+                return
+            if m_type == "HISTORY" and "before_id" not in msg:
+                self.resume_buffer.extend(unpack_history(msg))
+                return
+
         if m_type == "USER_LIST":
-            self.online_users = content
-            self.render_sidebar()
+            self.roster.load(content, msg.get("version"))
+            self.sidebar_dirty = True
 
-        elif m_type == "MSG":
-            is_private = msg.get("private", False)
+        elif m_type == PRESENCE:
+            if not self.roster.apply(
+                msg.get("event"), msg.get("user"), msg.get("version")
+            ):
+                # Missed a change, start over from a full list
+                self.conn.send({"type": USER_LIST_REQUEST})
+            self.sidebar_dirty = True
 
-            if is_private:
+        elif m_type == "MSG":
+            if is_channel(to):
+                partner = to
+            elif msg.get("private", False):
                 partner = sender if sender != self.username else to
-                frame = self.get_or_create_frame(partner)
-                frame.add_message(sender, content)
-
-                # Increment Unread if not looking at this chat
-                if self.current_partner != partner:
-                    self.unread_counts[partner] = self.unread_counts.get(partner, 0) + 1
-                    self.render_sidebar()
             else:
-                # Group Chat
-                frame = self.get_or_create_frame("all")
-                frame.add_message(sender, content)
-                # Could also add unread for Group, but requirement specified Private.
+                partner = "all"
+            self.queue_lines(partner, [(msg.get("id"), sender, content)])
+            self.note_message_id(msg.get("id"))
+
+            # Increment Unread if not looking at this chat
+            # (private chats and channels; the group chat has no badge)
+            if partner != "all" and self.current_partner != partner:
+                self.unread_counts[partner] = self.unread_counts.get(partner, 0) + 1
+                self.sidebar_dirty = True
+
+        elif m_type == CHANNEL_LIST:
+            self.channels = list(content)
+            self.sidebar_dirty = True
+
+        elif m_type == CHANNEL_JOINED:
+            channel = msg.get("channel")
+            if channel not in self.channels:
+                self.channels.append(channel)
+            self.select_chat(channel)
+
+        elif m_type == CHANNEL_LEFT:
+            channel = msg.get("channel")
+            if channel in self.channels:
+                self.channels.remove(channel)
+            self.unread_counts.pop(channel, None)
+            frame = self.frames.pop(channel, None)
+            if self.current_partner == channel:
+                self.select_chat("all")
+            if frame is not None:
+                frame.destroy()
+            self.sidebar_dirty = True
+
+        elif m_type == "HISTORY":
+            # A whole backlog page in one frame, render it in one go
+            # "to" is the chat the page belongs to: 'all' or the partner's name
+            messages = [
+                (m.get("id"), m.get("from"), m.get("content"))
+                for m in unpack_history(msg)
+            ]
+            if "before_id" in msg:
+                # Answer to a page request from ChatFrame.check_scroll
+                self.get_or_create_frame(to).apply_page(
+                    messages, msg.get("truncated", False)
+                )
+            else:
+                self.queue_lines(to, messages)
+                for message_id, _, _ in messages:
+                    self.note_message_id(message_id)
+
+        elif m_type == RECONNECTED:
+            for frame in self.frames.values():
+                frame.conn = msg["conn"]
+            if self.search_window is not None:
+                self.search_window.conn = msg["conn"]
+            if msg["resume"] is not None:
+                self.resume_buffer = []
+
+        elif m_type == RESUMED:
+            self.apply_resumed(msg.get("complete", False))
+
+        elif m_type == FILE_READY:
+            path = self.uploads.pop(msg.get("ref"), None)
+            if path is not None:
+                file_id, key = msg.get("file_id"), msg.get("key")
+                self.start_transfer(
+                    f"Upload of {os.path.basename(path)}",
+                    lambda: upload_file(self.server_ip, PORT, file_id, key, path),
+                )
+
+        elif m_type == SEARCH_RESULTS:
+            if self.search_window is not None and self.search_window.winfo_exists():
+                self.search_window.show_results(msg)
 
         elif m_type == "INFO":
-            frame = self.get_or_create_frame("all")
-            frame.add_message("SYSTEM", content)
+            self.queue_lines("all", [(None, "SYSTEM", content)])
 
         elif m_type == "ERROR":
             tk.messagebox.showerror("Error", content)
 
+    def note_message_id(self, message_id):
+        """Advances the resume token past a received message."""
+        if message_id is not None and (
+            self.last_message_id is None or message_id > self.last_message_id
+        ):
+            self.last_message_id = message_id
+
+    def apply_resumed(self, complete):
+        """
+        End of a resumed login's replay: applies the missed and the live
+        messages held since, in id order and each once. If the server could
+        not send everything missed, every chat starts over from its replay.
+        """
+        held = self.resume_buffer or []
+        self.resume_buffer = None
+        if complete:
+            seen = self.last_message_id or 0
+            held = [m for m in held if m.get("id") is not None and m["id"] > seen]
+        else:
+            for frame in self.frames.values():
+                frame.reset()
+        by_id = {m["id"]: m for m in held if m.get("id") is not None}
+        for message_id in sorted(by_id):
+            self.process_incoming_message(by_id[message_id])
+
     def on_disconnect(self, content=""):
         if len(content) > 0:
             tk.messagebox.showerror(
@@ -280,5 +946,14 @@ class ChatClient(ctk.CTk):
 
 
 if __name__ == "__main__":
-    app = ChatClient()
+    parser = argparse.ArgumentParser(description="LAN chat client")
+    parser.add_argument(
+        "--scrollback",
+        type=int,
+        default=DEFAULT_SCROLLBACK,
+        help="lines kept per chat, older ones are reloaded when scrolling up",
+    )
+    args = parser.parse_args()
+
+    app = ChatClient(scrollback=args.scrollback)
     app.mainloop()
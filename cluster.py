@@ -0,0 +1,488 @@
+"""
+Multi-process mode (server.py --workers N).
+
+N worker processes accept on the same port (SO_REUSEPORT), and a hub in the
+parent process ties them together over a Unix socket bus.
+
+The hub owns everything that must be global: presence (which worker holds
+which username), message ids and the SQLite writer. Workers own the client
+sockets. A chat message goes from its worker to the hub, where it is given
+an id, stored and encoded once. The hub then relays it to every worker,
+which forwards the frame bytes unchanged to its local recipients. Every
+worker sees every message in id order, so their history caches stay
+consistent with each other.
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+
+from database import DatabaseManager, utc_timestamp
+from heartbeat import IdleReaper
+from history_cache import HistoryCache
+from logs import setup_logging
+from protocol import (
+    PRESENCE_JOIN,
+    PRESENCE_LEAVE,
+    FramedConnection,
+    encode_message,
+    is_channel,
+    message_type,
+    resumed,
+)
+from server import ChatServer
+from session import ClientSession, OVERFLOW_BLOCK
+from transfer import FileStore
+
+logger = logging.getLogger("chat.cluster")
+
+BUS_SOCKET = "bus.sock"
+# Frames queued per worker link before the hub waits for that worker
+BUS_QUEUE_SIZE = 65536
+# How long a login waits for the hub to confirm its username (seconds)
+CLAIM_TIMEOUT = 10.0
+
+# Bus-only message types, clients never see these
+BUS_HELLO = "BUS_HELLO"  # worker -> hub: {"worker": index}
+BUS_CLAIM = "BUS_CLAIM"  # worker -> hub: {"user", "request"}
+BUS_CLAIMED = "BUS_CLAIMED"  # hub -> worker: {"user", "request", "ok"}
+BUS_RELEASE = "BUS_RELEASE"  # worker -> hub: {"user"}
+# worker -> hub: {"request"}, answered once every message stored so far is
+# committed, so a resume query sees what a write-behind hub still queued
+BUS_FLUSH = "BUS_FLUSH"
+BUS_FLUSHED = "BUS_FLUSHED"  # hub -> worker: {"request"}
+# hub -> workers: {"event", "user", "users", "version"}, versions numbered by the hub
+BUS_PRESENCE = "BUS_PRESENCE"
+# Chat messages travel as ordinary MSG frames: worker -> hub without id,
+# hub -> workers with "id" and "timestamp", and from there to clients as is.
+
+
+class RelayConnection(FramedConnection):
+    """
+    FramedConnection whose receive() returns (message, frame): the decoded
+    message and its original wire bytes, ready to be forwarded unchanged.
+    """
+
+    def _decode_frame(self, start, frame_length):
+        frame = bytes(self._view[start : start + frame_length])
+        return super()._decode_frame(start, frame_length), frame
+
+
+class ClusterHub:
+    """Presence registry, message sequencer and relay for the worker processes."""
+
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+
+        self.links = []  # ClientSession per connected worker
+        self.owners = {}  # username -> link of the worker holding it, login order
+        self.presence_version = 0  # Shared by all workers, so clients can switch
+        self.lock = threading.Lock()  # Keeps ids, presence and relay order in step
+        self.running = True
+
+    def start(self):
+        threading.Thread(
+            target=self.accept_loop, name="bus-accept", daemon=True
+        ).start()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(
+                target=self.handle_worker, args=(sock,), daemon=True
+            ).start()
+
+    def handle_worker(self, sock):
+        conn = FramedConnection(sock)
+        hello = conn.receive()
+        if not hello or hello.get("type") != BUS_HELLO:
+            conn.close()
+            return
+
+        name = f"worker-{hello.get('worker')}"
+        # Blocking policy: a lagging worker slows the hub down, it never loses messages
+        link = ClientSession(name, conn, BUS_QUEUE_SIZE, OVERFLOW_BLOCK)
+        with self.lock:
+            self.links.append(link)
+        logger.info("[BUS] %s connected", name)
+
+        try:
+            while self.running:
+                msg = conn.receive()
+                if msg is None:
+                    break
+                self.dispatch(link, msg)
+        finally:
+            logger.info("[BUS] %s disconnected", name)
+            with self.lock:
+                self.links.remove(link)
+                # Its users are gone too
+                for user in [u for u, owner in self.owners.items() if owner is link]:
+                    del self.owners[user]
+                    self.publish_presence(PRESENCE_LEAVE, user)
+            link.close()
+            conn.close()
+
+    def dispatch(self, link, msg):
+        msg_type = msg.get("type")
+
+        if msg_type == "MSG":
+            self.relay_message(msg)
+        elif msg_type == BUS_CLAIM:
+            self.claim(link, msg.get("user"), msg.get("request"))
+        elif msg_type == BUS_RELEASE:
+            self.release(link, msg.get("user"))
+        elif msg_type == BUS_FLUSH:
+            self.db.flush()
+            link.send({"type": BUS_FLUSHED, "request": msg.get("request")})
+
+    def claim(self, link, user, request):
+        with self.lock:
+            ok = user not in self.owners
+            if ok:
+                self.owners[user] = link
+            link.send({"type": BUS_CLAIMED, "user": user, "request": request, "ok": ok})
+            if ok:
+                self.publish_presence(PRESENCE_JOIN, user)
+
+    def release(self, link, user):
+        with self.lock:
+            if self.owners.get(user) is link:
+                del self.owners[user]
+                self.publish_presence(PRESENCE_LEAVE, user)
+
+    def publish_presence(self, event, user):
+        """Caller holds the lock."""
+        self.presence_version += 1
+        self.fan_out(
+            encode_message(
+                {
+                    "type": BUS_PRESENCE,
+                    "event": event,
+                    "user": user,
+                    "users": list(self.owners),
+                    "version": self.presence_version,
+                }
+            )
+        )
+
+    def relay_message(self, msg):
+        """Stamps a chat message with its id, stores it and relays it to every worker."""
+        msg_type = message_type(msg.get("to"))
+        with self.lock:
+            timestamp = utc_timestamp()
+            msg["id"] = self.db.store_message(
+                msg.get("from"), msg.get("to"), msg_type, msg.get("content"), timestamp
+            )
+            msg["timestamp"] = timestamp
+            self.fan_out(encode_message(msg))
+
+    def fan_out(self, frame):
+        """Caller holds the lock, so every worker gets frames in the same order."""
+        for link in self.links:
+            link.send_frame(frame)
+
+    def close(self):
+        self.running = False
+        self.listener.close()
+        with self.lock:
+            links = list(self.links)
+        for link in links:
+            link.close()
+
+
+class ClusterWorker(ChatServer):
+    """
+    ChatServer running as one of several processes. Usernames are claimed
+    through the hub, chat messages are published to the hub and delivered
+    when the hub relays them back.
+    """
+
+    def __init__(
+        self,
+        index,
+        bus_path,
+        host,
+        port,
+        queue_size,
+        overflow_policy,
+        db,
+        reaper=None,
+        files=None,
+    ):
+        super().__init__(
+            host,
+            port,
+            queue_size,
+            overflow_policy,
+            db=db,
+            reuse_port=True,
+            reaper=reaper,
+            files=files,
+        )
+        self.index = index
+        self.presence = {}  # Usernames online on any worker, as ordered keys
+        self.requests = itertools.count(1)
+        self.pending_claims = {}  # request id -> (ClientSession, Future)
+        self.pending_flushes = {}  # request id -> Future
+        self.pending_lock = threading.Lock()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(bus_path)
+        self.bus = RelayConnection(sock)
+        self.bus.send({"type": BUS_HELLO, "worker": index})
+        self.bus_reader = threading.Thread(
+            target=self.bus_loop, name="bus-reader", daemon=True
+        )
+        self.bus_reader.start()
+
+    def register_session(self, session):
+        """Claims the username cluster-wide. Returns False if it is taken."""
+        request = next(self.requests)
+        future = concurrent.futures.Future()
+        with self.pending_lock:
+            self.pending_claims[request] = (session, future)
+        self.bus.send({"type": BUS_CLAIM, "user": session.username, "request": request})
+        try:
+            return future.result(CLAIM_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            with self.pending_lock:
+                self.pending_claims.pop(request, None)
+            return False
+
+    def flush_hub(self):
+        """Waits until the hub has committed every message. False on timeout."""
+        request = next(self.requests)
+        future = concurrent.futures.Future()
+        with self.pending_lock:
+            self.pending_flushes[request] = future
+        self.bus.send({"type": BUS_FLUSH, "request": request})
+        try:
+            return future.result(CLAIM_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            with self.pending_lock:
+                self.pending_flushes.pop(request, None)
+            return False
+
+    def send_login_history(self, session, resume):
+        # Missed messages are read from SQLite, where the hub may not have
+        # written them yet
+        if resume is not None and not self.flush_hub():
+            logger.warning("[BUS] Hub did not flush, %s starts over", session.username)
+            self.send_history(session, self.db.get_public_history())
+            self.metrics.incr("resume_fallbacks")
+            session.send(resumed(resume, 0, False))
+            return
+        super().send_login_history(session, resume)
+
+    def user_list(self):
+        return list(self.presence)
+
+    def announce_login(self, username):
+        # Every worker publishes presence when the hub's join event reaches it
+        pass
+
+    def announce_logout(self, username):
+        self.bus.send({"type": BUS_RELEASE, "user": username})
+
+    def handle_chat_message(self, username, session, msg):
+        content = msg.get("content")
+        recipient = msg.get("to")  # 'all' or specific username
+
+        if recipient == "all":
+            logger.debug("[%s -> ALL]: %s", username, content)
+            self.metrics.incr("messages_broadcast")
+            self.bus.send(
+                {"type": "MSG", "from": username, "to": "all", "content": content}
+            )
+        elif is_channel(recipient):
+            if recipient not in session.channels:
+                session.send({"type": "ERROR", "content": f"Join {recipient} first."})
+                return
+            logger.debug("[%s -> %s]: %s", username, recipient, content)
+            self.metrics.incr("messages_channel")
+            self.bus.send(
+                {"type": "MSG", "from": username, "to": recipient, "content": content}
+            )
+        elif recipient in self.presence:
+            logger.debug("[%s -> %s]: %s", username, recipient, content)
+            self.metrics.incr("messages_private")
+            self.bus.send(
+                {
+                    "type": "MSG",
+                    "from": username,
+                    "to": recipient,
+                    "content": content,
+                    "private": True,
+                }
+            )
+        else:
+            session.send({"type": "ERROR", "content": f"User {recipient} not found."})
+
+    def bus_loop(self):
+        """Applies hub events in order. Runs on its own thread."""
+        while True:
+            received = self.bus.receive()
+            if received is None:
+                break
+            msg, frame = received
+            msg_type = msg.get("type")
+
+            if msg_type == "MSG":
+                self.deliver(msg, frame)
+            elif msg_type == BUS_PRESENCE:
+                self.update_presence(msg)
+            elif msg_type == BUS_CLAIMED:
+                self.claim_result(msg)
+            elif msg_type == BUS_FLUSHED:
+                with self.pending_lock:
+                    future = self.pending_flushes.pop(msg.get("request"), None)
+                if future is not None:
+                    future.set_result(True)
+
+        if self.running:
+            logger.error("[BUS] Lost the hub, stopping worker %d", self.index)
+            self.running = False
+            try:
+                # Wakes the accept loop in start()
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def deliver(self, msg, frame):
+        """Forwards a relayed chat message to the local recipients."""
+        recipient = msg.get("to")
+        if msg.get("id") is not None:
+            self.db.cache_message(
+                msg["id"],
+                msg.get("from"),
+                recipient,
+                message_type(recipient),
+                msg.get("content"),
+                msg.get("timestamp"),
+            )
+
+        if recipient == "all":
+            self.broadcast_frame(frame)
+            return
+        if is_channel(recipient):
+            self.send_channel_frame(recipient, frame)
+            return
+        # Recipient, and back to the sender so they see it in their UI
+        for user in (recipient, msg.get("from")):
+            session = self.clients.get(user)
+            if session:
+                session.send_frame(frame)
+
+    def update_presence(self, msg):
+        """Applies a hub presence event, keeping the hub's version number."""
+        event = msg.get("event")
+        user = msg.get("user")
+        with self.presence_lock:
+            self.presence = dict.fromkeys(msg.get("users", []))
+            self.presence_version = msg.get("version", 0)
+            # The joining user's own worker sends it the full list
+            new_session = self.clients.get(user) if event == PRESENCE_JOIN else None
+            self.send_presence(event, user, new_session)
+
+    def claim_result(self, msg):
+        with self.pending_lock:
+            pending = self.pending_claims.pop(msg.get("request"), None)
+        if pending is None:
+            # The login gave up waiting, hand the name back
+            if msg.get("ok"):
+                self.bus.send({"type": BUS_RELEASE, "user": msg.get("user")})
+            return
+
+        session, future = pending
+        if msg.get("ok"):
+            # Registered here, before any later hub event is applied, so the
+            # new user sees its own join and every message after it
+            with self.clients_lock:
+                self.clients[session.username] = session
+        future.set_result(msg.get("ok"))
+
+    def stats(self):
+        stats = super().stats()
+        stats["worker"] = self.index
+        stats["online"] = len(self.presence)
+        return stats
+
+
+def run_worker(index, bus_path, args):
+    """Entry point of a worker process. args is server.py's parsed command line."""
+    setup_logging(args.log_level, args.log_rate)
+    cache = HistoryCache(
+        args.cache_public, args.cache_private, args.cache_conversations
+    )
+    # Workers never write messages, the hub does
+    db = DatabaseManager(
+        cache=cache, readers=args.db_readers, archive_dir=args.archive_dir
+    )
+    server = ClusterWorker(
+        index,
+        bus_path,
+        args.host,
+        args.port,
+        args.queue_size,
+        args.overflow_policy,
+        db,
+        IdleReaper(args.ping_interval, args.idle_timeout, args.login_timeout),
+        FileStore(args.files_dir, args.file_rate, args.max_file_size),
+    )
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+
+
+def run_cluster(args, db):
+    """Runs the hub in this process and args.workers worker processes until interrupted."""
+    with tempfile.TemporaryDirectory(prefix="chat-bus-") as bus_dir:
+        hub = ClusterHub(db, os.path.join(bus_dir, BUS_SOCKET))
+        hub.start()
+
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(
+                target=run_worker,
+                args=(index, hub.path, args),
+                name=f"chat-worker-{index}",
+                daemon=True,
+            )
+            for index in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        logger.info(
+            "[CLUSTER] %d workers sharing %s:%s", args.workers, args.host, args.port
+        )
+
+        try:
+            for worker in workers:
+                worker.join()
+                if worker.exitcode:
+                    logger.error(
+                        "[CLUSTER] %s exited with %s", worker.name, worker.exitcode
+                    )
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            for worker in workers:
+                worker.join(5)
+            hub.close()
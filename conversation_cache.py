@@ -0,0 +1,78 @@
+"""
+Client-side copy of each chat's messages, so scrolling back over trimmed
+scrollback or switching between chats never asks the server twice for the
+same page. Kept free of Tk, like sidebar.py.
+"""
+
+from bisect import bisect_left
+from operator import itemgetter
+
+# Messages kept per conversation; the oldest are forgotten beyond this
+DEFAULT_CACHE_MESSAGES = 20000
+
+_message_id = itemgetter(0)
+
+
+class ConversationCache:
+    """
+    The messages of one chat as (id, sender, content), oldest first. They
+    always form one unbroken run of that chat's history: live messages are
+    added after the newest, and server pages only when they reach back
+    from the oldest.
+    """
+
+    def __init__(self, limit=DEFAULT_CACHE_MESSAGES):
+        self.messages = []
+        self.complete = False  # True once the first message of the chat is cached
+        self.limit = limit
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add_newest(self, messages):
+        """Live messages, in arrival order. Messages without an id are skipped."""
+        newest = self.messages[-1][0] if self.messages else None
+        for message in messages:
+            if message[0] is None or (newest is not None and message[0] <= newest):
+                continue
+            self.messages.append(message)
+            newest = message[0]
+        if len(self.messages) > self.limit:
+            del self.messages[: len(self.messages) - self.limit]
+            self.complete = False
+
+    def add_page(self, messages, before_id, exhausted):
+        """
+        A HISTORY_REQ answer: the messages right before `before_id` (None for
+        the newest), `exhausted` if the chat has nothing older. The page is
+        dropped if it does not connect to the cached run or would overflow it.
+        """
+        messages = [message for message in messages if message[0] is not None]
+        if not self.messages:
+            self.messages = messages[-self.limit :]
+            self.complete = exhausted and len(messages) <= self.limit
+            return
+        oldest = self.messages[0][0]
+        reaches = before_id == oldest or (messages and messages[-1][0] >= oldest)
+        older = [message for message in messages if message[0] < oldest]
+        if not reaches or len(self.messages) + len(older) > self.limit:
+            return
+        self.messages[:0] = older
+        self.complete = self.complete or exhausted
+
+    def page(self, before_id, limit):
+        """
+        Answers a page request from the cache: (messages, exhausted) like the
+        server would, or None if the server has to be asked.
+        """
+        if before_id is None:
+            end = len(self.messages)
+        else:
+            end = bisect_left(self.messages, before_id, key=_message_id)
+            if end == len(self.messages) or self.messages[end][0] != before_id:
+                return None  # Not cached, so its neighbours may not be either
+        start = max(0, end - limit)
+        exhausted = start == 0 and self.complete
+        if start == end and not exhausted:
+            return None
+        return self.messages[start:end], exhausted
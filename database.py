@@ -1,117 +1,961 @@
 import sqlite3
 import datetime
+import logging
+import os
+import pathlib
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from itertools import takewhile
+from archive import ArchiveStore, stream_key
 
 DB_NAME = "chat_history.db"
 
+logger = logging.getLogger("chat.database")
+
+# Write-behind defaults: flush when this many messages are queued...
+DEFAULT_BATCH_SIZE = 256
+# ...or when the oldest queued message has waited this long (seconds)
+DEFAULT_FLUSH_INTERVAL = 0.05
+
+# Messages per history page (login replay and "older messages" requests)
+HISTORY_PAGE_SIZE = 50
+# Upper bound for keyset pagination when no before_id is given (SQLite max rowid)
+MAX_MESSAGE_ID = 2**63 - 1
+
+# Read-only connections kept for concurrent lookups and history queries
+DEFAULT_READERS = 4
+
+# Retention: seconds between archive passes, messages moved per
+# transaction (the writer is free for store_message in between) and pages
+# released per incremental_vacuum step
+DEFAULT_RETENTION_INTERVAL = 3600.0
+ARCHIVE_BATCH = 250
+VACUUM_STEP = 256
+
+# Hits per SEARCH page
+SEARCH_PAGE_SIZE = 20
+# Only the newest matches of a query are ranked: bm25 over every match of a
+# common word costs a full index scan, this bounds it
+SEARCH_CANDIDATES = 10000
+
+
+def utc_timestamp():
+    """Message timestamp format stored in the messages table (UTC)."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Keep messages_fts in step with the messages table
+SEARCH_TRIGGERS = (
+    """
+    CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+)
+
+
+def fts_query(text):
+    """
+    FTS5 MATCH expression for free text typed by a user: every word must
+    occur, a trailing * matches it as a prefix. Anything else is taken
+    literally, so user input can never be a malformed query. None if empty.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms) or None
+
+
+class ConnectionPool:
+    """
+    SQLite access for many threads: one writer connection, used by one
+    thread at a time, plus a pool of read-only connections. With WAL
+    journaling readers see the last committed state and never wait for
+    the writer.
+    """
+
+    def __init__(self, db_name, readers=DEFAULT_READERS):
+        self.db_name = db_name
+        self.writer = sqlite3.connect(db_name, check_same_thread=False)
+        # Lets retention hand freed pages back with incremental_vacuum (takes
+        # effect on new files; older ones are converted when retention starts)
+        self.writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.write_lock = threading.Lock()
+
+        self.size = readers
+        self.opened = 0  # Read connections created so far (opened lazily)
+        self.idle = queue.Queue()
+        self.all_readers = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def write(self):
+        """Exclusive use of the writer connection."""
+        with self.write_lock:
+            yield self.writer
+
+    @contextmanager
+    def read(self):
+        """Borrows a read-only connection, waiting if all are busy."""
+        conn = self.acquire_reader()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def acquire_reader(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                conn = self.open_reader()
+                self.all_readers.append(conn)
+                return conn
+        return self.idle.get()
+
+    def open_reader(self):
+        uri = pathlib.Path(self.db_name).absolute().as_uri() + "?mode=ro"
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def close(self):
+        with self.lock:
+            for conn in self.all_readers:
+                conn.close()
+            self.all_readers = []
+        with self.write_lock:
+            self.writer.close()
+
 
 class DatabaseManager:
-    def __init__(self):
-        self.conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-        self.cursor = self.conn.cursor()
+    def __init__(
+        self,
+        db_name=DB_NAME,
+        write_behind=False,
+        batch_size=DEFAULT_BATCH_SIZE,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        cache=None,
+        readers=DEFAULT_READERS,
+        user_directory=True,
+        retention_days=None,
+        retention_interval=DEFAULT_RETENTION_INTERVAL,
+        archive_dir=None,
+    ):
+        self.db_name = db_name
+        self.pool = ConnectionPool(db_name, readers)
+        self.conn = self.pool.writer  # Single-threaded callers (scripts, benchmarks)
+        # Messages moved out by retention, still read by the history queries
+        self.archive = ArchiveStore(
+            archive_dir or os.path.splitext(db_name)[0] + "-archive"
+        )
         self.create_tables()
 
+        # Write-through copy of every bound IP (username -> ip_address), so
+        # a returning user's LOGIN neither reads nor writes SQLite. A bound
+        # IP never changes, which keeps the copy valid even when another
+        # process (a cluster worker) registers users in the same file.
+        self.user_directory = None
+        self.user_lock = threading.Lock()
+        self.user_stats_data = {"memory_hits": 0, "db_reads": 0, "db_writes": 0}
+        if user_directory:
+            with self.pool.write() as conn:
+                rows = conn.execute(
+                    "SELECT username, ip_address FROM users WHERE ip_address IS NOT NULL"
+                ).fetchall()
+            self.user_directory = dict(rows)
+
+        # Message ids are handed out here so store_message can return one
+        # immediately, even when the row is written later. Archived ids
+        # count too: retention may have emptied the messages table.
+        with self.pool.write() as conn:
+            result = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+            newest = max(result.fetchone()[0], ArchiveStore.newest_id(conn))
+            self.next_message_id = newest + 1
+        self.id_lock = threading.Lock()
+
+        # Write-behind state
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []  # Rows waiting to be written
+        self.pending_since = None  # monotonic time the oldest pending row was queued
+        self.pending_cond = threading.Condition()
+        self.queued_seq = 0  # Rows ever queued
+        self.written_seq = 0  # Rows ever committed
+        self.closing = False
+        self.flush_stats_data = {
+            "batches": 0,
+            "rows": 0,
+            "max_batch": 0,
+            "total_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "last_flush_ms": 0.0,
+            "errors": 0,
+        }
+        self.flusher = None
+        if write_behind:
+            self.flusher = threading.Thread(
+                target=self.flush_loop, name="db-flusher", daemon=True
+            )
+            self.flusher.start()
+
+        # Optional in-memory recent history (HistoryCache), warmed with the
+        # latest broadcasts so logins never have to touch SQLite
+        self.cache = cache
+        if cache is not None and cache.public_size > 0:
+            rows = self.query_public_history(cache.public_size, MAX_MESSAGE_ID)
+            cache.load_public(rows, complete=len(rows) < cache.public_size)
+
+        # Retention: a background thread moves messages older than
+        # retention_days into the archive every retention_interval seconds
+        self.retention_days = retention_days
+        self.retention_interval = retention_interval
+        self.retention_stop = threading.Event()
+        self.retention_stats_data = {
+            "passes": 0,
+            "archived": 0,
+            "last_pass_s": 0.0,
+            "pages_freed": 0,
+            "errors": 0,
+        }
+        self.retention_thread = None
+        if retention_days:
+            self.enable_incremental_vacuum()
+            self.retention_thread = threading.Thread(
+                target=self.retention_loop, name="db-retention", daemon=True
+            )
+            self.retention_thread.start()
+
     def create_tables(self):
-        # Users table (track last seen if needed, simple for now)
-        self.cursor.execute(
+        with self.pool.write() as conn:
+            cursor = conn.cursor()
+            # Users table (track last seen if needed, simple for now)
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    ip_address TEXT
+                )
             """
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT PRIMARY KEY,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                ip_address TEXT
             )
-        """
-        )
 
-        # Try to add ip_address column if it doesn't exist (migration for existing db)
-        try:
-            self.cursor.execute("ALTER TABLE users ADD COLUMN ip_address TEXT")
-            self.conn.commit()
-        except sqlite3.OperationalError:
-            # Column likely already exists
-            pass
+            # Try to add ip_address column if it doesn't exist (migration for existing db)
+            try:
+                cursor.execute("ALTER TABLE users ADD COLUMN ip_address TEXT")
+                conn.commit()
+            except sqlite3.OperationalError:
+                # Column likely already exists
+                pass
+
+            # Messages table
+            # msg_type: 'BROADCAST', 'PRIVATE' or 'CHANNEL' (recipient is the channel)
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT,
+                    recipient TEXT,
+                    msg_type TEXT,
+                    content TEXT,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """
+            )
 
-        # Messages table
-        # msg_type: 'BROADCAST' or 'PRIVATE'
-        self.cursor.execute(
+            # Indexes backing the keyset-paginated history queries:
+            # public history walks (msg_type, id) backwards from the newest row...
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_type_id ON messages (msg_type, id)"
+            )
+            # ...and a private conversation is keyed by its (unordered) user pair,
+            # so both directions of the conversation share one index range.
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_messages_private_pair
+                ON messages (min(sender, recipient), max(sender, recipient), id)
+                WHERE msg_type = 'PRIVATE'
+            """
+            )
+            # ...and a channel's history by its name.
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_messages_channel
+                ON messages (recipient, id)
+                WHERE msg_type = 'CHANNEL'
             """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT,
-                recipient TEXT,
-                msg_type TEXT,
-                content TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
+
+            # Channel memberships, looked up by user at login
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS channel_members (
+                    username TEXT,
+                    channel TEXT,
+                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (username, channel)
+                ) WITHOUT ROWID
+            """
+            )
+            # Blocks of archived messages, see archive.py
+            ArchiveStore.create_index(cursor)
+            # Shared files (see transfer.py); `key` authorizes their data connections
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT,
+                    recipient TEXT,
+                    name TEXT,
+                    size INTEGER,
+                    key TEXT,
+                    complete INTEGER DEFAULT 0,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """
+            )
+            conn.commit()
+            self.search_enabled = self.create_search_index(conn)
+
+    def create_search_index(self, conn):
+        """
+        Full-text index over message content. External content: the text is
+        only stored in messages, and triggers keep the index in step with
+        every insert (store_message and write-behind batches alike), delete
+        and update. Messages stored before the index existed are indexed
+        once, here. Returns False if this SQLite build lacks FTS5.
         """
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+        ).fetchone()
+        if exists:
+            return True
+        try:
+            # One transaction, so a crash cannot leave a half-filled index behind
+            conn.execute("BEGIN")
+            conn.execute(
+                """
+                CREATE VIRTUAL TABLE messages_fts USING fts5(
+                    content, content='messages', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            """
+            )
+            for trigger in SEARCH_TRIGGERS:
+                conn.execute(trigger)
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            logger.warning("[SEARCH] Full-text search unavailable: %s", e)
+            return False
+        start = time.perf_counter()
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        conn.commit()
+        logger.info(
+            "[SEARCH] Indexed existing messages in %.1fs", time.perf_counter() - start
         )
-        self.conn.commit()
+        return True
 
     def add_user(self, username, ip_address):
+        # The login's get_user_ip already counted this lookup
+        if self.cached_user_ip(username, count=False) is not None:
+            return  # Already registered and bound, nothing would change
         try:
-            self.cursor.execute(
-                "INSERT OR IGNORE INTO users (username, ip_address) VALUES (?, ?)",
-                (username, ip_address),
-            )
-            # Update IP if it was previously NULL (first login since feature added)
-            self.cursor.execute(
-                "UPDATE users SET ip_address = ? WHERE username = ? AND ip_address IS NULL",
-                (ip_address, username),
-            )
-            self.conn.commit()
+            with self.pool.write() as conn, conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (username, ip_address) VALUES (?, ?)",
+                    (username, ip_address),
+                )
+                # Update IP if it was previously NULL (first login since feature added)
+                conn.execute(
+                    "UPDATE users SET ip_address = ? WHERE username = ? AND ip_address IS NULL",
+                    (ip_address, username),
+                )
+                stored = None
+                if self.user_directory is not None:
+                    # Whatever is bound now, ours or one bound by another process
+                    stored = conn.execute(
+                        "SELECT ip_address FROM users WHERE username = ?", (username,)
+                    ).fetchone()
+            self.remember_user_ip(username, stored[0] if stored else None, "db_writes")
         except Exception as e:
-            print(f"DB Error add_user: {e}")
+            logger.error("DB Error add_user: %s", e)
 
     def get_user_ip(self, username):
+        ip_address = self.cached_user_ip(username)
+        if ip_address is not None:
+            return ip_address
+        # Not bound here: a new user, or one registered by another process
         try:
-            self.cursor.execute(
-                "SELECT ip_address FROM users WHERE username = ?", (username,)
+            with self.pool.read() as conn:
+                result = conn.execute(
+                    "SELECT ip_address FROM users WHERE username = ?", (username,)
+                ).fetchone()
+            ip_address = result[0] if result else None
+            self.remember_user_ip(username, ip_address, "db_reads")
+            return ip_address
+        except Exception as e:
+            logger.error("DB Error get_user_ip: %s", e)
+            return None
+
+    def cached_user_ip(self, username, count=True):
+        """
+        The user's bound IP from the user directory, None if not known there.
+        A hit counts towards memory_hits unless count is False.
+        """
+        if self.user_directory is None:
+            return None
+        with self.user_lock:
+            ip_address = self.user_directory.get(username)
+            if ip_address is not None and count:
+                self.user_stats_data["memory_hits"] += 1
+            return ip_address
+
+    def remember_user_ip(self, username, ip_address, counter):
+        with self.user_lock:
+            self.user_stats_data[counter] += 1
+            if self.user_directory is not None and ip_address is not None:
+                self.user_directory[username] = ip_address
+
+    def user_stats(self):
+        """User directory statistics: logins answered from memory vs. SQLite."""
+        with self.user_lock:
+            stats = dict(self.user_stats_data)
+            stats["cached_users"] = (
+                len(self.user_directory) if self.user_directory is not None else None
             )
-            result = self.cursor.fetchone()
-            return result[0] if result else None
+        return stats
+
+    def get_channels(self, username):
+        """Channels the user is a member of, in joining order."""
+        try:
+            with self.pool.read() as conn:
+                rows = conn.execute(
+                    "SELECT channel FROM channel_members WHERE username = ? ORDER BY joined_at, channel",
+                    (username,),
+                ).fetchall()
+            return [row[0] for row in rows]
+        except Exception as e:
+            logger.error("DB Error get_channels: %s", e)
+            return []
+
+    def join_channel(self, username, channel):
+        try:
+            with self.pool.write() as conn, conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO channel_members (username, channel) VALUES (?, ?)",
+                    (username, channel),
+                )
+        except Exception as e:
+            logger.error("DB Error join_channel: %s", e)
+
+    def leave_channel(self, username, channel):
+        try:
+            with self.pool.write() as conn, conn:
+                conn.execute(
+                    "DELETE FROM channel_members WHERE username = ? AND channel = ?",
+                    (username, channel),
+                )
         except Exception as e:
-            print(f"DB Error get_user_ip: {e}")
+            logger.error("DB Error leave_channel: %s", e)
+
+    def add_file(self, sender, recipient, name, size, key):
+        """Registers a file offered by sender. Returns its id, None on error."""
+        try:
+            with self.pool.write() as conn, conn:
+                cursor = conn.execute(
+                    "INSERT INTO files (sender, recipient, name, size, key) VALUES (?, ?, ?, ?, ?)",
+                    (sender, recipient, name, size, key),
+                )
+            return cursor.lastrowid
+        except Exception as e:
+            logger.error("DB Error add_file: %s", e)
             return None
 
-    def store_message(self, sender, recipient, msg_type, content):
+    def get_file(self, file_id):
+        """(id, sender, recipient, name, size, key, complete) or None."""
         try:
-            self.cursor.execute(
-                "INSERT INTO messages (sender, recipient, msg_type, content) VALUES (?, ?, ?, ?)",
-                (sender, recipient, msg_type, content),
+            with self.pool.read() as conn:
+                return conn.execute(
+                    "SELECT id, sender, recipient, name, size, key, complete FROM files WHERE id = ?",
+                    (file_id,),
+                ).fetchone()
+        except Exception as e:
+            logger.error("DB Error get_file: %s", e)
+            return None
+
+    def complete_file(self, file_id):
+        try:
+            with self.pool.write() as conn, conn:
+                conn.execute("UPDATE files SET complete = 1 WHERE id = ?", (file_id,))
+        except Exception as e:
+            logger.error("DB Error complete_file: %s", e)
+
+    def store_message(self, sender, recipient, msg_type, content, timestamp=None):
+        """
+        Stores a message and returns its id.
+        In write-behind mode the row is only queued, and committed by the
+        flusher thread together with its neighbours.
+        """
+        with self.id_lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            if timestamp is None:
+                timestamp = utc_timestamp()
+            row = (message_id, sender, recipient, msg_type, content, timestamp)
+            if not self.write_behind:
+                try:
+                    with self.pool.write() as conn, conn:
+                        conn.execute(
+                            "INSERT INTO messages (id, sender, recipient, msg_type, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                            row,
+                        )
+                except Exception as e:
+                    logger.error("DB Error store_message: %s", e)
+                    return None
+            # Cached under the id lock so the rings stay in id order, and
+            # only once the row is committed (or queued, in write-behind mode)
+            self.cache_message(
+                message_id, sender, recipient, msg_type, content, timestamp
             )
-            self.conn.commit()
+            if not self.write_behind:
+                return message_id
+
+            # Queued under the id lock too, so no batch commits an id before
+            # an older one is queued: readers never see a gap that fills later
+            with self.pending_cond:
+                if not self.pending:
+                    self.pending_since = time.monotonic()
+                self.pending.append(row)
+                self.queued_seq += 1
+                if len(self.pending) >= self.batch_size:
+                    self.pending_cond.notify_all()
+        return message_id
+
+    def cache_message(
+        self, message_id, sender, recipient, msg_type, content, timestamp
+    ):
+        """
+        Adds a message to the history cache without storing it, for messages
+        written by another process (cluster workers). Calls must come in id order.
+        """
+        if self.cache is None:
+            return
+        cached = (message_id, sender, content, timestamp)
+        if msg_type == "BROADCAST":
+            self.cache.add_public(cached)
+        elif msg_type == "PRIVATE":
+            self.cache.add_private(sender, recipient, cached)
+
+    def flush_loop(self):
+        """Flusher thread: commits queued rows in batches on a size or time threshold."""
+        with self.pool.write() as conn:
+            # WAL + NORMAL: no fsync per commit, still crash-safe
+            conn.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            with self.pending_cond:
+                while not self.pending and not self.closing:
+                    self.pending_cond.wait()
+                # Give the batch time to fill up, unless it already has
+                while (
+                    self.pending
+                    and len(self.pending) < self.batch_size
+                    and not self.closing
+                ):
+                    remaining = (
+                        self.pending_since + self.flush_interval - time.monotonic()
+                    )
+                    if remaining <= 0:
+                        break
+                    self.pending_cond.wait(remaining)
+                batch = self.pending
+                self.pending = []
+                if not batch and self.closing:
+                    return
+
+            self.write_batch(batch)
+
+            with self.pending_cond:
+                self.written_seq += len(batch)
+                self.pending_cond.notify_all()
+
+    def write_batch(self, batch):
+        start = time.perf_counter()
+        try:
+            # One transaction, one commit for the whole batch
+            with self.pool.write() as conn, conn:
+                conn.executemany(
+                    "INSERT INTO messages (id, sender, recipient, msg_type, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                    batch,
+                )
+        except Exception as e:
+            self.flush_stats_data["errors"] += 1
+            logger.error("DB Error write_batch (%d messages): %s", len(batch), e)
+            return
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stats = self.flush_stats_data
+        stats["batches"] += 1
+        stats["rows"] += len(batch)
+        stats["max_batch"] = max(stats["max_batch"], len(batch))
+        stats["total_flush_ms"] += elapsed_ms
+        stats["max_flush_ms"] = max(stats["max_flush_ms"], elapsed_ms)
+        stats["last_flush_ms"] = elapsed_ms
+
+    def flush(self):
+        """Blocks until every message queued so far has been written."""
+        if self.flusher is None:
+            return
+        with self.pending_cond:
+            target = self.queued_seq
+            self.pending_cond.notify_all()
+            while self.written_seq < target and self.flusher.is_alive():
+                # Skip the remaining time threshold, someone is waiting
+                self.pending_since = float("-inf")
+                self.pending_cond.wait(0.1)
+
+    def flush_stats(self):
+        """Write-behind statistics: batch sizes and flush latency."""
+        with self.pending_cond:
+            stats = dict(self.flush_stats_data)
+            stats["pending"] = len(self.pending)
+        stats["avg_batch"] = stats["rows"] / stats["batches"] if stats["batches"] else 0
+        stats["avg_flush_ms"] = (
+            stats["total_flush_ms"] / stats["batches"] if stats["batches"] else 0.0
+        )
+        return stats
+
+    def enable_incremental_vacuum(self):
+        """Converts a database created without auto_vacuum, with a one-off VACUUM."""
+        with self.pool.write() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return
+            logger.info("[RETENTION] Enabling incremental vacuum (one-off VACUUM)...")
+            start = time.perf_counter()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            logger.info("[RETENTION] VACUUM done in %.1fs", time.perf_counter() - start)
+
+    def retention_loop(self):
+        while not self.retention_stop.is_set():
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+                days=self.retention_days
+            )
+            start = time.perf_counter()
+            try:
+                archived = self.archive_messages(cutoff.strftime("%Y-%m-%d %H:%M:%S"))
+                freed = self.vacuum_free_pages()
+            except Exception as e:
+                logger.error("[RETENTION] Archive pass failed: %s", e)
+                self.retention_stats_data["errors"] += 1
+            else:
+                elapsed = time.perf_counter() - start
+                stats = self.retention_stats_data
+                stats["passes"] += 1
+                stats["archived"] += archived
+                stats["pages_freed"] += freed
+                stats["last_pass_s"] = elapsed
+                if archived:
+                    logger.info(
+                        "[RETENTION] Archived %d messages, freed %d pages in %.1fs",
+                        archived,
+                        freed,
+                        elapsed,
+                    )
+            self.retention_stop.wait(self.retention_interval)
+
+    def archive_messages(self, cutoff):
+        """
+        Moves messages stored before `cutoff` (a messages.timestamp string)
+        into the archive, oldest first. Each batch is read from a reader
+        connection and written to a segment without holding the writer; only
+        indexing and deleting it is one short write transaction, so
+        store_message waits at most that long. Returns the number moved.
+        """
+        archived = 0
+        while not self.retention_stop.is_set():
+            with self.pool.read() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT id, sender, recipient, msg_type, content, timestamp
+                    FROM messages ORDER BY id LIMIT ?
+                """,
+                    (ARCHIVE_BATCH,),
+                ).fetchall()
+            rows = list(takewhile(lambda row: row[5] < cutoff, rows))
+            if not rows:
+                break
+            entries = self.archive.write(rows)
+            with self.pool.write() as conn, conn:
+                conn.executemany(
+                    "INSERT INTO archive_blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    entries,
+                )
+                conn.executemany(
+                    "DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows]
+                )
+            archived += len(rows)
+        return archived
+
+    def vacuum_free_pages(self):
+        """Returns free pages to the file system, VACUUM_STEP pages per write lock."""
+        freed = 0
+        while not self.retention_stop.is_set():
+            with self.pool.write() as conn:
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free:
+                    break
+                # executescript steps the pragma to completion; execute()
+                # would stop after the first page
+                conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP})")
+            freed += min(free, VACUUM_STEP)
+        return freed
+
+    def retention_stats(self):
+        stats = dict(self.retention_stats_data)
+        stats.update(self.archive.stats())
+        return stats
+
+    def archived_page(self, key, limit, before_id, rows):
+        """
+        Completes a short page of `rows` (oldest first, all newer than
+        anything archived) with archived messages of stream `key`.
+        """
+        if len(rows) >= limit:
+            return rows
+        try:
+            with self.pool.read() as conn:
+                older = self.archive.page(
+                    conn, key, limit - len(rows), rows[0][0] if rows else before_id
+                )
         except Exception as e:
-            print(f"DB Error store_message: {e}")
+            logger.error("DB Error archived history: %s", e)
+            return rows
+        return older + rows
 
-    def get_public_history(self, limit=50):
+    def get_public_history(self, limit=HISTORY_PAGE_SIZE, before_id=None):
+        """
+        Returns up to `limit` broadcasts as (id, sender, content, timestamp),
+        oldest first. Without before_id this is the latest page, otherwise
+        the page just before message before_id (keyset pagination).
+        Served from the history cache when it holds the whole page.
+        """
+        if self.cache is not None:
+            rows = self.cache.public_page(limit, before_id)
+            if rows is not None:
+                return rows
+        return self.query_public_history(
+            limit, MAX_MESSAGE_ID if before_id is None else before_id
+        )
+
+    def get_private_history(
+        self, user1, user2, limit=HISTORY_PAGE_SIZE, before_id=None
+    ):
+        """
+        Returns up to `limit` private messages exchanged between user1 and
+        user2 as (id, sender, content, timestamp), oldest first, paginated
+        the same way as get_public_history.
+        """
+        if self.cache is not None:
+            rows = self.cache.private_page(user1, user2, limit, before_id)
+            if rows is not None:
+                return rows
+
+        rows = self.query_private_history(
+            user1, user2, limit, MAX_MESSAGE_ID if before_id is None else before_id
+        )
+        if self.cache is not None and before_id is None:
+            # Seed the conversation's ring with its latest page
+            self.cache.load_private(user1, user2, rows, complete=len(rows) < limit)
+        return rows
+
+    def get_channel_history(self, channel, limit=HISTORY_PAGE_SIZE, before_id=None):
+        """
+        Returns up to `limit` messages of a channel as (id, sender, content,
+        timestamp), oldest first, paginated the same way as get_public_history.
+        """
+        self.flush()  # Make queued messages visible
         try:
-            self.cursor.execute(
-                """
-                SELECT sender, content, timestamp FROM messages 
-                WHERE msg_type = 'BROADCAST' 
-                ORDER BY timestamp ASC
-            """
-            )  # limiting is tricky with ASC, usually fetch all or subquery. Let's fetch all for simplicity in this project.
-            return self.cursor.fetchall()
+            # Walks idx_messages_channel backwards from before_id
+            with self.pool.read() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT id, sender, content, timestamp FROM messages
+                    WHERE msg_type = 'CHANNEL' AND recipient = ? AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """,
+                    (
+                        channel,
+                        MAX_MESSAGE_ID if before_id is None else before_id,
+                        limit,
+                    ),
+                ).fetchall()
+            rows.reverse()
         except Exception as e:
-            print(f"DB Error get_public_history: {e}")
+            logger.error("DB Error get_channel_history: %s", e)
             return []
+        return self.archived_page(
+            stream_key("CHANNEL", None, channel),
+            limit,
+            MAX_MESSAGE_ID if before_id is None else before_id,
+            rows,
+        )
 
-    def get_private_history(self, user1, user2):
+    def query_public_history(self, limit, before_id):
+        self.flush()  # Make queued messages visible
         try:
-            # Fetch messages between user1 and user2
-            self.cursor.execute(
-                """
-                SELECT sender, content, timestamp FROM messages 
-                WHERE msg_type = 'PRIVATE' 
-                AND ((sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?))
-                ORDER BY timestamp ASC
-            """,
-                (user1, user2, user2, user1),
-            )
-            return self.cursor.fetchall()
+            with self.pool.read() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT id, sender, content, timestamp FROM messages
+                    WHERE msg_type = 'BROADCAST' AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """,
+                    (before_id, limit),
+                ).fetchall()
+            rows.reverse()
         except Exception as e:
-            print(f"DB Error get_private_history: {e}")
+            logger.error("DB Error get_public_history: %s", e)
             return []
+        return self.archived_page(
+            stream_key("BROADCAST", None, None), limit, before_id, rows
+        )
+
+    def query_private_history(self, user1, user2, limit, before_id):
+        self.flush()  # Make queued messages visible
+        low, high = sorted((user1, user2))
+        try:
+            # The min/max expressions match idx_messages_private_pair
+            with self.pool.read() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT id, sender, content, timestamp FROM messages
+                    WHERE msg_type = 'PRIVATE'
+                    AND min(sender, recipient) = ? AND max(sender, recipient) = ?
+                    AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """,
+                    (low, high, before_id, limit),
+                ).fetchall()
+            rows.reverse()
+        except Exception as e:
+            logger.error("DB Error get_private_history: %s", e)
+            return []
+        return self.archived_page(
+            stream_key("PRIVATE", low, high), limit, before_id, rows
+        )
+
+    def get_missed_messages(self, username, after_id, limit):
+        """
+        Messages newer than after_id that username can see: broadcasts, their
+        own private messages and those of their channels, as (id, sender,
+        recipient, msg_type, content, timestamp), oldest first.
+        Returns (rows, complete). complete is False, and rows empty, if more
+        than `limit` match or messages after after_id have been archived.
+        """
+        self.flush()  # Make queued messages visible
+        try:
+            # Range scans of idx_messages_type_id from after_id: the cost
+            # grows with the messages sent since, not with the table
+            with self.pool.read() as conn:
+                if ArchiveStore.newest_id(conn) > after_id:
+                    return [], False
+                rows = conn.execute(
+                    """
+                    SELECT id, sender, recipient, msg_type, content, timestamp
+                    FROM messages
+                    WHERE id > ? AND (
+                        msg_type = 'BROADCAST'
+                        OR (msg_type = 'PRIVATE' AND ? IN (sender, recipient))
+                        OR (msg_type = 'CHANNEL' AND recipient IN (
+                            SELECT channel FROM channel_members WHERE username = ?
+                        ))
+                    )
+                    ORDER BY id
+                    LIMIT ?
+                """,
+                    (after_id, username, username, limit + 1),
+                ).fetchall()
+        except Exception as e:
+            logger.error("DB Error get_missed_messages: %s", e)
+            return [], False
+        if len(rows) > limit:
+            return [], False
+        return rows, True
+
+    def search_messages(self, username, text, limit=SEARCH_PAGE_SIZE, offset=0):
+        """
+        Full-text search over broadcasts, username's own private messages and
+        the channels username is a member of.
+        Returns (rows, more): up to `limit` hits as (id, sender, recipient,
+        msg_type, content, timestamp), best match first (newest first among
+        equals) after skipping `offset`, and whether more hits follow.
+        Hits are ranked among the newest SEARCH_CANDIDATES matches.
+        """
+        match = fts_query(text)
+        if not self.search_enabled or match is None:
+            return [], False
+        self.flush()  # Make queued messages visible
+        try:
+            with self.pool.read() as conn:
+                rows = conn.execute(
+                    """
+                    WITH hits AS (
+                        SELECT rowid AS id, rank FROM messages_fts
+                        WHERE messages_fts MATCH ?
+                        ORDER BY rowid DESC
+                        LIMIT ?
+                    )
+                    SELECT m.id, m.sender, m.recipient, m.msg_type, m.content, m.timestamp
+                    FROM hits JOIN messages AS m ON m.id = hits.id
+                    WHERE m.msg_type = 'BROADCAST'
+                    OR (m.msg_type = 'PRIVATE' AND ? IN (m.sender, m.recipient))
+                    OR (m.msg_type = 'CHANNEL' AND m.recipient IN (
+                        SELECT channel FROM channel_members WHERE username = ?
+                    ))
+                    ORDER BY hits.rank, m.id DESC
+                    LIMIT ? OFFSET ?
+                """,
+                    (match, SEARCH_CANDIDATES, username, username, limit + 1, offset),
+                ).fetchall()
+        except Exception as e:
+            logger.error("DB Error search_messages: %s", e)
+            return [], False
+        return rows[:limit], len(rows) > limit
 
     def close(self):
-        self.conn.close()
+        """Flushes queued messages (write-behind mode) and closes the database."""
+        if self.retention_thread is not None:
+            self.retention_stop.set()
+            self.retention_thread.join()
+            self.retention_thread = None
+        if self.flusher is not None:
+            with self.pending_cond:
+                self.closing = True
+                self.pending_cond.notify_all()
+            self.flusher.join()
+            self.flusher = None
+        self.pool.close()
@@ -0,0 +1,514 @@
+"""
+Server-to-server federation (server.py --node NAME --peer HOST:PORT).
+
+Each server ("node") keeps authenticated links to its peers over the normal
+client port and framing. Users of other nodes appear as "user@node".
+
+- Broadcasts are flooded to every peer. Each copy carries a unique id and
+  the path of nodes it has visited: a node drops ids it has already seen
+  and never sends a message back along its path.
+- Every node floods its own user list, versioned, on change and every few
+  seconds. The link a node's newest list arrived on is the route to that
+  node, and private messages to user@node follow these routes hop by hop.
+- Links authenticate both ways with a shared secret (HMAC over a fresh
+  nonce), the secret itself never crosses the wire.
+"""
+
+import hashlib
+import hmac
+import itertools
+import logging
+import secrets
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from protocol import PRESENCE_JOIN, PRESENCE_LEAVE, FramedConnection, encode_message
+from server import ChatServer
+from session import ClientSession, OVERFLOW_DISCONNECT
+
+logger = logging.getLogger("chat.federation")
+
+PEER_HELLO = "PEER_HELLO"  # dialer -> acceptor: {"node", "nonce"}
+PEER_AUTH = "PEER_AUTH"  # acceptor: {"node", "nonce", "proof"}, dialer: {"proof"}
+PEER_MSG = "PEER_MSG"  # {"fid", "path", "from", "to", "content"}
+PEER_PRESENCE = "PEER_PRESENCE"  # {"node", "version", "users", "path"}
+
+# Frames queued per peer before a stalled link is dropped (it reconnects)
+PEER_QUEUE_SIZE = 65536
+HANDSHAKE_TIMEOUT = 5.0
+RECONNECT_DELAY = 2.0
+# User lists are re-flooded this often and forgotten when not refreshed
+PRESENCE_INTERVAL = 5.0
+PRESENCE_EXPIRY = 3 * PRESENCE_INTERVAL
+# Relayed message ids remembered for duplicate suppression
+SEEN_LIMIT = 100000
+MAX_HOPS = 16
+
+
+def auth_proof(secret, role, nonce, node):
+    """HMAC proving knowledge of the secret for one handshake step."""
+    message = f"{role}|{nonce}|{node}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def parse_peer(text):
+    """'host:port' -> (host, port)."""
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class PeerLink:
+    """One authenticated connection to a neighbouring node."""
+
+    def __init__(self, node, conn, dialer):
+        self.node = node
+        self.conn = conn
+        self.dialer = dialer  # Name of the node that opened the connection
+        self.session = ClientSession(
+            f"peer-{node}", conn, PEER_QUEUE_SIZE, OVERFLOW_DISCONNECT
+        )
+
+    def send(self, message_dict):
+        return self.session.send(message_dict)
+
+    def send_frame(self, frame):
+        return self.session.send_frame(frame)
+
+
+class FederatedServer(ChatServer):
+    """ChatServer that shares users and messages with peer servers."""
+
+    def __init__(self, node, secret, peers=(), *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.node = node
+        self.secret = secret
+        self.peer_addresses = [parse_peer(peer) for peer in peers]
+        self.address_nodes = {}  # (host, port) -> node name, once linked
+
+        self.links = {}  # node -> PeerLink
+        # node -> {"users", "version", "via", "seen", "msg"} for every remote node
+        self.remote = {}
+        self.seen = OrderedDict()  # Recently relayed message ids
+        self.federation_lock = threading.Lock()
+
+        # Ids and versions start from the clock so they stay new across restarts
+        self.boot = time.time_ns()
+        self.fids = itertools.count(1)
+        self.peer_version = 0  # Of this node's PEER_PRESENCE floods
+
+    def start(self):
+        for address in self.peer_addresses:
+            threading.Thread(
+                target=self.dial_loop, args=(address,), name="peer-dial", daemon=True
+            ).start()
+        threading.Thread(
+            target=self.presence_loop, name="peer-presence", daemon=True
+        ).start()
+        super().start()
+
+    # Local users
+
+    def username_error(self, username):
+        error = super().username_error(username)
+        if error is None and "@" in username:
+            return "Usernames cannot contain '@'"
+        return error
+
+    def user_list(self):
+        """Local users followed by the users of every remote node as user@node."""
+        users = super().user_list()
+        with self.federation_lock:
+            for node in sorted(self.remote):
+                users.extend(f"{user}@{node}" for user in self.remote[node]["users"])
+        return users
+
+    def announce_login(self, username):
+        super().announce_login(username)
+        self.announce_presence()
+
+    def announce_logout(self, username):
+        super().announce_logout(username)
+        self.announce_presence()
+
+    def publish_remote_changes(self, node, old_users, new_users):
+        """Presence deltas for remote users. Caller holds presence_lock."""
+        new_set = set(new_users)
+        old_set = set(old_users)
+        self.presence_changed(
+            PRESENCE_LEAVE,
+            [f"{user}@{node}" for user in old_users if user not in new_set],
+        )
+        self.presence_changed(
+            PRESENCE_JOIN,
+            [f"{user}@{node}" for user in new_users if user not in old_set],
+        )
+
+    def handle_chat_message(self, username, session, msg):
+        recipient = msg.get("to")
+
+        if recipient == "all":
+            super().handle_chat_message(username, session, msg)
+            self.relay(
+                {
+                    "type": PEER_MSG,
+                    "fid": self.next_fid(),
+                    "path": [self.node],
+                    "from": f"{username}@{self.node}",
+                    "to": "all",
+                    "content": msg.get("content"),
+                }
+            )
+        elif isinstance(recipient, str) and "@" in recipient:
+            self.send_remote_private(username, session, recipient, msg.get("content"))
+        else:
+            super().handle_chat_message(username, session, msg)
+
+    def send_remote_private(self, username, session, recipient, content):
+        user, _, node = recipient.rpartition("@")
+        with self.federation_lock:
+            entry = self.remote.get(node)
+            link = entry["via"] if entry and user in entry["users"] else None
+        if link is None:
+            session.send({"type": "ERROR", "content": f"User {recipient} not found."})
+            return
+
+        logger.debug("[%s -> %s]: %s", username, recipient, content)
+        with self.metrics.timer("db_store"):
+            message_id = self.db.store_message(username, recipient, "PRIVATE", content)
+        self.metrics.incr("messages_private")
+        link.send(
+            {
+                "type": PEER_MSG,
+                "fid": self.next_fid(),
+                "path": [self.node],
+                "from": f"{username}@{self.node}",
+                "to": recipient,
+                "content": content,
+            }
+        )
+        # Back to the sender so they see it in their UI
+        session.send(
+            {
+                "type": "MSG",
+                "id": message_id,
+                "from": username,
+                "to": recipient,
+                "content": content,
+                "private": True,
+            }
+        )
+
+    # Relaying
+
+    def next_fid(self):
+        return f"{self.node}:{self.boot}:{next(self.fids)}"
+
+    def first_sight(self, fid):
+        """True the first time a message id is seen."""
+        with self.federation_lock:
+            if fid in self.seen:
+                return False
+            self.seen[fid] = None
+            if len(self.seen) > SEEN_LIMIT:
+                self.seen.popitem(last=False)
+            return True
+
+    def relay(self, msg, exclude=None):
+        """Sends msg to every peer that is neither `exclude` nor on its path."""
+        frame = encode_message(msg)
+        path = msg.get("path", ())
+        with self.federation_lock:
+            links = [
+                link
+                for link in self.links.values()
+                if link is not exclude and link.node not in path
+            ]
+        for link in links:
+            link.send_frame(frame)
+        self.metrics.incr("peer_frames_sent", len(links))
+
+    def on_peer_message(self, link, msg):
+        path = msg.get("path") or []
+        if self.node in path or len(path) > MAX_HOPS:
+            return
+        if not self.first_sight(msg.get("fid")):
+            return
+        self.metrics.incr("peer_messages_received")
+        path.append(self.node)
+
+        sender = msg.get("from")
+        recipient = msg.get("to")
+        content = msg.get("content")
+
+        if recipient == "all":
+            logger.debug("[%s -> ALL]: %s", sender, content)
+            with self.metrics.timer("db_store"):
+                message_id = self.db.store_message(sender, "all", "BROADCAST", content)
+            self.broadcast(
+                {
+                    "type": "MSG",
+                    "id": message_id,
+                    "from": sender,
+                    "to": "all",
+                    "content": content,
+                }
+            )
+            self.relay(msg, exclude=link)
+            return
+
+        user, _, node = recipient.rpartition("@")
+        if node != self.node:
+            # Not ours, pass it on towards its node
+            with self.federation_lock:
+                entry = self.remote.get(node)
+                next_link = entry["via"] if entry else None
+            if next_link is not None and next_link.node not in path:
+                next_link.send(msg)
+            return
+
+        target_session = self.clients.get(user)
+        if target_session is None:
+            logger.info(
+                "[FEDERATION] %s is offline, dropped message from %s", user, sender
+            )
+            return
+        logger.debug("[%s -> %s]: %s", sender, user, content)
+        with self.metrics.timer("db_store"):
+            message_id = self.db.store_message(sender, user, "PRIVATE", content)
+        target_session.send(
+            {
+                "type": "MSG",
+                "id": message_id,
+                "from": sender,
+                "to": user,
+                "content": content,
+                "private": True,
+            }
+        )
+
+    # Presence
+
+    def announce_presence(self, link=None):
+        """Floods this node's user list to every peer (or just to `link`)."""
+        with self.federation_lock:
+            self.peer_version = max(self.peer_version + 1, time.time_ns())
+            msg = {
+                "type": PEER_PRESENCE,
+                "node": self.node,
+                "version": self.peer_version,
+                "users": list(self.clients.keys()),
+                "path": [self.node],
+            }
+        if link is None:
+            self.relay(msg)
+        else:
+            link.send(msg)
+
+    def on_presence(self, link, msg):
+        node = msg.get("node")
+        path = msg.get("path") or []
+        if node == self.node or self.node in path or len(path) > MAX_HOPS:
+            return
+
+        users = msg.get("users", [])
+        # Held across the update and its deltas so they go out in the same order
+        with self.presence_lock:
+            with self.federation_lock:
+                entry = self.remote.get(node)
+                if entry is not None and msg.get("version", 0) <= entry["version"]:
+                    return  # Old news, or a copy that took a longer path
+                old_users = entry["users"] if entry is not None else []
+                path.append(self.node)
+                self.remote[node] = {
+                    "users": users,
+                    "version": msg.get("version", 0),
+                    "via": link,
+                    "seen": time.monotonic(),
+                    "msg": msg,
+                }
+            self.publish_remote_changes(node, old_users, users)
+
+        self.relay(msg, exclude=link)
+
+    def presence_loop(self):
+        while self.running:
+            time.sleep(PRESENCE_INTERVAL)
+            self.announce_presence()
+            self.expire_nodes()
+
+    def expire_nodes(self):
+        now = time.monotonic()
+        with self.presence_lock:
+            with self.federation_lock:
+                stale = {
+                    node: entry["users"]
+                    for node, entry in self.remote.items()
+                    if now - entry["seen"] > PRESENCE_EXPIRY
+                }
+                for node in stale:
+                    del self.remote[node]
+            for node, users in stale.items():
+                self.publish_remote_changes(node, users, [])
+        if stale:
+            logger.info("[FEDERATION] Lost nodes: %s", ", ".join(stale))
+
+    # Links
+
+    def check_proof(self, proof, role, nonce, node):
+        expected = auth_proof(self.secret, role, nonce, node)
+        return isinstance(proof, str) and hmac.compare_digest(proof, expected)
+
+    def dial(self, address):
+        """Connects and authenticates to the peer at address. Returns a PeerLink."""
+        sock = socket.create_connection(address, timeout=HANDSHAKE_TIMEOUT)
+        conn = FramedConnection(sock, metrics=self.metrics)
+        try:
+            nonce = secrets.token_hex(16)
+            conn.send({"type": PEER_HELLO, "node": self.node, "nonce": nonce})
+            reply = conn.receive()
+            if not reply or reply.get("type") != PEER_AUTH:
+                reason = reply.get("content") if reply else "connection closed"
+                raise ConnectionError(f"refused: {reason}")
+            peer = reply.get("node")
+            if not peer or not self.check_proof(
+                reply.get("proof"), "acceptor", nonce, peer
+            ):
+                raise ConnectionError("peer failed authentication")
+            conn.send(
+                {
+                    "type": PEER_AUTH,
+                    "proof": auth_proof(
+                        self.secret, "dialer", reply.get("nonce"), self.node
+                    ),
+                }
+            )
+        except Exception:
+            conn.close()
+            raise
+        sock.settimeout(None)
+        return PeerLink(peer, conn, dialer=self.node)
+
+    def dial_loop(self, address):
+        """Keeps a link to the peer at address open, reconnecting as needed."""
+        while self.running:
+            node = self.address_nodes.get(address)
+            with self.federation_lock:
+                linked = node in self.links
+            if not linked:
+                try:
+                    link = self.dial(address)
+                except OSError as e:
+                    logger.info("[FEDERATION] Cannot link to %s:%s: %s", *address, e)
+                else:
+                    self.address_nodes[address] = link.node
+                    self.run_link(link)
+            time.sleep(RECONNECT_DELAY)
+
+    def accept_peer(self, conn, hello, address):
+        peer = hello.get("node")
+        if not peer or peer == self.node:
+            conn.send({"type": "ERROR", "content": "Bad node name"})
+            return
+
+        nonce = secrets.token_hex(16)
+        conn.sock.settimeout(HANDSHAKE_TIMEOUT)
+        conn.send(
+            {
+                "type": PEER_AUTH,
+                "node": self.node,
+                "nonce": nonce,
+                "proof": auth_proof(
+                    self.secret, "acceptor", hello.get("nonce"), self.node
+                ),
+            }
+        )
+        reply = conn.receive()
+        if (
+            not reply
+            or reply.get("type") != PEER_AUTH
+            or not self.check_proof(reply.get("proof"), "dialer", nonce, peer)
+        ):
+            logger.warning(
+                "[REJECTED] Peer %s from %s failed authentication", peer, address
+            )
+            return
+        conn.sock.settimeout(None)
+        self.run_link(PeerLink(peer, conn, dialer=peer))
+
+    def add_link(self, link):
+        """
+        Registers a link, False if it is a duplicate. When both nodes dial
+        each other, both keep the link dialed by the smaller node name.
+        """
+        with self.federation_lock:
+            existing = self.links.get(link.node)
+            if existing is not None:
+                if existing.dialer != link.dialer and existing.dialer == min(
+                    self.node, link.node
+                ):
+                    return False
+                # Replaces the other direction, or a stale link from the same side
+                existing.session.close()
+            self.links[link.node] = link
+            return True
+
+    def run_link(self, link):
+        """Serves one peer link until it closes."""
+        if not self.add_link(link):
+            logger.info("[FEDERATION] Duplicate link to %s dropped", link.node)
+            link.session.close()
+            return
+
+        logger.info("[FEDERATION] Linked to %s", link.node)
+        try:
+            # Bring the peer up to date: our users and every node we know of
+            self.announce_presence(link)
+            with self.federation_lock:
+                known = [entry["msg"] for entry in self.remote.values()]
+            for msg in known:
+                link.send(msg)
+
+            while self.running:
+                msg = link.conn.receive()
+                if msg is None:
+                    break
+                msg_type = msg.get("type")
+
+                if msg_type == PEER_MSG:
+                    self.on_peer_message(link, msg)
+                elif msg_type == PEER_PRESENCE:
+                    self.on_presence(link, msg)
+        finally:
+            self.remove_link(link)
+
+    def remove_link(self, link):
+        link.session.close()
+        with self.presence_lock:
+            with self.federation_lock:
+                if self.links.get(link.node) is link:
+                    del self.links[link.node]
+                # Nodes reached through this link, until a refresh finds another way
+                lost = {
+                    node: entry["users"]
+                    for node, entry in self.remote.items()
+                    if entry["via"] is link
+                }
+                for node in lost:
+                    del self.remote[node]
+            for node, users in lost.items():
+                self.publish_remote_changes(node, users, [])
+        logger.info("[FEDERATION] Link to %s closed", link.node)
+
+    def stats(self):
+        stats = super().stats()
+        with self.federation_lock:
+            stats["federation"] = {
+                "node": self.node,
+                "links": sorted(self.links),
+                "nodes": {
+                    node: len(entry["users"]) for node, entry in self.remote.items()
+                },
+            }
+        return stats
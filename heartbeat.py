@@ -0,0 +1,212 @@
+import socket
+import threading
+import time
+
+from protocol import PING, encode_message
+
+# Seconds of silence before a client is pinged, and before it is dropped
+DEFAULT_PING_INTERVAL = 30.0
+DEFAULT_IDLE_TIMEOUT = 90.0
+# Seconds a new connection gets to send its first frame (LOGIN)
+DEFAULT_LOGIN_TIMEOUT = 10.0
+# How often the reaper runs; deadlines are honoured to within one tick
+DEFAULT_TICK = 1.0
+
+# TCP keepalive, for clients that never answer PINGs: the kernel probes a
+# connection after KEEPALIVE_IDLE seconds of silence, every
+# KEEPALIVE_INTERVAL seconds, and resets it after KEEPALIVE_PROBES misses
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 15
+KEEPALIVE_PROBES = 4
+
+PING_FRAME = encode_message({"type": PING})
+
+
+def enable_keepalive(sock):
+    """
+    Turns on TCP keepalive for an accepted connection. A half-open one (the
+    peer's laptop slept, its Wi-Fi went away) then fails its next read even
+    when the client never announced heartbeats, so it is never on the
+    wheel. The timing options are set where the platform has them.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (
+            ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+            ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+            ("TCP_KEEPCNT", KEEPALIVE_PROBES),
+        ):
+            if hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+    except OSError:
+        pass  # Not a TCP socket
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel. A timer goes into the slot of the tick it expires
+    on, so scheduling and cancelling are O(1) and advancing the clock only
+    looks at the slots of the ticks that passed, whose timers are all due.
+    Timers more than one turn away share a slot with nearer ones and are
+    left there until their turn.
+
+    Timers are objects with `deadline` and `slot` attributes (see Watch);
+    the wheel keeps them there instead of in an index of its own.
+    """
+
+    def __init__(self, tick, slots, now):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # Timers as dict keys, per slot
+        self.current = int(now // tick)  # First tick not expired yet
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, timer, deadline):
+        """(Re)schedules `timer` to expire at `deadline`."""
+        if timer.slot is not None:
+            self.cancel(timer)
+        timer.deadline = deadline
+        timer.slot = slot = self.slots[
+            max(int(deadline // self.tick), self.current) % len(self.slots)
+        ]
+        slot[timer] = None
+        self.count += 1
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            del timer.slot[timer]
+            timer.slot = None
+            self.count -= 1
+
+    def expire(self, now):
+        """
+        Removes and returns the timers of the ticks that have fully passed
+        by `now`. Only whole slots are taken, so a tick looks at no timer
+        that is not due; the price is firing up to one tick late.
+        """
+        end = int(now // self.tick)  # The tick `now` is in, still running
+        # A full turn visits every slot, older ticks need not be replayed
+        ticks = range(max(self.current, end - len(self.slots)), end)
+        self.current = max(self.current, end)
+        expired = []
+        for tick in ticks:
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            due = [timer for timer in slot if timer.deadline < end * self.tick]
+            if len(due) == len(slot):
+                self.slots[index] = {}
+            else:
+                # Timers a turn or more away, left for a later visit
+                for timer in due:
+                    del slot[timer]
+            for timer in due:
+                timer.slot = None
+            expired.extend(due)
+        self.count -= len(expired)
+        return expired
+
+
+class Watch:
+    """One watched connection: when it was last heard from and how to act on it."""
+
+    __slots__ = ("close", "ping", "last_seen", "deadline", "slot")
+
+    def __init__(self, close, ping, now):
+        self.close = close
+        self.ping = ping
+        self.last_seen = now
+        self.deadline = None
+        self.slot = None  # Set while scheduled on the wheel
+
+    def seen(self):
+        """Called for every frame received from the connection."""
+        self.last_seen = time.monotonic()
+
+
+class IdleReaper:
+    """
+    Closes connections that have gone quiet. Watches with a ping callback
+    (logged-in clients that answer PING) are pinged after `ping_interval`
+    seconds of silence and closed after `idle_timeout`; watches without one
+    (connections that have not logged in yet) are closed after
+    `login_timeout`.
+
+    Receiving a frame only stamps Watch.last_seen. The wheel entry is moved
+    lazily, when it expires and turns out to have been seen since, so a
+    busy connection costs one wheel visit per interval rather than one per
+    frame.
+    """
+
+    def __init__(
+        self,
+        ping_interval=DEFAULT_PING_INTERVAL,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        login_timeout=DEFAULT_LOGIN_TIMEOUT,
+        tick=DEFAULT_TICK,
+    ):
+        if idle_timeout <= ping_interval:
+            raise ValueError("idle_timeout must be longer than ping_interval")
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.login_timeout = login_timeout
+        self.tick = tick
+        # Enough slots that every deadline is less than one turn away
+        slots = int(max(idle_timeout, login_timeout) / tick) + 2
+        self.wheel = TimerWheel(tick, slots, time.monotonic())
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def watch(self, close, ping=None):
+        """Starts watching a connection. Returns the Watch to stamp and unwatch."""
+        now = time.monotonic()
+        watch = Watch(close, ping, now)
+        timeout = self.login_timeout if ping is None else self.ping_interval
+        with self.lock:
+            self.wheel.schedule(watch, now + timeout)
+        return watch
+
+    def unwatch(self, watch):
+        with self.lock:
+            self.wheel.cancel(watch)
+
+    def wait_time(self):
+        """Seconds from now until just past the next tick, when reap() is due."""
+        return self.tick - time.monotonic() % self.tick + 0.001
+
+    def reap(self, now=None):
+        """
+        Pings and closes the connections that are due. Callbacks run outside
+        the lock. Returns (pinged, closed) counts.
+        """
+        now = time.monotonic() if now is None else now
+        pings = []
+        closes = []
+        with self.lock:
+            for watch in self.wheel.expire(now):
+                idle = now - watch.last_seen
+                if watch.ping is None:
+                    if idle >= self.login_timeout:
+                        closes.append(watch)
+                        continue
+                    deadline = watch.last_seen + self.login_timeout
+                elif idle < self.ping_interval:
+                    deadline = watch.last_seen + self.ping_interval
+                elif idle < self.idle_timeout:
+                    pings.append(watch)
+                    deadline = watch.last_seen + self.idle_timeout
+                else:
+                    closes.append(watch)
+                    continue
+                self.wheel.schedule(watch, deadline)
+
+        for watch in pings:
+            watch.ping()
+        for watch in closes:
+            watch.close()
+        return len(pings), len(closes)
@@ -0,0 +1,156 @@
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, deque
+
+# Default memory limits
+DEFAULT_PUBLIC_SIZE = 1000  # Recent broadcasts kept in memory
+DEFAULT_PRIVATE_SIZE = 200  # Recent messages kept per private conversation
+DEFAULT_MAX_CONVERSATIONS = 1000  # Private conversations kept (LRU)
+
+
+class MessageRing:
+    """
+    Bounded, id-ordered suffix of one message stream.
+    Rows are (id, sender, content, timestamp) tuples.
+    """
+
+    def __init__(self, size):
+        self.rows = deque(maxlen=size)
+        # True while the ring holds the entire stream, so a short page
+        # really means "no older messages" rather than "not cached"
+        self.complete = False
+
+    def append(self, row):
+        if len(self.rows) == self.rows.maxlen:
+            self.complete = False
+        self.rows.append(row)
+
+    def load(self, rows, complete):
+        """Merges rows read from the database with what is already cached."""
+        merged = {row[0]: row for row in rows}
+        merged.update((row[0], row) for row in self.rows)
+        ordered = sorted(merged.values())
+        self.complete = complete and len(ordered) <= self.rows.maxlen
+        self.rows.clear()
+        self.rows.extend(ordered)
+
+    def page(self, limit, before_id=None):
+        """Returns up to limit rows older than before_id, or None if not cached."""
+        if before_id is None:
+            end = len(self.rows)
+        else:
+            end = bisect_left(self.rows, before_id, key=lambda row: row[0])
+        start = end - limit
+        if start < 0:
+            if not self.complete:
+                return None
+            start = 0
+        return [self.rows[i] for i in range(start, end)]
+
+
+class HistoryCache:
+    """
+    In-memory recent history: one ring for public broadcasts and an LRU set
+    of per-conversation rings for private messages. Keeps logins and recent
+    pages out of SQLite, older pages fall back to the database.
+    A size of 0 disables that part of the cache.
+    """
+
+    def __init__(
+        self,
+        public_size=DEFAULT_PUBLIC_SIZE,
+        private_size=DEFAULT_PRIVATE_SIZE,
+        max_conversations=DEFAULT_MAX_CONVERSATIONS,
+    ):
+        self.public_size = public_size
+        self.private_size = private_size
+        self.max_conversations = max_conversations
+
+        self.public = MessageRing(public_size) if public_size > 0 else None
+        self.private = OrderedDict()  # (user_a, user_b) -> MessageRing, LRU order
+        self.lock = threading.Lock()
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def conversation_key(user1, user2):
+        return tuple(sorted((user1, user2)))
+
+    def add_public(self, row):
+        if self.public is None:
+            return
+        with self.lock:
+            self.public.append(row)
+
+    def add_private(self, user1, user2, row):
+        if self.private_size <= 0 or self.max_conversations <= 0:
+            return
+        with self.lock:
+            self.conversation_ring(self.conversation_key(user1, user2)).append(row)
+
+    def load_public(self, rows, complete):
+        if self.public is None:
+            return
+        with self.lock:
+            self.public.load(rows, complete)
+
+    def load_private(self, user1, user2, rows, complete):
+        if self.private_size <= 0 or self.max_conversations <= 0:
+            return
+        with self.lock:
+            key = self.conversation_key(user1, user2)
+            self.conversation_ring(key).load(rows, complete)
+
+    def public_page(self, limit, before_id=None):
+        """Rows from the public ring, or None on a miss."""
+        with self.lock:
+            rows = self.public.page(limit, before_id) if self.public else None
+            self.count(rows)
+            return rows
+
+    def private_page(self, user1, user2, limit, before_id=None):
+        """Rows from the conversation's ring, or None on a miss."""
+        with self.lock:
+            key = self.conversation_key(user1, user2)
+            ring = self.private.get(key)
+            rows = None
+            if ring is not None:
+                self.private.move_to_end(key)
+                rows = ring.page(limit, before_id)
+            self.count(rows)
+            return rows
+
+    def conversation_ring(self, key):
+        """Returns (creating if needed) a conversation ring. Caller holds the lock."""
+        ring = self.private.get(key)
+        if ring is None:
+            ring = MessageRing(self.private_size)
+            self.private[key] = ring
+            while len(self.private) > self.max_conversations:
+                self.private.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.private.move_to_end(key)
+        return ring
+
+    def count(self, rows):
+        if rows is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "public_rows": len(self.public.rows) if self.public else 0,
+                "conversations": len(self.private),
+                "private_rows": sum(len(ring.rows) for ring in self.private.values()),
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,51 @@
+import logging
+import threading
+import time
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+# Default cap on identical log lines (same logger and format string) per second
+DEFAULT_RATE_LIMIT = 20
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `rate` records per second for each distinct
+    (logger, message template) pair. What was dropped is reported on the
+    next record that gets through, so floods stay visible but cheap.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT):
+        super().__init__()
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.windows = {}  # key -> [window start, records in window, suppressed]
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= 1.0:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} (suppressed {suppressed} similar)"
+                return True
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def setup_logging(level="INFO", rate=DEFAULT_RATE_LIMIT):
+    """Configures the root logger: leveled, rate-limited output to stderr."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimitFilter(rate))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
@@ -0,0 +1,92 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds: 1us .. ~17s, doubling
+BUCKETS = tuple(1e-6 * 2**i for i in range(25))
+
+
+class Histogram:
+    """Latency histogram with fixed power-of-two buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # Last slot: above the top bucket
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given percentile, in seconds."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return (
+                    min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+                )
+        return self.max
+
+    def snapshot(self):
+        to_ms = 1000.0
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * to_ms if self.count else 0.0,
+            "p50_ms": self.percentile(0.50) * to_ms,
+            "p99_ms": self.percentile(0.99) * to_ms,
+            "max_ms": self.max * to_ms,
+        }
+
+
+class Metrics:
+    """
+    Thread-safe registry of named counters and latency histograms.
+    Cheap enough for the message hot path: one lock, no allocation per update.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Times the with-block into histogram `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_s": time.time() - self.started,
+                "counters": dict(self.counters),
+                "latency": {
+                    name: histogram.snapshot()
+                    for name, histogram in self.histograms.items()
+                },
+            }
@@ -1,180 +1,745 @@
+import argparse
+import ipaddress
+import logging
+import os
+import secrets
 import socket
 import threading
 import signal
 import sys
-from database import DatabaseManager
-from protocol import PORT, send_message, receive_message
+from database import (
+    DatabaseManager,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_FLUSH_INTERVAL,
+    DEFAULT_READERS,
+    DEFAULT_RETENTION_INTERVAL,
+    HISTORY_PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
+)
+from heartbeat import (
+    IdleReaper,
+    DEFAULT_IDLE_TIMEOUT,
+    DEFAULT_LOGIN_TIMEOUT,
+    DEFAULT_PING_INTERVAL,
+    PING_FRAME,
+    enable_keepalive,
+)
+from history_cache import (
+    HistoryCache,
+    DEFAULT_PUBLIC_SIZE,
+    DEFAULT_PRIVATE_SIZE,
+    DEFAULT_MAX_CONVERSATIONS,
+)
+from protocol import (
+    PORT,
+    CHANNEL_JOIN,
+    CHANNEL_LEAVE,
+    CHANNEL_JOINED,
+    CHANNEL_LEFT,
+    CHANNEL_LIST,
+    CHANNEL_NAME,
+    FEATURE_HEARTBEAT,
+    FEATURE_HISTORY_BATCH,
+    FEATURE_PRESENCE,
+    FEATURE_ZLIB,
+    FILE_DATA,
+    FILE_DONE,
+    FILE_GET,
+    FILE_OFFER,
+    FILE_OFFSET,
+    FILE_PUT,
+    FILE_READY,
+    HISTORY_REQUEST,
+    MAX_CHANNELS,
+    MAX_CONTENT_LENGTH,
+    PRESENCE_JOIN,
+    PRESENCE_LEAVE,
+    RESUME_LIMIT,
+    SEARCH,
+    USER_LIST_REQUEST,
+    FramedConnection,
+    build_history_frames,
+    build_history_page,
+    encode_message,
+    file_message,
+    history_messages,
+    is_channel,
+    missed_by_chat,
+    parse_content,
+    parse_file_offer,
+    parse_history_request,
+    parse_resume,
+    parse_search_request,
+    presence_event,
+    resumed,
+    search_results,
+    user_list_snapshot,
+    username_problem,
+)
+from session import (
+    ClientSession,
+    DEFAULT_QUEUE_SIZE,
+    OVERFLOW_DISCONNECT,
+    OVERFLOW_POLICIES,
+)
+from metrics import Metrics
+from logs import DEFAULT_RATE_LIMIT, setup_logging
+from transfer import (
+    DEFAULT_FILES_DIR,
+    DEFAULT_MAX_FILE_SIZE,
+    TRANSFER_TIMEOUT,
+    FileStore,
+    TransferError,
+)
 import time
 
+logger = logging.getLogger("chat.server")
+
 
 class ChatServer:
-    def __init__(self, host="0.0.0.0", port=PORT):
+    def __init__(
+        self,
+        host="0.0.0.0",
+        port=PORT,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        overflow_policy=OVERFLOW_DISCONNECT,
+        db=None,
+        reuse_port=False,
+        reaper=None,
+        files=None,
+    ):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Several processes accept on the same port, the kernel spreads connections
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((host, port))
         self.server_socket.listen()
 
-        self.clients = {}  # Maps username -> socket
-        self.sockets = {}  # Maps socket -> username
-        self.db = DatabaseManager()
+        self.clients = {}  # Maps username -> ClientSession
+        self.sockets = {}  # Maps FramedConnection -> username
+        self.clients_lock = threading.Lock()  # Guards username registration
+        # Every join/leave bumps the version; the lock keeps versions and the
+        # order their deltas are queued in step (re-entrant for subclasses)
+        self.presence_version = 0
+        self.presence_lock = threading.RLock()
+        # Channel -> {username: ClientSession} of its members connected here,
+        # so a channel message only visits its own members
+        self.channels = {}
+        self.channels_lock = threading.Lock()
+        self.db = db if db is not None else DatabaseManager()
+        # Closes connections that stopped talking (see heartbeat.py)
+        self.reaper = reaper if reaper is not None else IdleReaper()
+        # Shared files, moved over their own data connections (see transfer.py)
+        self.files = files if files is not None else FileStore()
         self.running = True
 
-        print(f"[STARTING] Server listens on {host}:{port}")
+        # Outbound queue settings applied to every new session
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+
+        self.metrics = Metrics()
+
+        logger.info("[STARTING] Server listens on %s:%s", host, port)
 
     def broadcast(self, message_dict, exclude_user=None):
-        """Send a message to all connected clients."""
-        for user, sock in self.clients.items():
-            if user != exclude_user:
-                send_message(sock, message_dict)
+        """Queue a message for all connected clients."""
+        # Encode once, every recipient gets the same immutable frame
+        with self.metrics.timer("frame_encode"):
+            frame = encode_message(message_dict)
+        self.broadcast_frame(frame, exclude_user)
+
+    def broadcast_frame(self, frame, exclude_user=None):
+        """Queue an already encoded frame for all connected clients."""
+        with self.metrics.timer("broadcast_fanout"):
+            recipients = 0
+            for user, session in list(self.clients.items()):
+                if user != exclude_user:
+                    session.send_frame(frame)
+                    recipients += 1
+        self.metrics.incr("fanout_frames", recipients)
+
+    def send_history(self, session, rows, to="all"):
+        """
+        Replays history rows (id, sender, content, timestamp) to one client.
+        `to` is the chat they belong to from that client's point of view:
+        'all' or the private conversation partner.
+        Clients that announced history_batch get a few HISTORY frames, older
+        clients get one MSG frame per message.
+        Blocks this client's own thread instead of overflowing its queue.
+        """
+        messages = history_messages(rows, to)
+
+        if FEATURE_HISTORY_BATCH in session.features:
+            compress = FEATURE_ZLIB in session.features
+            messages = build_history_frames(messages, to, compress)
+
+        for message in messages:
+            session.send(message, block=True)
+
+    def send_login_history(self, session, resume):
+        """
+        Sends a new login the latest group chat page. A resuming client
+        (resume = the newest message id it has) gets the messages of all
+        its chats after that id instead, then RESUMED.
+        """
+        if resume is None:
+            self.send_history(session, self.db.get_public_history())
+            return
+        rows, complete = self.db.get_missed_messages(
+            session.username, resume, RESUME_LIMIT
+        )
+        if complete:
+            for chat, messages in missed_by_chat(rows, session.username).items():
+                self.send_history(session, messages, chat)
+            self.metrics.incr("resumes")
+        else:
+            self.send_history(session, self.db.get_public_history())
+            self.metrics.incr("resume_fallbacks")
+        session.send(resumed(resume, len(rows), complete))
+
+    def queue_stats(self):
+        """Per-client outbound queue stats, most lagging clients first."""
+        stats = {user: session.stats() for user, session in list(self.clients.items())}
+        return dict(sorted(stats.items(), key=lambda item: -item[1]["depth"]))
+
+    def is_admin(self, address):
+        """Admin requests (STATS) are only answered on the loopback interface."""
+        try:
+            return ipaddress.ip_address(address[0]).is_loopback
+        except ValueError:
+            return False
+
+    def stats(self):
+        """Snapshot of server metrics, client queues and database statistics."""
+        db_stats = {}
+        if self.db.write_behind:
+            db_stats["write_behind"] = self.db.flush_stats()
+        if self.db.cache is not None:
+            db_stats["cache"] = self.db.cache.stats()
+        db_stats["users"] = self.db.user_stats()
+        db_stats["files"] = self.files.stats()
+        if self.db.retention_days:
+            db_stats["retention"] = self.db.retention_stats()
+        return {
+            "clients": len(self.clients),
+            "channels": len(self.channels),
+            "watched": len(self.reaper),
+            "metrics": self.metrics.snapshot(),
+            "queues": self.queue_stats(),
+            "db": db_stats,
+        }
 
     def handle_client(self, client_socket, address):
         """Thread function to handle a single client connection."""
-        print(f"[NEW CONNECTION] {address} connected.")
+        logger.info("[NEW CONNECTION] %s connected.", address)
+        enable_keepalive(client_socket)
         username = None
+        session = None
+        conn = FramedConnection(client_socket, metrics=self.metrics)
+        # Until LOGIN arrives the connection only has login_timeout to live
+        watch = self.reaper.watch(conn.shutdown)
 
         try:
+            first_msg = conn.receive()
+            self.reaper.unwatch(watch)
+            watch = None
+
+            # Admin tools may ask for STATS instead of logging in
+            if first_msg and first_msg.get("type") == "STATS":
+                self.handle_stats(conn, address)
+                conn.close()
+                return
+
+            # File data travels over separate connections, never the chat one
+            if first_msg and first_msg.get("type") in (FILE_PUT, FILE_GET):
+                self.handle_transfer(conn, first_msg, address)
+                conn.close()
+                return
+
+            # Other servers open federation links on the same port
+            if first_msg and first_msg.get("type") == "PEER_HELLO":
+                self.accept_peer(conn, first_msg, address)
+                conn.close()
+                return
+
             # First message should be LOGIN
-            first_msg = receive_message(client_socket)
             if first_msg and first_msg.get("type") == "LOGIN":
+                login_started = time.perf_counter()
                 username = first_msg.get("content")
 
-                # Check if username taken
-                if username in self.clients:
-                    send_message(
-                        client_socket, {"type": "ERROR", "content": "Username taken"}
-                    )
-                    client_socket.close()
+                # Check if username taken (or otherwise not allowed)
+                error = self.username_error(username)
+                if error:
+                    conn.send({"type": "ERROR", "content": error})
+                    conn.close()
                     return
 
                 # Check IP Restriction
                 client_ip = address[0]
                 stored_ip = self.db.get_user_ip(username)
                 if stored_ip and stored_ip != client_ip:
-                    print(
-                        f"[REJECTED] {username} from {client_ip} (Expected: {stored_ip})"
+                    logger.warning(
+                        "[REJECTED] %s from %s (Expected: %s)",
+                        username,
+                        client_ip,
+                        stored_ip,
                     )
-                    send_message(
-                        client_socket,
+                    conn.send(
                         {
                             "type": "ERROR",
                             "content": f"Access Denied: Account bound to {stored_ip}",
                         },
                     )
-                    client_socket.close()
+                    conn.close()
                     return
 
-                # Register user
-                self.clients[username] = client_socket
-                self.sockets[client_socket] = username
+                # Register user (re-checked, another thread may have claimed
+                # the name while we were in the database)
+                session = ClientSession(
+                    username,
+                    conn,
+                    self.queue_size,
+                    self.overflow_policy,
+                    first_msg.get("features", ()),
+                )
+                if not self.register_session(session):
+                    conn.send({"type": "ERROR", "content": "Username taken"})
+                    session.close()
+                    session = None
+                    conn.close()
+                    return
+                self.sockets[conn] = username
+                if FEATURE_HEARTBEAT in session.features:
+                    # Never blocks the reaper, even under OVERFLOW_BLOCK
+                    watch = self.reaper.watch(
+                        session.close,
+                        lambda: session.send_frame(PING_FRAME, block=False),
+                    )
                 self.db.add_user(username, client_ip)
 
-                print(f"[LOGIN] User: {username}")
+                logger.info("[LOGIN] User: %s", username)
+                self.metrics.incr("logins")
 
                 # Send welcome & History
-                send_message(
-                    client_socket, {"type": "INFO", "content": f"Welcome {username}!"}
-                )
+                session.send({"type": "INFO", "content": f"Welcome {username}!"})
 
                 # Send User List to everyone
-                user_list = list(self.clients.keys())
-                self.broadcast({"type": "USER_LIST", "content": user_list})
-                # Send User List to self (broadcast does it, but just in case)
-
-                # Retrieve and send public history
-                history = self.db.get_public_history()
-                for sender, content, timestamp in history:
-                    send_message(
-                        client_socket,
-                        {
-                            "type": "MSG",
-                            "from": sender,
-                            "to": "all",
-                            "content": content,
-                            "timestamp": timestamp,
-                        },
-                    )
+                self.announce_login(username)
+
+                # Back into the channels this user is a member of
+                channels = self.db.get_channels(username)
+                self.subscribe(session, channels)
+                session.send({"type": CHANNEL_LIST, "content": channels})
+
+                # Public history, or only what a reconnecting client missed
+                with self.metrics.timer("history_replay"):
+                    self.send_login_history(session, parse_resume(first_msg))
+                self.metrics.observe("login", time.perf_counter() - login_started)
             else:
-                print(f"[ERROR] {address} did not send LOGIN.")
-                client_socket.close()
+                logger.warning("[ERROR] %s did not send LOGIN.", address)
+                conn.close()
                 return
 
             # Main Loop
             while self.running:
-                msg = receive_message(client_socket)
+                msg = conn.receive()
                 if msg is None:
                     break  # Connection closed
-
-                msg_type = msg.get("type")
-                content = msg.get("content")
-                recipient = msg.get("to")  # 'all' or specific username
-
-                if msg_type == "MSG":
-                    if recipient == "all":
-                        # Broadcast
-                        print(f"[{username} -> ALL]: {content}")
-                        self.db.store_message(username, "all", "BROADCAST", content)
-                        self.broadcast(
-                            {
-                                "type": "MSG",
-                                "from": username,
-                                "to": "all",
-                                "content": content,
-                            }
-                        )
-                    else:
-                        # Private Message
-                        target_sock = self.clients.get(recipient)
-                        if target_sock:
-                            print(f"[{username} -> {recipient}]: {content}")
-                            self.db.store_message(
-                                username, recipient, "PRIVATE", content
-                            )
-                            # Send to recipient
-                            send_message(
-                                target_sock,
-                                {
-                                    "type": "MSG",
-                                    "from": username,
-                                    "to": recipient,
-                                    "content": content,
-                                    "private": True,
-                                },
-                            )
-                            # Send back to sender so they see it in their UI
-                            send_message(
-                                client_socket,
-                                {
-                                    "type": "MSG",
-                                    "from": username,
-                                    "to": recipient,
-                                    "content": content,
-                                    "private": True,
-                                },
-                            )
-                        else:
-                            send_message(
-                                client_socket,
-                                {
-                                    "type": "ERROR",
-                                    "content": f"User {recipient} not found.",
-                                },
-                            )
+                if watch is not None:
+                    watch.seen()
+                self.handle_message(username, session, msg, address)
 
         except Exception as e:
-            print(f"[EXCEPTION] {address}: {e}")
+            logger.exception("[EXCEPTION] %s: %s", address, e)
         finally:
             # Cleanup
-            print(f"[DISCONNECT] {address} {username}")
-            if username in self.clients:
-                del self.clients[username]
-            if client_socket in self.sockets:
-                del self.sockets[client_socket]
-            client_socket.close()
-            # self.broadcast({"type": "USER_LIST", "content": list(self.clients.keys())})
-            # Update user lists
+            logger.info("[DISCONNECT] %s %s", address, username)
+            if watch is not None:
+                self.reaper.unwatch(watch)
+            if session is not None:
+                self.metrics.incr("disconnects")
+                session.close()
+                self.unregister_session(session)
+            if conn in self.sockets:
+                del self.sockets[conn]
+            conn.close()
+
+    def register_session(self, session):
+        """Claims the session's username. Returns False if it is taken."""
+        with self.clients_lock:
+            if session.username in self.clients:
+                return False
+            self.clients[session.username] = session
+            return True
+
+    def unregister_session(self, session):
+        with self.clients_lock:
+            if self.clients.get(session.username) is not session:
+                return
+            del self.clients[session.username]
+        self.unsubscribe(session, list(session.channels))
+        self.announce_logout(session.username)
+
+    def username_error(self, username):
+        """Why a LOGIN name cannot be used, or None if it can."""
+        error = username_problem(username)
+        if error:
+            return error
+        if username in self.clients:
+            return "Username taken"
+        return None
+
+    def user_list(self):
+        return list(self.clients.keys())
+
+    def announce_login(self, username):
+        """Sends the new client the full user list and everyone else a join."""
+        self.presence_changed(PRESENCE_JOIN, [username], self.clients.get(username))
+
+    def announce_logout(self, username):
+        self.presence_changed(PRESENCE_LEAVE, [username])
+
+    def presence_changed(self, event, users, new_session=None):
+        """Publishes one versioned presence event per user in `users`."""
+        with self.presence_lock:
+            for user in users:
+                self.presence_version += 1
+                self.send_presence(event, user, new_session)
+
+    def send_presence(self, event, user, new_session=None):
+        """
+        Queues the delta for the current presence_version to every client.
+        Clients without FEATURE_PRESENCE get the full list instead, and so
+        does `new_session`, a client that just logged in.
+        Caller holds presence_lock.
+        """
+        delta = encode_message(presence_event(event, user, self.presence_version))
+        snapshot = None
+        for session in list(self.clients.values()):
+            if session is new_session:
+                continue
+            if FEATURE_PRESENCE in session.features:
+                session.send_frame(delta)
+                continue
+            if snapshot is None:
+                snapshot = encode_message(self.user_list_message())
+            session.send_frame(snapshot)
+        if new_session is not None:
+            new_session.send(self.user_list_message())
+        self.metrics.incr("presence_events")
+
+    def user_list_message(self):
+        """USER_LIST snapshot. Caller holds presence_lock."""
+        return user_list_snapshot(self.user_list(), self.presence_version)
+
+    def accept_peer(self, conn, hello, address):
+        """Federation link request; see FederatedServer."""
+        logger.warning("[REJECTED] Peer link from %s, federation is off", address)
+        conn.send({"type": "ERROR", "content": "Federation is not enabled"})
+
+    def handle_message(self, username, session, msg, address):
+        """Dispatches one message from a logged-in client."""
+        msg_type = msg.get("type")
+
+        if msg_type == "MSG":
+            if parse_content(msg) is None:
+                session.send(
+                    {
+                        "type": "ERROR",
+                        "content": f"Messages are limited to {MAX_CONTENT_LENGTH} characters",
+                    }
+                )
+                return
+            self.handle_chat_message(username, session, msg)
+        elif msg_type == HISTORY_REQUEST:
+            self.handle_history_request(username, session, msg)
+        elif msg_type in (CHANNEL_JOIN, CHANNEL_LEAVE):
+            self.handle_channel_request(username, session, msg)
+        elif msg_type == SEARCH:
+            self.handle_search(username, session, msg)
+        elif msg_type == FILE_OFFER:
+            self.handle_file_offer(username, session, msg)
+        elif msg_type == USER_LIST_REQUEST:
+            # The client missed a presence version, resend the whole list
+            with self.presence_lock:
+                session.send(self.user_list_message())
+        elif msg_type == "STATS":
+            self.handle_stats(session, address)
+
+    def handle_chat_message(self, username, session, msg):
+        content = msg.get("content")
+        recipient = msg.get("to")  # 'all' or specific username
+
+        if recipient == "all":
+            # Broadcast
+            logger.debug("[%s -> ALL]: %s", username, content)
+            with self.metrics.timer("db_store"):
+                message_id = self.db.store_message(
+                    username, "all", "BROADCAST", content
+                )
+            self.metrics.incr("messages_broadcast")
+            self.broadcast(
+                {
+                    "type": "MSG",
+                    "id": message_id,
+                    "from": username,
+                    "to": "all",
+                    "content": content,
+                }
+            )
+        elif is_channel(recipient):
+            self.handle_channel_message(username, session, recipient, content)
+        else:
+            # Private Message
+            target_session = self.clients.get(recipient)
+            if target_session:
+                logger.debug("[%s -> %s]: %s", username, recipient, content)
+                with self.metrics.timer("db_store"):
+                    message_id = self.db.store_message(
+                        username, recipient, "PRIVATE", content
+                    )
+                self.metrics.incr("messages_private")
+                frame = encode_message(
+                    {
+                        "type": "MSG",
+                        "id": message_id,
+                        "from": username,
+                        "to": recipient,
+                        "content": content,
+                        "private": True,
+                    }
+                )
+                # Send to recipient, and back to sender so they see it in their UI
+                target_session.send_frame(frame)
+                session.send_frame(frame)
+            else:
+                session.send(
+                    {
+                        "type": "ERROR",
+                        "content": f"User {recipient} not found.",
+                    },
+                )
+
+    def handle_channel_message(self, username, session, channel, content):
+        if channel not in session.channels:
+            session.send({"type": "ERROR", "content": f"Join {channel} first."})
+            return
+        logger.debug("[%s -> %s]: %s", username, channel, content)
+        with self.metrics.timer("db_store"):
+            message_id = self.db.store_message(username, channel, "CHANNEL", content)
+        self.metrics.incr("messages_channel")
+        self.send_channel_frame(
+            channel,
+            encode_message(
+                {
+                    "type": "MSG",
+                    "id": message_id,
+                    "from": username,
+                    "to": channel,
+                    "content": content,
+                }
+            ),
+        )
+
+    def send_channel_frame(self, channel, frame):
+        """Queues an encoded frame for the members of a channel connected here."""
+        with self.metrics.timer("channel_fanout"):
+            with self.channels_lock:
+                members = list(self.channels.get(channel, {}).values())
+            for session in members:
+                session.send_frame(frame)
+        self.metrics.incr("fanout_frames", len(members))
+
+    def handle_channel_request(self, username, session, msg):
+        """JOIN or LEAVE a channel. Memberships are stored and outlive the session."""
+        channel = msg.get("channel")
+        if not isinstance(channel, str) or not CHANNEL_NAME.fullmatch(channel):
+            session.send(
+                {
+                    "type": "ERROR",
+                    "content": "Channel names are # and up to 32 letters, digits, _ or -",
+                }
+            )
+            return
+        if msg.get("type") == CHANNEL_JOIN:
+            if (
+                channel not in session.channels
+                and len(session.channels) >= MAX_CHANNELS
+            ):
+                session.send(
+                    {
+                        "type": "ERROR",
+                        "content": f"You can be in at most {MAX_CHANNELS} channels",
+                    }
+                )
+                return
+            self.db.join_channel(username, channel)
+            self.subscribe(session, [channel])
+            session.send({"type": CHANNEL_JOINED, "channel": channel})
+        else:
+            self.db.leave_channel(username, channel)
+            self.unsubscribe(session, [channel])
+            session.send({"type": CHANNEL_LEFT, "channel": channel})
+
+    def subscribe(self, session, channels):
+        with self.channels_lock:
+            for channel in channels:
+                self.channels.setdefault(channel, {})[session.username] = session
+                session.channels.add(channel)
+
+    def unsubscribe(self, session, channels):
+        with self.channels_lock:
+            for channel in channels:
+                session.channels.discard(channel)
+                members = self.channels.get(channel)
+                if members is None or members.get(session.username) is not session:
+                    continue
+                del members[session.username]
+                if not members:
+                    del self.channels[channel]
+
+    def handle_history_request(self, username, session, msg):
+        """Sends one page of older messages of a chat ('all' or a partner)."""
+        request = parse_history_request(msg, HISTORY_PAGE_SIZE)
+        if request is None:
+            session.send({"type": "ERROR", "content": "Bad history request"})
+            return
+        chat, before_id, limit = request
+
+        if is_channel(chat) and chat not in session.channels:
+            session.send({"type": "ERROR", "content": f"Join {chat} first."})
+            return
+
+        with self.metrics.timer("history_page"):
+            if chat == "all":
+                rows = self.db.get_public_history(limit, before_id)
+            elif is_channel(chat):
+                rows = self.db.get_channel_history(chat, limit, before_id)
+            else:
+                rows = self.db.get_private_history(username, chat, limit, before_id)
+        compress = FEATURE_ZLIB in session.features
+        session.send(build_history_page(rows, chat, before_id, compress), block=True)
+
+    def handle_search(self, username, session, msg):
+        """Answers a SEARCH with one page of ranked hits the user may see."""
+        request = parse_search_request(msg, SEARCH_PAGE_SIZE)
+        if request is None:
+            session.send({"type": "ERROR", "content": "Bad search request"})
+            return
+        query, offset, limit = request
+
+        with self.metrics.timer("search"):
+            rows, more = self.db.search_messages(username, query, limit, offset)
+        session.send(search_results(rows, query, offset, more), block=True)
+
+    def handle_file_offer(self, username, session, msg):
+        """Registers a file to share in a chat; FILE_READY says how to upload it."""
+        offer = parse_file_offer(msg, self.files.max_size)
+        if offer is None:
+            session.send({"type": "ERROR", "content": "Bad file offer"})
+            return
+        to, name, size = offer
+        if is_channel(to) and to not in session.channels:
+            session.send({"type": "ERROR", "content": f"Join {to} first."})
+            return
+        if to != "all" and not is_channel(to) and to not in self.user_list():
+            session.send({"type": "ERROR", "content": f"User {to} not found."})
+            return
+        key = secrets.token_hex(16)
+        file_id = self.db.add_file(username, to, name, size, key)
+        if file_id is None:
+            session.send({"type": "ERROR", "content": "Could not store the file"})
+            return
+        logger.info("[FILE] %s offers %s (%d bytes) to %s", username, name, size, to)
+        session.send(
+            {"type": FILE_READY, "file_id": file_id, "key": key, "ref": msg.get("ref")}
+        )
+
+    def handle_transfer(self, conn, msg, address):
+        """
+        A data connection: receives (FILE_PUT) or sends (FILE_GET) the bytes
+        of one file, on this connection's own thread, so chat traffic never
+        waits for it.
+        """
+        row = self.db.get_file(msg.get("file_id"))
+        error = self.files.transfer_error(row, msg)
+        if error:
+            conn.send({"type": "ERROR", "content": error})
+            return
+        file_id, sender, recipient, name, size, key, _ = row
+        conn.sock.settimeout(TRANSFER_TIMEOUT)
+        try:
+            if msg.get("type") == FILE_GET:
+                offset = msg.get("offset", 0)
+                conn.send(
+                    {"type": FILE_DATA, "name": name, "size": size, "offset": offset}
+                )
+                with self.metrics.timer("file_download"):
+                    self.files.send(conn.sock, file_id, offset, size)
+                return
+
+            part = self.files.begin_upload(file_id)
+            if part is None:
+                conn.send({"type": "ERROR", "content": "Upload already running"})
+                return
+            try:
+                conn.send({"type": FILE_OFFSET, "offset": self.files.received(part)})
+                with self.metrics.timer("file_upload"):
+                    done = self.files.receive(conn.sock, part, file_id, size)
+            finally:
+                self.files.end_upload(file_id, part)
+            if done:
+                self.db.complete_file(file_id)
+                conn.send({"type": FILE_DONE, "file_id": file_id})
+                self.file_uploaded(sender, recipient, name, size, file_id, key)
+        except (OSError, TransferError) as e:
+            logger.warning(
+                "[FILE] Transfer of file %s with %s broke off: %s", file_id, address, e
+            )
+
+    def file_uploaded(self, sender, recipient, name, size, file_id, key):
+        """Announces a complete upload in its chat, as a message from its sender."""
+        logger.info("[FILE] %s uploaded %s (%d bytes)", sender, name, size)
+        self.metrics.incr("files_shared")
+        session = self.clients.get(sender)
+        if session is None:
+            logger.warning("[FILE] %s left before %s was uploaded", sender, name)
+            return
+        self.handle_chat_message(
+            sender,
+            session,
+            {
+                "type": "MSG",
+                "to": recipient,
+                "content": file_message(name, size, file_id, key),
+            },
+        )
+
+    def handle_stats(self, sender, address):
+        """Answers a STATS request; sender is a FramedConnection or ClientSession."""
+        if not self.is_admin(address):
+            sender.send(
+                {"type": "ERROR", "content": "STATS is restricted to localhost"}
+            )
+            return
+        sender.send({"type": "STATS", "content": self.stats()})
+
+    def reap_loop(self):
+        """Pings quiet clients and disconnects dead ones, once per reaper tick."""
+        while self.running:
+            time.sleep(self.reaper.wait_time())
+            with self.metrics.timer("reaper_tick"):
+                pinged, closed = self.reaper.reap()
+            if pinged:
+                self.metrics.incr("heartbeat_pings", pinged)
+            if closed:
+                self.metrics.incr("reaped", closed)
+                logger.info("[REAPER] Closed %d idle connections", closed)
 
     def start(self):
-        print("[SERVER CONNECTED] Waiting for connections...")
+        threading.Thread(target=self.reap_loop, name="reaper", daemon=True).start()
+        logger.info("[SERVER CONNECTED] Waiting for connections...")
         while self.running:
             try:
                 client_sock, addr = self.server_socket.accept()
@@ -188,9 +753,237 @@ class ChatServer:
 
 
 if __name__ == "__main__":
-    server = ChatServer()
+    parser = argparse.ArgumentParser(description="LAN chat server")
+    parser.add_argument(
+        "--mode",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="threaded: one thread per client (default), asyncio: single event loop",
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="max frames queued per client before the overflow policy applies",
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        choices=OVERFLOW_POLICIES,
+        default=OVERFLOW_DISCONNECT,
+        help="what to do when a slow client's queue is full (threaded mode)",
+    )
+    parser.add_argument(
+        "--write-behind",
+        action="store_true",
+        help="queue messages in memory and commit them to SQLite in batches",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="write-behind: flush once this many messages are queued",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=DEFAULT_FLUSH_INTERVAL,
+        help="write-behind: max seconds a message waits before being flushed",
+    )
+    parser.add_argument(
+        "--cache-public",
+        type=int,
+        default=DEFAULT_PUBLIC_SIZE,
+        help="recent broadcasts kept in memory for history (0 disables)",
+    )
+    parser.add_argument(
+        "--cache-private",
+        type=int,
+        default=DEFAULT_PRIVATE_SIZE,
+        help="recent messages kept in memory per private conversation (0 disables)",
+    )
+    parser.add_argument(
+        "--cache-conversations",
+        type=int,
+        default=DEFAULT_MAX_CONVERSATIONS,
+        help="private conversations kept in memory, least recently used evicted",
+    )
+    parser.add_argument(
+        "--db-readers",
+        type=int,
+        default=DEFAULT_READERS,
+        help="read-only SQLite connections for lookups and history queries",
+    )
+    parser.add_argument(
+        "--retention-days",
+        type=float,
+        default=0,
+        help="move messages older than this into compressed archive segments (0 keeps all)",
+    )
+    parser.add_argument(
+        "--retention-interval",
+        type=float,
+        default=DEFAULT_RETENTION_INTERVAL,
+        help="seconds between archive passes",
+    )
+    parser.add_argument(
+        "--archive-dir",
+        help="where archive segments are kept (default: chat_history-archive next to the database)",
+    )
+    parser.add_argument(
+        "--files-dir",
+        default=DEFAULT_FILES_DIR,
+        help="where shared files are stored",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=DEFAULT_MAX_FILE_SIZE,
+        help="largest file that can be shared, in bytes",
+    )
+    parser.add_argument(
+        "--file-rate",
+        type=int,
+        default=0,
+        help="bytes per second each file upload or download may use (0 = unlimited)",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="DEBUG logs every message (slow), WARNING or above for production",
+    )
+    parser.add_argument(
+        "--log-rate",
+        type=int,
+        default=DEFAULT_RATE_LIMIT,
+        help="max identical log lines per second (0 = unlimited)",
+    )
+    parser.add_argument(
+        "--ping-interval",
+        type=float,
+        default=DEFAULT_PING_INTERVAL,
+        help="seconds of silence before a heartbeat client is sent PING",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help="seconds of silence (no PONG either) before a heartbeat client is dropped",
+    )
+    parser.add_argument(
+        "--login-timeout",
+        type=float,
+        default=DEFAULT_LOGIN_TIMEOUT,
+        help="seconds a new connection has to send LOGIN",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="run N worker processes sharing the port (threaded mode, SO_REUSEPORT)",
+    )
+    parser.add_argument(
+        "--node", help="federation: this server's name, enables peer links"
+    )
+    parser.add_argument(
+        "--peer",
+        action="append",
+        default=[],
+        metavar="HOST:PORT",
+        help="federation: peer server to link to (repeatable)",
+    )
+    parser.add_argument(
+        "--peer-secret",
+        default=os.environ.get("CHAT_PEER_SECRET"),
+        help="federation: secret shared by all nodes (default: $CHAT_PEER_SECRET)",
+    )
+    args = parser.parse_args()
+    if args.peer and not args.node:
+        parser.error("--peer needs --node")
+    if args.node and not args.peer_secret:
+        parser.error("--node needs --peer-secret or CHAT_PEER_SECRET")
+    if args.node and (args.workers or args.mode == "asyncio"):
+        parser.error("federation runs on the threaded single-process server")
+    if args.workers and args.mode == "asyncio":
+        parser.error(
+            "--workers runs threaded workers, it cannot be combined with asyncio"
+        )
+    if args.workers and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers needs SO_REUSEPORT, which this platform lacks")
+    if args.idle_timeout <= args.ping_interval:
+        parser.error("--idle-timeout must be longer than --ping-interval")
+    setup_logging(args.log_level, args.log_rate)
+
+    cache = HistoryCache(
+        args.cache_public, args.cache_private, args.cache_conversations
+    )
+    db = DatabaseManager(
+        write_behind=args.write_behind,
+        batch_size=args.batch_size,
+        flush_interval=args.flush_interval,
+        cache=None if args.workers else cache,  # Workers keep their own
+        readers=args.db_readers,
+        retention_days=args.retention_days,
+        retention_interval=args.retention_interval,
+        archive_dir=args.archive_dir,
+    )
+
+    reaper = IdleReaper(args.ping_interval, args.idle_timeout, args.login_timeout)
+    files = FileStore(args.files_dir, args.file_rate, args.max_file_size)
+
+    server = None
+    if args.workers:
+        # The hub in this process stores messages, the workers serve clients
+        from cluster import run_cluster
+    elif args.mode == "asyncio":
+        from async_server import AsyncChatServer
+
+        server = AsyncChatServer(
+            args.host, args.port, db=db, reaper=reaper, files=files
+        )
+    elif args.node:
+        from federation import FederatedServer
+
+        server = FederatedServer(
+            args.node,
+            args.peer_secret,
+            args.peer,
+            args.host,
+            args.port,
+            args.queue_size,
+            args.overflow_policy,
+            db=db,
+            reaper=reaper,
+            files=files,
+        )
+    else:
+        server = ChatServer(
+            args.host,
+            args.port,
+            args.queue_size,
+            args.overflow_policy,
+            db=db,
+            reaper=reaper,
+            files=files,
+        )
+
+    # Turn SIGTERM into a normal exit so queued messages get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     try:
-        server.start()
+        if server is None:
+            run_cluster(args, db)
+        else:
+            server.start()
     except KeyboardInterrupt:
-        print("Server stopping...")
-        server.running = False
+        logger.info("Server stopping...")
+        if server is not None:
+            server.running = False
+    finally:
+        db.close()
+        if db.write_behind:
+            logger.info("[DB] Write-behind stats: %s", db.flush_stats())
+        if db.cache is not None:
+            logger.info("[DB] History cache stats: %s", cache.stats())
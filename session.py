@@ -0,0 +1,147 @@
+import logging
+import threading
+from collections import deque
+from protocol import encode_message
+
+# What to do when a client's outbound queue is full
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # Discard the oldest queued frame
+OVERFLOW_DISCONNECT = "disconnect"  # Drop the slow consumer
+OVERFLOW_BLOCK = "block"  # Make the sender wait for room
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT, OVERFLOW_BLOCK)
+
+DEFAULT_QUEUE_SIZE = 1024
+
+logger = logging.getLogger("chat.session")
+
+# Upper bound on how many bytes the writer joins into a single sendall
+MAX_WRITE_BATCH = 256 * 1024
+
+
+class ClientSession:
+    """
+    Outbound side of one connected client.
+
+    Frames are queued in a bounded deque and written by a dedicated writer
+    thread, so a client with a full TCP window only delays its own queue
+    instead of every broadcast and the sender's read loop.
+    """
+
+    def __init__(
+        self,
+        username,
+        conn,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        overflow_policy=OVERFLOW_DISCONNECT,
+        features=(),
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+
+        self.username = username
+        self.conn = conn
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.features = set(features)  # Protocol features announced at LOGIN
+        self.channels = set()  # Channels this client is subscribed to
+
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # Stats
+        self.max_depth = 0
+        self.sent = 0
+        self.dropped = 0
+
+        self.writer = threading.Thread(
+            target=self.write_loop, name=f"writer-{username}", daemon=True
+        )
+        self.writer.start()
+
+    def send(self, message_dict, block=None):
+        """Encodes and queues a message. See send_frame."""
+        return self.send_frame(encode_message(message_dict), block)
+
+    def send_frame(self, frame, block=None):
+        """
+        Queues an encoded frame for delivery.
+        block=True waits for room whatever the policy (used for history replay
+        from the client's own thread). Returns False if the frame was not queued.
+        """
+        if block is None:
+            block = self.overflow_policy == OVERFLOW_BLOCK
+
+        with self.cond:
+            if self.closed:
+                return False
+
+            if len(self.queue) >= self.queue_size:
+                if block:
+                    while len(self.queue) >= self.queue_size and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return False
+                elif self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    logger.warning("[SLOW CONSUMER] Disconnecting %s", self.username)
+                    self.dropped += 1
+                    self._close_locked()
+                    return False
+
+            self.queue.append(frame)
+            if len(self.queue) > self.max_depth:
+                self.max_depth = len(self.queue)
+            self.cond.notify_all()
+            return True
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+
+                # Take everything pending (bounded) so one syscall carries many frames
+                batch = [self.queue.popleft()]
+                size = len(batch[0])
+                while self.queue and size < MAX_WRITE_BATCH:
+                    frame = self.queue.popleft()
+                    batch.append(frame)
+                    size += len(frame)
+                # Wake up senders waiting for room
+                self.cond.notify_all()
+
+            data = batch[0] if len(batch) == 1 else b"".join(batch)
+            if not self.conn.send_frame(data):
+                self.close()
+                return
+            self.sent += len(batch)
+
+    def close(self):
+        """Stops the writer and unblocks the client's read loop."""
+        with self.cond:
+            self._close_locked()
+
+    def _close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.cond.notify_all()
+        # Shutting down (not closing) the socket wakes the reader thread,
+        # which then runs the normal disconnect cleanup.
+        self.conn.shutdown()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.queue),
+                "max_depth": self.max_depth,
+                "capacity": self.queue_size,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "policy": self.overflow_policy,
+            }
@@ -0,0 +1,117 @@
+"""
+Sidebar state for the GUI client, kept free of Tk so it can be benchmarked
+headless. The client keeps one button per entry and applies only the
+differences computed here, and tracks who is online with PresenceRoster.
+"""
+
+from collections import namedtuple
+
+from protocol import PRESENCE_JOIN
+
+GROUP_CHAT = "all"
+
+ACTIVE_COLOR = ("#3B8ED0", "#1F6AA5")  # (light, dark) mode
+UNREAD_COLOR = "#C0392B"  # Red-ish for notification attention
+IDLE_COLOR = "transparent"
+
+# One sidebar button: key is 'all', a channel or the username
+Entry = namedtuple("Entry", "key text color")
+
+# removed: keys whose buttons go away; added / changed: Entry lists;
+# reorder: True if the buttons must be re-packed in entry order
+SidebarDiff = namedtuple("SidebarDiff", "removed added changed reorder")
+
+
+def sidebar_entries(
+    online_users, username, current_partner, unread_counts, channels=()
+):
+    """
+    The sidebar as it should look: group chat first, then the joined
+    channels, then every other user.
+    """
+    entries = [
+        Entry(
+            GROUP_CHAT,
+            "Group Chat",
+            ACTIVE_COLOR if current_partner == GROUP_CHAT else IDLE_COLOR,
+        )
+    ]
+    for key in list(channels) + list(online_users):
+        if key == username:
+            continue
+        # Label: "User" or "User (N)"
+        count = unread_counts.get(key, 0)
+        text = f"{key} ({count})" if count > 0 else key
+        if key == current_partner:
+            color = ACTIVE_COLOR
+        elif count > 0:
+            color = UNREAD_COLOR
+        else:
+            color = IDLE_COLOR
+        entries.append(Entry(key, text, color))
+    return entries
+
+
+class SidebarModel:
+    """Remembers what the sidebar shows and works out the minimal update."""
+
+    def __init__(self):
+        self.shown = {}  # key -> Entry currently displayed
+        self.order = []  # Keys in display order
+
+    def update(self, entries):
+        """Records entries as displayed and returns the SidebarDiff to get there."""
+        wanted = {entry.key: entry for entry in entries}
+        removed = [key for key in self.order if key not in wanted]
+        added = []
+        changed = []
+        for entry in entries:
+            shown = self.shown.get(entry.key)
+            if shown is None:
+                added.append(entry)
+            elif shown != entry:
+                changed.append(entry)
+
+        # New buttons are packed at the end; anything else needs a re-pack
+        kept = [key for key in self.order if key in wanted]
+        new_order = [entry.key for entry in entries]
+        reorder = kept + [entry.key for entry in added] != new_order
+
+        self.shown = wanted
+        self.order = new_order
+        return SidebarDiff(removed, added, changed, reorder)
+
+
+class PresenceRoster:
+    """
+    Online users as the client knows them: loaded from versioned USER_LIST
+    snapshots and kept current with PRESENCE deltas.
+    """
+
+    def __init__(self):
+        self.users = {}  # Ordered keys: usernames in sidebar order
+        self.version = None  # None until a snapshot arrives, or after a gap
+
+    def load(self, users, version):
+        self.users = dict.fromkeys(users)
+        self.version = version
+
+    def apply(self, event, user, version):
+        """
+        Applies one delta. Returns False if a version was skipped: the roster
+        then ignores deltas until the snapshot the caller should request.
+        """
+        if self.version is None or version <= self.version:
+            return True  # Waiting for a snapshot, or already included in it
+        if version != self.version + 1:
+            self.version = None
+            return False
+        self.version = version
+        if event == PRESENCE_JOIN:
+            self.users[user] = None
+        else:
+            self.users.pop(user, None)
+        return True
+
+    def online_users(self):
+        return list(self.users)
@@ -0,0 +1,32 @@
+import pytest
+
+from async_server import AsyncChatServer
+from database import DatabaseManager
+from server import ChatServer
+from transfer import FileStore
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A DatabaseManager on a scratch file, closed after the test."""
+    db = DatabaseManager(str(tmp_path / "chat.db"))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def async_server(db):
+    """An AsyncChatServer on the scratch database; tests run it with asyncio.run."""
+    server = AsyncChatServer(db=db)
+    yield server
+    server.db_executor.shutdown(wait=True)
+
+
+@pytest.fixture
+def chat_server(db, tmp_path):
+    """A ChatServer bound to a free local port; its accept loop is not started."""
+    server = ChatServer(
+        host="127.0.0.1", port=0, db=db, files=FileStore(str(tmp_path / "files"))
+    )
+    yield server
+    server.server_socket.close()
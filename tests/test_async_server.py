@@ -0,0 +1,111 @@
+import asyncio
+
+from protocol import MAX_CONTENT_LENGTH, encode_message
+
+
+async def login_at_once(server, username, count):
+    """Sends `count` LOGINs as `username` together; returns each first reply."""
+    listener = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    connections = [
+        await asyncio.open_connection("127.0.0.1", port) for _ in range(count)
+    ]
+    for _, writer in connections:
+        writer.write(encode_message({"type": "LOGIN", "content": username}))
+    replies = [
+        await asyncio.wait_for(server.receive_message(reader), 5)
+        for reader, _ in connections
+    ]
+    for _, writer in connections:
+        writer.close()
+    listener.close()
+    await listener.wait_closed()
+    return replies
+
+
+def test_concurrent_logins_with_the_same_name(async_server):
+    replies = asyncio.run(login_at_once(async_server, "alice", 2))
+    contents = sorted(reply["content"] for reply in replies)
+    assert contents == ["Username taken", "Welcome alice!"]
+
+
+async def read_broadcasts(server, reader, count):
+    """Reads until `count` broadcasts arrived; returns how many did."""
+    received = 0
+    while received < count:
+        msg = await server.receive_message(reader)
+        if msg is None:
+            break
+        if msg.get("type") == "MSG":
+            received += 1
+    return received
+
+
+async def broadcast_past_a_slow_reader(server, count, size):
+    listener = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    clients = {}
+    for name in ("slow", "fast", "sender"):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(encode_message({"type": "LOGIN", "content": name}))
+        await writer.drain()
+        clients[name] = (reader, writer)
+    # "slow" never reads; the sender and "fast" read everything
+    readers = [
+        asyncio.create_task(read_broadcasts(server, clients[name][0], count))
+        for name in ("fast", "sender")
+    ]
+    sender = clients["sender"][1]
+
+    async def exchange():
+        for _ in range(count):
+            sender.write(
+                encode_message({"type": "MSG", "to": "all", "content": "x" * size})
+            )
+            await sender.drain()
+        return await asyncio.gather(*readers)
+
+    try:
+        # A stalled fan-out would stop the server reading the sender too
+        received = await asyncio.wait_for(exchange(), 20)
+        slow_dropped = "slow" not in server.clients
+    finally:
+        for task in readers:
+            task.cancel()
+        for _, writer in clients.values():
+            writer.transport.abort()
+        listener.close()
+        await listener.wait_closed()
+    return received, slow_dropped
+
+
+def test_slow_reader_does_not_stall_broadcasts(async_server):
+    received, slow_dropped = asyncio.run(
+        broadcast_past_a_slow_reader(async_server, 800, MAX_CONTENT_LENGTH)
+    )
+    assert received == [800, 800]
+    assert slow_dropped
+
+
+async def send_too_long(server):
+    listener = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(encode_message({"type": "LOGIN", "content": "alice"}))
+        content = "x" * (MAX_CONTENT_LENGTH + 1)
+        writer.write(encode_message({"type": "MSG", "to": "all", "content": content}))
+        while True:
+            msg = await asyncio.wait_for(server.receive_message(reader), 5)
+            if msg["type"] in ("ERROR", "MSG"):
+                return msg
+    finally:
+        writer.close()
+        listener.close()
+        await listener.wait_closed()
+
+
+def test_overlong_messages_are_refused(async_server, db):
+    reply = asyncio.run(send_too_long(async_server))
+    assert reply["type"] == "ERROR"
+    assert db.get_public_history() == []
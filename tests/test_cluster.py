@@ -0,0 +1,35 @@
+import pytest
+
+from cluster import ClusterHub, ClusterWorker
+from database import DatabaseManager
+from session import OVERFLOW_BLOCK
+
+
+@pytest.fixture
+def cluster(tmp_path):
+    """A write-behind hub that holds messages back, and one worker on its bus."""
+    path = str(tmp_path / "chat.db")
+    hub_db = DatabaseManager(path, write_behind=True, flush_interval=3600)
+    hub = ClusterHub(hub_db, str(tmp_path / "bus.sock"))
+    hub.start()
+    worker_db = DatabaseManager(path)
+    worker = ClusterWorker(0, hub.path, "127.0.0.1", 0, 16, OVERFLOW_BLOCK, worker_db)
+    yield hub, worker
+    worker.server_socket.close()
+    worker.bus.close()
+    hub.close()
+    worker_db.close()
+    hub_db.close()
+
+
+def test_resume_sees_messages_the_hub_still_queues(cluster):
+    hub, worker = cluster
+    for i in range(3):
+        hub.relay_message(
+            {"type": "MSG", "from": "alice", "to": "all", "content": f"m{i}"}
+        )
+    assert worker.db.get_missed_messages("bob", 0, 100) == ([], True)
+    assert worker.flush_hub()
+    rows, complete = worker.db.get_missed_messages("bob", 0, 100)
+    assert complete
+    assert [row[4] for row in rows] == ["m0", "m1", "m2"]
@@ -0,0 +1,95 @@
+import threading
+import time
+
+from database import MAX_MESSAGE_ID, DatabaseManager
+from history_cache import HistoryCache
+
+
+def test_ids_keep_increasing_after_everything_was_archived(tmp_path):
+    path = str(tmp_path / "chat.db")
+    db = DatabaseManager(path)
+    ids = [db.store_message("alice", "all", "BROADCAST", f"m{i}") for i in range(5)]
+    assert db.archive_messages("9999-12-31 23:59:59") == 5
+    assert db.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 0
+    db.close()
+
+    db = DatabaseManager(path)
+    try:
+        new_id = db.store_message("alice", "all", "BROADCAST", "after restart")
+        assert new_id > max(ids)
+        page = db.get_public_history(10, MAX_MESSAGE_ID)
+        assert [row[0] for row in page] == ids + [new_id]
+    finally:
+        db.close()
+
+
+def test_failed_write_is_not_cached(tmp_path):
+    db = DatabaseManager(str(tmp_path / "chat.db"), cache=HistoryCache())
+    try:
+        first = db.store_message("alice", "all", "BROADCAST", "stored")
+        db.next_message_id = first  # The next INSERT hits the primary key
+        assert db.store_message("alice", "all", "BROADCAST", "phantom") is None
+        assert [row[2] for row in db.get_public_history()] == ["stored"]
+    finally:
+        db.close()
+
+
+def test_a_returning_login_is_one_memory_hit(db):
+    db.add_user("alice", "10.0.0.1")
+    before = db.user_stats()
+    # What a login does: look the user up, then register them
+    assert db.get_user_ip("alice") == "10.0.0.1"
+    db.add_user("alice", "10.0.0.1")
+    after = db.user_stats()
+    assert after["memory_hits"] == before["memory_hits"] + 1
+    assert after["db_reads"] == before["db_reads"]
+    assert after["db_writes"] == before["db_writes"]
+
+
+class YieldingCondition(threading.Condition):
+    """A Condition that lets other threads run just before it is taken."""
+
+    def __enter__(self):
+        time.sleep(0)
+        return super().__enter__()
+
+
+def test_write_behind_commits_ids_in_order(tmp_path, monkeypatch):
+    # Widens any gap between taking an id and queueing its row
+    monkeypatch.setattr(threading, "Condition", YieldingCondition)
+    db = DatabaseManager(
+        str(tmp_path / "chat.db"), write_behind=True, batch_size=3, flush_interval=0
+    )
+    monkeypatch.undo()
+    committed = []
+    write_batch = db.write_batch
+
+    def record(batch):
+        write_batch(batch)
+        committed.append(sorted(row[0] for row in batch))
+
+    monkeypatch.setattr(db, "write_batch", record)
+
+    def send(index):
+        for i in range(300):
+            db.store_message(f"user{index}", "all", "BROADCAST", f"m{i}")
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.flush()
+        # flush() returns once everything queued before it is committed
+        assert len(db.get_public_history(limit=8 * 300)) == 8 * 300
+    finally:
+        db.close()
+
+    # Whatever a reader sees after any commit is an unbroken run of ids, so
+    # a resume from the newest id it saw never skips an older one
+    seen = []
+    for batch in committed:
+        seen = sorted(seen + batch)
+        assert seen == list(range(seen[0], seen[0] + len(seen)))
+    assert len(seen) == 8 * 300
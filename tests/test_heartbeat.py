@@ -0,0 +1,106 @@
+import asyncio
+import socket
+
+import heartbeat
+from heartbeat import KEEPALIVE_IDLE, IdleReaper, enable_keepalive
+from protocol import encode_message
+
+
+def keepalive_settings(sock):
+    settings = [sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE) != 0]
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        settings.append(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE))
+    return settings
+
+
+def test_enable_keepalive():
+    listener = socket.create_server(("127.0.0.1", 0))
+    with listener, socket.create_connection(listener.getsockname()) as client:
+        accepted, _ = listener.accept()
+        with accepted:
+            enable_keepalive(accepted)
+            assert keepalive_settings(accepted) in ([True], [True, KEEPALIVE_IDLE])
+    # Not TCP: ignored rather than raised
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        enable_keepalive(ours)
+
+
+async def login_and_inspect(server):
+    listener = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(encode_message({"type": "LOGIN", "content": "legacy"}))
+    await server.receive_message(reader)  # The welcome
+    settings = keepalive_settings(server.clients["legacy"].get_extra_info("socket"))
+    writer.close()
+    listener.close()
+    await listener.wait_closed()
+    return settings
+
+
+def test_legacy_clients_get_keepalive(async_server):
+    settings = asyncio.run(login_and_inspect(async_server))
+    assert settings in ([True], [True, KEEPALIVE_IDLE])
+
+
+class FakeClock:
+    """Stands in for the time module inside heartbeat.py."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+
+def test_reaper_over_thousands_of_watches(monkeypatch):
+    clock = FakeClock(1000.25)
+    monkeypatch.setattr(heartbeat, "time", clock)
+    reaper = IdleReaper(ping_interval=30, idle_timeout=90, login_timeout=10)
+    events = []
+
+    def watch(kind, heartbeats=True):
+        index = len(events)
+        events.append([])
+
+        def record(event):
+            return lambda: events[index].append((event, clock.now))
+
+        ping = record("ping") if heartbeats else None
+        return kind, reaper.watch(record("close"), ping)
+
+    watches = [watch("anonymous", False) for _ in range(2000)]
+    watches += [watch("silent") for _ in range(2000)]
+    watches += [watch("talker") for _ in range(2000)]
+    start = clock.now
+    expire = reaper.wheel.expire
+    visited = []
+    monkeypatch.setattr(
+        reaper.wheel, "expire", lambda now: visited.append(expire(now)) or visited[-1]
+    )
+
+    for second in range(1, 121):
+        # Talkers are heard from between ticks
+        clock.now = start + second - 0.5
+        for kind, entry in watches:
+            if kind == "talker" and second % 7 == 0:
+                entry.seen()
+        clock.now = start + second
+        reaper.reap()
+
+    for (kind, _), record in zip(watches, events):
+        if kind == "anonymous":
+            assert [event for event, _ in record] == ["close"]
+            assert 10 <= record[0][1] - start <= 11
+        elif kind == "silent":
+            assert [event for event, _ in record] == ["ping", "close"]
+            assert 30 <= record[0][1] - start <= 31
+            assert 90 <= record[1][1] - start <= 91
+        else:
+            assert record == []
+    assert len(reaper) == 2000  # Only the talkers are still watched
+    # A tick only costs the watches that are due: each one is visited once
+    # per deadline, not on the ticks in between
+    assert sum(len(due) for due in visited) <= 2000 * 2 + 2000 * 2 + 2000 * 5
+    assert all(len(due) == 0 for due in visited[:9])
@@ -0,0 +1,76 @@
+import asyncio
+
+from protocol import (
+    FEATURE_HISTORY_BATCH,
+    FEATURE_ZLIB,
+    HEADER_LENGTH,
+    MAX_CONTENT_LENGTH,
+    MAX_FRAME_SIZE,
+    build_history_frames,
+    build_history_page,
+    encode_message,
+    unpack_history,
+)
+
+
+def message(message_id, content):
+    return {
+        "type": "MSG",
+        "id": message_id,
+        "from": "alice",
+        "to": "all",
+        "content": content,
+    }
+
+
+def test_history_frames_split_by_size():
+    # About 1.5 MB of JSON each: every character is a \u escape
+    messages = [message(i, "é" * 256 * 1024) for i in range(24)]
+    for compress in (False, True):
+        frames = build_history_frames(messages, "all", compress)
+        assert len(frames) > 1
+        for frame in frames:
+            assert len(encode_message(frame)) <= HEADER_LENGTH + MAX_FRAME_SIZE
+        unpacked = [m for frame in frames for m in unpack_history(frame)]
+        assert unpacked == messages
+
+
+def test_oversized_page_keeps_its_newest_messages():
+    rows = [(i, "alice", "é" * MAX_CONTENT_LENGTH, "now") for i in range(500)]
+    page = build_history_page(rows, "all", None)
+    assert page["truncated"]
+    assert len(encode_message(page)) <= HEADER_LENGTH + MAX_FRAME_SIZE
+    assert unpack_history(page)[-1]["id"] == 499
+    assert not build_history_page(rows[:5], "all", None).get("truncated")
+
+
+async def login_history(server, username, features):
+    """Logs in; returns the messages of the group chat's HISTORY frames."""
+    listener = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        login = {"type": "LOGIN", "content": username, "features": features}
+        writer.write(encode_message(login))
+        while True:
+            msg = await asyncio.wait_for(server.receive_message(reader), 30)
+            assert msg is not None, "server sent an oversized frame"
+            if msg["type"] == "HISTORY":
+                return unpack_history(msg)
+    finally:
+        writer.close()
+        listener.close()
+        await listener.wait_closed()
+
+
+def test_login_after_huge_messages(async_server, db):
+    # Stored before MAX_CONTENT_LENGTH existed, straight into the database
+    for _ in range(2):
+        db.store_message("alice", "all", "BROADCAST", "x" * 7 * 1024 * 1024)
+    for username, features in (
+        ("bob", [FEATURE_HISTORY_BATCH]),
+        ("carol", [FEATURE_HISTORY_BATCH, FEATURE_ZLIB]),
+    ):
+        messages = asyncio.run(login_history(async_server, username, features))
+        assert len(messages) == 2
+        assert all(len(m["content"]) < 2 * MAX_CONTENT_LENGTH for m in messages)
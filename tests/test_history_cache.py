@@ -0,0 +1,70 @@
+from database import MAX_MESSAGE_ID, DatabaseManager
+from history_cache import HistoryCache, MessageRing
+
+
+def rows(ids):
+    return [(i, "alice", f"m{i}", "now") for i in ids]
+
+
+def test_ring_stops_answering_short_pages_once_it_overflows():
+    ring = MessageRing(5)
+    ring.load([], complete=True)
+    for row in rows(range(1, 4)):
+        ring.append(row)
+    assert ring.page(10) == rows(range(1, 4))  # The whole stream
+    for row in rows(range(4, 7)):
+        ring.append(row)
+    assert not ring.complete  # Message 1 fell out
+    assert ring.page(10) is None
+    assert ring.page(3) == rows(range(4, 7))
+    assert ring.page(2, before_id=5) == rows([3, 4])
+    assert ring.page(4, before_id=5) is None  # Message 1 is not cached
+
+
+def test_load_merges_with_live_rows():
+    ring = MessageRing(5)
+    ring.append(rows([7])[0])  # Arrived while the page was being read
+    ring.load(rows(range(4, 7)), complete=True)
+    assert ring.page(10) == rows(range(4, 8))
+    ring.load(rows(range(1, 7)), complete=True)
+    assert not ring.complete  # Seven rows do not fit
+    assert ring.page(5) == rows(range(3, 8))
+
+
+def test_least_recently_used_conversation_is_evicted():
+    cache = HistoryCache(private_size=10, max_conversations=2)
+    cache.load_private("alice", "bob", rows([1]), complete=True)
+    cache.load_private("alice", "carol", rows([2]), complete=True)
+    assert cache.private_page("bob", "alice", 10) == rows([1])  # Now the newest
+    cache.add_private("alice", "dave", rows([3])[0])
+    assert cache.private_page("alice", "carol", 10) is None
+    assert cache.private_page("alice", "bob", 10) == rows([1])
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cached_pages_match_the_database(tmp_path):
+    path = str(tmp_path / "chat.db")
+    db = DatabaseManager(path)
+    for i in range(30):
+        db.store_message("alice", "all", "BROADCAST", f"m{i}")
+    db.close()
+
+    cache = HistoryCache(public_size=10)
+    db = DatabaseManager(path, cache=cache)
+    try:
+        for i in range(30, 35):
+            db.store_message("alice", "all", "BROADCAST", f"m{i}")
+            db.store_message("alice", "bob", "PRIVATE", f"p{i}")
+        before_id = None
+        for _ in range(5):
+            page = db.get_public_history(8, before_id)
+            assert page == db.query_public_history(
+                8, MAX_MESSAGE_ID if before_id is None else before_id
+            )
+            before_id = page[0][0] if page else before_id
+        assert cache.stats()["hits"] == 1  # Only the newest page fits in the ring
+        assert db.get_private_history("alice", "bob", 3) == db.query_private_history(
+            "alice", "bob", 3, MAX_MESSAGE_ID
+        )
+    finally:
+        db.close()
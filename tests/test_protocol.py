@@ -0,0 +1,106 @@
+import socket
+import threading
+
+import pytest
+
+from protocol import (
+    HEADER_LENGTH,
+    MAX_CONTENT_LENGTH,
+    MAX_FRAME_SIZE,
+    RECEIVE_CHUNK,
+    USERNAME_LENGTH,
+    FramedConnection,
+    _recv_exactly,
+    encode_message,
+    parse_content,
+    parse_header,
+    receive_message,
+    search_results,
+    username_problem,
+)
+
+
+def header(length):
+    return f"{length:<{HEADER_LENGTH}}".encode()
+
+
+class TrickleSocket:
+    """Hands out `data` a few bytes per recv_into, recording each buffer size."""
+
+    def __init__(self, data, step=4096):
+        self.data = data
+        self.step = step
+        self.sizes = []
+
+    def recv_into(self, buffer):
+        self.sizes.append(len(buffer))
+        n = min(len(buffer), self.step, len(self.data))
+        buffer[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+
+def test_parse_header_limits():
+    assert parse_header(header(MAX_FRAME_SIZE)) == MAX_FRAME_SIZE
+    with pytest.raises(ValueError):
+        parse_header(header(MAX_FRAME_SIZE + 1))
+    with pytest.raises(ValueError):
+        parse_header(b"-1        ")
+
+
+def test_oversized_frame_drops_the_connection():
+    for receive in (receive_message, lambda sock: FramedConnection(sock).receive()):
+        ours, theirs = socket.socketpair()
+        with ours, theirs:
+            theirs.sendall(header(MAX_FRAME_SIZE + 1) + b"x" * 100)
+            assert receive(ours) is None
+
+
+def test_recv_exactly_grows_with_the_data():
+    sock = TrickleSocket(b"abc" * 100)
+    assert _recv_exactly(sock, MAX_FRAME_SIZE) is None  # Peer went away
+    assert max(sock.sizes) <= 2 * RECEIVE_CHUNK
+
+
+def test_framed_connection_grows_with_the_data():
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        conn = FramedConnection(ours)
+        theirs.sendall(header(MAX_FRAME_SIZE) + b"x" * 100)
+        theirs.shutdown(socket.SHUT_WR)
+        assert conn.receive() is None
+        assert len(conn._buf) == RECEIVE_CHUNK
+
+
+def test_large_frames_still_arrive():
+    message = {"type": "MSG", "content": "y" * (3 * RECEIVE_CHUNK)}
+    frame = encode_message(message)
+    assert receive_message(TrickleSocket(frame)) == message
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        conn = FramedConnection(ours)
+        sender = threading.Thread(target=theirs.sendall, args=(frame + frame,))
+        sender.start()
+        assert conn.receive() == message
+        assert conn.receive() == message
+        sender.join()
+
+
+def test_content_and_username_limits():
+    assert parse_content({"content": "x" * MAX_CONTENT_LENGTH}) is not None
+    for content in ("x" * (MAX_CONTENT_LENGTH + 1), None, 42, ["x"]):
+        assert parse_content({"content": content}) is None
+    assert username_problem("a" * USERNAME_LENGTH) is None
+    for name in ("", "a" * (USERNAME_LENGTH + 1), None, 7, "#room"):
+        assert username_problem(name) is not None
+
+
+def test_search_results_fit_in_a_frame():
+    # Worst case per character: escaped astral symbols, stored before the limit
+    big = "\U0001f600" * (4 * 1024 * 1024)
+    rows = [(i, "alice", "all", "BROADCAST", big, "now") for i in range(100)]
+    page = search_results(rows, "x", 0, False)
+    assert len(encode_message(page)) <= HEADER_LENGTH + MAX_FRAME_SIZE
+    assert page["more"]
+    assert 0 < len(page["results"]) < 100
+    assert len(page["results"][0]["content"]) < MAX_CONTENT_LENGTH + 10
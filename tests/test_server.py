@@ -0,0 +1,289 @@
+import pytest
+
+import server
+from protocol import (
+    CHANNEL_JOIN,
+    CHANNEL_JOINED,
+    CHANNEL_LEAVE,
+    CHANNEL_LEFT,
+    FEATURE_HISTORY_BATCH,
+    FEATURE_PRESENCE,
+    HEADER_LENGTH,
+    HISTORY_REQUEST,
+    MAX_CONTENT_LENGTH,
+    PRESENCE,
+    RESUMED,
+    SEARCH,
+    USER_LIST_REQUEST,
+    USERNAME_LENGTH,
+    decode_message,
+    unpack_history,
+)
+from sidebar import PresenceRoster
+
+
+class RecordingSession:
+    """Stands in for a ClientSession, keeping what it was sent."""
+
+    def __init__(self, username, features=()):
+        self.username = username
+        self.features = set(features)
+        self.channels = set()
+        self.sent = []
+
+    def send(self, message_dict, block=None):
+        self.sent.append(message_dict)
+
+    def send_frame(self, frame, block=None):
+        self.sent.append(decode_message(frame[HEADER_LENGTH:]))
+
+
+def test_overlong_messages_are_refused(chat_server, db):
+    session = RecordingSession("alice")
+    chat_server.clients["alice"] = session
+    content = "x" * (MAX_CONTENT_LENGTH + 1)
+    for to in ("all", "#room", "alice"):
+        msg = {"type": "MSG", "to": to, "content": content}
+        chat_server.handle_message("alice", session, msg, ("127.0.0.1", 1))
+    assert [m["type"] for m in session.sent] == ["ERROR"] * 3
+    assert db.get_public_history() == []
+
+
+def test_username_limits(chat_server):
+    assert chat_server.username_error("a" * USERNAME_LENGTH) is None
+    assert chat_server.username_error("a" * (USERNAME_LENGTH + 1))
+    assert chat_server.username_error(None)
+
+
+def page_through(server, session, chat, limit):
+    """Requests pages of `chat` from the newest back; returns their message ids."""
+    pages, before_id = [], None
+    while True:
+        request = {"type": HISTORY_REQUEST, "to": chat, "limit": limit}
+        if before_id is not None:
+            request["before_id"] = before_id
+        server.handle_message(session.username, session, request, ("127.0.0.1", 1))
+        page = session.sent.pop()
+        assert page["before_id"] == before_id
+        ids = [message["id"] for message in unpack_history(page)]
+        if not ids:
+            return pages
+        pages.append(ids)
+        before_id = ids[0]
+
+
+def test_history_pages(chat_server, db):
+    public, private = [], []
+    for i in range(25):
+        public.append(db.store_message("alice", "all", "BROADCAST", f"all {i}"))
+        private.append(db.store_message("alice", "bob", "PRIVATE", f"bob {i}"))
+        db.store_message("alice", "carol", "PRIVATE", f"carol {i}")
+    session = RecordingSession("bob")
+
+    pages = page_through(chat_server, session, "all", 10)
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [i for page in reversed(pages) for i in page] == public
+
+    pages = page_through(chat_server, session, "alice", 10)
+    assert [i for page in reversed(pages) for i in page] == private
+
+
+def log_in(server, session):
+    assert server.register_session(session)
+    server.announce_login(session.username)
+    return session
+
+
+def roster_of(session):
+    """Applies what the session was sent the way the client does."""
+    roster = PresenceRoster()
+    for msg in session.sent:
+        if msg["type"] == "USER_LIST":
+            roster.load(msg["content"], msg["version"])
+        elif msg["type"] == PRESENCE:
+            assert roster.apply(msg["event"], msg["user"], msg["version"])
+    return roster
+
+
+def test_presence_deltas_and_snapshots(chat_server):
+    alice = log_in(chat_server, RecordingSession("alice", [FEATURE_PRESENCE]))
+    bob = log_in(chat_server, RecordingSession("bob", [FEATURE_PRESENCE]))
+    legacy = log_in(chat_server, RecordingSession("carol"))
+    chat_server.unregister_session(bob)
+
+    # Alice: her own snapshot, then one delta per change
+    assert [(m["type"], m["version"]) for m in alice.sent] == [
+        ("USER_LIST", 1),
+        (PRESENCE, 2),
+        (PRESENCE, 3),
+        (PRESENCE, 4),
+    ]
+    assert roster_of(alice).online_users() == ["alice", "carol"]
+    assert roster_of(alice).version == 4
+    # Bob joined at version 2 and needs no snapshot of his own leave
+    assert roster_of(bob).online_users() == ["alice", "bob", "carol"]
+    # Clients without the feature get the whole list every time
+    assert [m["type"] for m in legacy.sent] == ["USER_LIST", "USER_LIST"]
+    assert legacy.sent[-1] == {
+        "type": "USER_LIST",
+        "content": ["alice", "carol"],
+        "version": 4,
+    }
+
+    # A client that saw a gap asks for a new snapshot
+    chat_server.handle_message(
+        "alice", alice, {"type": USER_LIST_REQUEST}, ("127.0.0.1", 1)
+    )
+    assert alice.sent[-1]["version"] == 4
+
+
+def test_roster_detects_a_gap():
+    roster = PresenceRoster()
+    assert roster.apply("join", "bob", 3)  # No snapshot yet: ignored
+    roster.load(["alice"], 3)
+    assert roster.apply("join", "bob", 3)  # Already in the snapshot
+    assert roster.apply("join", "bob", 4)
+    assert not roster.apply("leave", "bob", 6)
+    assert roster.version is None
+    assert roster.online_users() == ["alice", "bob"]
+
+
+def search_pages(server, session, query, limit):
+    """Follows SEARCH pages while "more" is set; returns them."""
+    pages, offset = [], 0
+    while True:
+        request = {"type": SEARCH, "query": query, "offset": offset, "limit": limit}
+        server.handle_message(session.username, session, request, ("127.0.0.1", 1))
+        page = session.sent.pop()
+        assert page["offset"] == offset
+        pages.append(page)
+        if not page["more"]:
+            return pages
+        offset += len(page["results"])
+
+
+def test_search_pages_cover_what_the_user_may_see(chat_server, db):
+    if not db.search_enabled:
+        pytest.skip("SQLite without FTS5")
+    visible = set()
+    for i in range(12):
+        visible.add(db.store_message("alice", "all", "BROADCAST", f"apple {i}"))
+        visible.add(db.store_message("alice", "bob", "PRIVATE", f"apple {i}"))
+        db.store_message("alice", "carol", "PRIVATE", f"apple {i}")
+        db.store_message("alice", "#secret", "CHANNEL", f"apple {i}")
+        db.store_message("alice", "all", "BROADCAST", f"pear {i}")
+    db.join_channel("bob", "#team")
+    visible.add(db.store_message("alice", "#team", "CHANNEL", "apple pie"))
+
+    pages = search_pages(chat_server, RecordingSession("bob"), "apple", 10)
+    assert [len(page["results"]) for page in pages] == [10, 10, 5]
+    found = [result["id"] for page in pages for result in page["results"]]
+    assert len(found) == len(set(found))
+    assert set(found) == visible
+
+
+def test_channel_membership(chat_server, db):
+    alice, bob, carol = (
+        log_in(chat_server, RecordingSession(name))
+        for name in ("alice", "bob", "carol")
+    )
+    address = ("127.0.0.1", 1)
+
+    def send(session, msg):
+        session.sent.clear()
+        chat_server.handle_message(session.username, session, msg, address)
+
+    for session in (alice, bob):
+        send(session, {"type": CHANNEL_JOIN, "channel": "#team"})
+        assert session.sent == [{"type": CHANNEL_JOINED, "channel": "#team"}]
+    send(carol, {"type": CHANNEL_JOIN, "channel": "team"})
+    assert carol.sent[0]["type"] == "ERROR"
+
+    for session in (alice, bob, carol):
+        session.sent.clear()
+    chat_server.handle_message(
+        "alice", alice, {"type": "MSG", "to": "#team", "content": "hi"}, address
+    )
+    assert [m["content"] for m in alice.sent + bob.sent] == ["hi", "hi"]
+    assert carol.sent == []
+
+    # Outsiders can neither post nor read
+    send(carol, {"type": "MSG", "to": "#team", "content": "let me in"})
+    assert carol.sent[0]["type"] == "ERROR"
+    send(carol, {"type": HISTORY_REQUEST, "to": "#team"})
+    assert carol.sent[0]["type"] == "ERROR"
+    assert [row[2] for row in db.get_channel_history("#team")] == ["hi"]
+
+    send(bob, {"type": CHANNEL_LEAVE, "channel": "#team"})
+    assert bob.sent == [{"type": CHANNEL_LEFT, "channel": "#team"}]
+    bob.sent.clear()
+    send(alice, {"type": "MSG", "to": "#team", "content": "still here?"})
+    assert [m["content"] for m in alice.sent] == ["still here?"]
+    assert bob.sent == []
+    assert db.get_channels("alice") == ["#team"]
+    assert db.get_channels("bob") == []
+
+    # Disconnecting keeps the membership but leaves the fan-out index
+    chat_server.unregister_session(alice)
+    assert chat_server.channels == {}
+    assert db.get_channels("alice") == ["#team"]
+
+
+def resume(server, username, after_id):
+    """A resumed login's replay: ({chat: [message ids]}, RESUMED)."""
+    session = RecordingSession(username, [FEATURE_HISTORY_BATCH])
+    server.send_login_history(session, after_id)
+    *frames, done = session.sent
+    assert done["type"] == RESUMED and done["after_id"] == after_id
+    chats = {}
+    for frame in frames:
+        chats.setdefault(frame["to"], []).extend(m["id"] for m in unpack_history(frame))
+    return chats, done
+
+
+def test_resume_sends_only_the_gap(chat_server, db):
+    db.join_channel("bob", "#team")
+    last_seen = db.store_message("alice", "all", "BROADCAST", "seen")
+    missed = {
+        "all": [db.store_message("alice", "all", "BROADCAST", "missed")],
+        "alice": [
+            db.store_message("alice", "bob", "PRIVATE", "to bob"),
+            db.store_message("bob", "alice", "PRIVATE", "from bob"),
+        ],
+        "#team": [db.store_message("alice", "#team", "CHANNEL", "team")],
+    }
+    db.store_message("alice", "carol", "PRIVATE", "not for bob")
+    db.store_message("alice", "#other", "CHANNEL", "not for bob either")
+
+    chats, done = resume(chat_server, "bob", last_seen)
+    assert chats == missed
+    assert done["complete"] and done["count"] == 4
+
+    chats, done = resume(chat_server, "bob", max(missed["#team"]))
+    assert chats == {} and done["complete"] and done["count"] == 0
+
+
+def test_resume_falls_back_when_too_much_was_missed(chat_server, db, monkeypatch):
+    monkeypatch.setattr(server, "RESUME_LIMIT", 5)
+    ids = [db.store_message("alice", "all", "BROADCAST", f"m{i}") for i in range(10)]
+    chats, done = resume(chat_server, "bob", ids[0])
+    assert not done["complete"]
+    assert chats == {"all": ids}  # The usual latest page instead
+
+
+def test_resume_falls_back_past_archived_messages(chat_server, db):
+    ids = [db.store_message("alice", "all", "BROADCAST", f"m{i}") for i in range(4)]
+    db.archive_messages("9999-12-31 23:59:59")
+    chats, done = resume(chat_server, "bob", ids[1])
+    assert not done["complete"]
+    assert chats == {"all": ids}
+
+
+def test_channel_limit(chat_server, monkeypatch):
+    monkeypatch.setattr(server, "MAX_CHANNELS", 2)
+    session = log_in(chat_server, RecordingSession("alice"))
+    for channel in ("#a", "#b", "#a", "#c"):
+        msg = {"type": CHANNEL_JOIN, "channel": channel}
+        chat_server.handle_message("alice", session, msg, ("127.0.0.1", 1))
+    assert [m["type"] for m in session.sent[-4:]] == [CHANNEL_JOINED] * 3 + ["ERROR"]
+    assert session.channels == {"#a", "#b"}
@@ -0,0 +1,83 @@
+import threading
+import time
+
+from session import (
+    OVERFLOW_BLOCK,
+    OVERFLOW_DISCONNECT,
+    OVERFLOW_DROP_OLDEST,
+    ClientSession,
+)
+
+QUEUE_SIZE = 4
+
+
+class StalledConnection:
+    """A connection whose peer does not read until release()."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.sent = []
+        self.was_shut_down = False
+
+    def send_frame(self, data):
+        self.gate.wait()
+        self.sent.append(data)
+        return True
+
+    def shutdown(self):
+        self.was_shut_down = True
+        self.gate.set()
+
+    def release(self):
+        self.gate.set()
+
+
+def stalled_session(policy):
+    """A session whose writer is stuck on frame 0, with a full queue behind it."""
+    conn = StalledConnection()
+    session = ClientSession("slow", conn, QUEUE_SIZE, policy)
+    session.send_frame(b"0")
+    deadline = time.monotonic() + 5
+    while session.queue and time.monotonic() < deadline:
+        time.sleep(0.001)
+    for i in range(1, QUEUE_SIZE + 1):
+        assert session.send_frame(str(i).encode())
+    return conn, session
+
+
+def delivered(conn, session, count):
+    """Everything the writer passes on once the peer reads again."""
+    conn.release()
+    deadline = time.monotonic() + 5
+    while session.sent < count and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return b"".join(conn.sent)
+
+
+def test_disconnect_drops_the_slow_consumer():
+    conn, session = stalled_session(OVERFLOW_DISCONNECT)
+    assert not session.send_frame(b"5")
+    assert session.closed and conn.was_shut_down
+    assert session.dropped == 1
+    assert not session.send_frame(b"6")
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    conn, session = stalled_session(OVERFLOW_DROP_OLDEST)
+    assert session.send_frame(b"5")
+    assert session.send_frame(b"6")
+    assert session.dropped == 2
+    assert delivered(conn, session, QUEUE_SIZE + 1) == b"03456"
+    session.close()
+
+
+def test_block_waits_for_room():
+    conn, session = stalled_session(OVERFLOW_BLOCK)
+    sender = threading.Thread(target=session.send_frame, args=(b"5",))
+    sender.start()
+    sender.join(0.2)
+    assert sender.is_alive()  # Still waiting for room
+    assert delivered(conn, session, QUEUE_SIZE + 2) == b"012345"
+    sender.join(5)
+    assert session.dropped == 0
+    session.close()
@@ -0,0 +1,43 @@
+import logging
+import threading
+
+import pytest
+
+from benchmarks.stress_db import simulate_user
+from database import DatabaseManager
+from history_cache import HistoryCache
+
+USERS = 100
+MESSAGES = 5
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+def test_concurrent_logins_and_sends(tmp_path, caplog, write_behind):
+    db = DatabaseManager(
+        str(tmp_path / "stress.db"), write_behind=write_behind, cache=HistoryCache()
+    )
+    failures = []
+    barrier = threading.Barrier(USERS)
+    threads = [
+        threading.Thread(
+            target=simulate_user, args=(db, i, MESSAGES, USERS, barrier, failures)
+        )
+        for i in range(USERS)
+    ]
+    with caplog.at_level(logging.ERROR, logger="chat.database"):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.flush()
+    try:
+        with db.pool.read() as conn:
+            stored = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    finally:
+        db.close()
+
+    assert failures == []
+    assert caplog.records == []
+    assert stored == USERS * MESSAGES * 2
+    assert users == USERS
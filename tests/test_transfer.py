@@ -0,0 +1,84 @@
+import socket
+import threading
+
+from protocol import FILE_GET, FILE_OFFSET, FILE_PUT, receive_message, send_message
+from transfer import FileStore, TransferError, upload_file
+
+KEY = "0123456789abcdef0123456789abcdef"
+
+
+def test_transfer_error_checks_the_key(tmp_path):
+    files = FileStore(str(tmp_path))
+    row = (1, "alice", "all", "a.txt", 10, KEY, 1)
+    assert files.transfer_error(row, {"type": FILE_GET, "key": KEY}) is None
+    for key in (None, 42, "ÿ" * 32, KEY.upper(), "f" * 32):
+        msg = {"type": FILE_GET, "key": key}
+        assert files.transfer_error(row, msg) == "Unknown file"
+
+
+def test_one_uploader_per_file_across_stores(tmp_path):
+    # Two stores on one directory stand in for two cluster workers
+    first, second = FileStore(str(tmp_path)), FileStore(str(tmp_path))
+    part = first.begin_upload(7)
+    assert part is not None
+    assert second.begin_upload(7) is None
+    part.write(b"hello")
+    first.end_upload(7, part)
+
+    part = second.begin_upload(7)
+    assert part is not None
+    assert second.received(part) == 5
+    second.end_upload(7, part)
+
+
+def test_transfer_error_for_uploads(tmp_path):
+    files = FileStore(str(tmp_path))
+    msg = {"type": FILE_PUT, "key": KEY}
+    assert files.transfer_error((1, "a", "all", "a", 1, KEY, 0), msg) is None
+    row = (1, "a", "all", "a", 1, KEY, 1)
+    assert files.transfer_error(row, msg) == "File already uploaded"
+
+
+def test_failed_open_releases_the_claim(tmp_path):
+    blocker = tmp_path / "not-a-directory"
+    blocker.write_bytes(b"")
+    files = FileStore(str(blocker))
+    assert files.begin_upload(7) is None
+    assert not files.uploading
+
+
+def accept_upload(listener):
+    """Answers one FILE_PUT with offset 0, then reads until the client leaves."""
+    conn, _ = listener.accept()
+    with conn:
+        receive_message(conn)
+        send_message(conn, {"type": FILE_OFFSET, "offset": 0})
+        while conn.recv(65536):
+            pass
+
+
+def test_upload_of_a_shrinking_file_fails(tmp_path, monkeypatch):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"x" * 1000)
+    # What sendfile does once the file was cut short under it
+    monkeypatch.setattr(socket.socket, "sendfile", lambda *args: 0)
+    errors = []
+
+    def upload(port):
+        try:
+            upload_file("127.0.0.1", port, 7, KEY, str(path))
+        except TransferError as e:
+            errors.append(e)
+
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        server = threading.Thread(target=accept_upload, args=(listener,), daemon=True)
+        server.start()
+        # Daemon threads, so an upload stuck in its loop fails the test instead
+        client = threading.Thread(
+            target=upload, args=(listener.getsockname()[1],), daemon=True
+        )
+        client.start()
+        client.join(10)
+        assert not client.is_alive()
+        assert errors
+        server.join(5)
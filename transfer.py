@@ -0,0 +1,245 @@
+import hmac
+import logging
+import os
+import socket
+import threading
+import time
+
+from protocol import (
+    FILE_DATA,
+    FILE_DONE,
+    FILE_GET,
+    FILE_KEY,
+    FILE_OFFSET,
+    FILE_PUT,
+    receive_message,
+    send_message,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: uploads are only guarded within one process
+    fcntl = None
+
+logger = logging.getLogger("chat.transfer")
+
+# Bytes per sendfile call and per receive; transfers are paced in these steps
+FILE_CHUNK_SIZE = 1024 * 1024
+DEFAULT_FILES_DIR = "chat_files"
+DEFAULT_MAX_FILE_SIZE = 4 * 1024**3
+# Seconds a data connection may stall before it is dropped
+TRANSFER_TIMEOUT = 60.0
+
+
+class TransferError(Exception):
+    """The server refused or broke off a transfer."""
+
+
+class Pacer:
+    """Keeps one transfer at or below `rate` bytes per second (0 = unlimited)."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.done = 0
+
+    def delay(self, count):
+        """Counts `count` more bytes. Returns how long to wait before the next chunk."""
+        self.done += count
+        if not self.rate:
+            return 0.0
+        return max(0.0, self.start + self.done / self.rate - time.monotonic())
+
+
+class FileStore:
+    """
+    Shared files on disk, named by file id: "<id>.part" while the upload is
+    under way, "<id>" once complete. Uploads append to the part file, so an
+    interrupted one resumes at its current size. File data only ever passes
+    through FILE_CHUNK_SIZE buffers (uploads) or the kernel (sendfile).
+    """
+
+    def __init__(
+        self, directory=DEFAULT_FILES_DIR, rate=0, max_size=DEFAULT_MAX_FILE_SIZE
+    ):
+        self.directory = directory
+        self.rate = rate  # Per transfer, bytes per second (0 = unlimited)
+        self.max_size = max_size
+        self.uploading = set()  # File ids with an uploader in this process
+        self.lock = threading.Lock()
+        self.stats_data = {"uploads": 0, "downloads": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def path(self, file_id):
+        return os.path.join(self.directory, str(file_id))
+
+    def part_path(self, file_id):
+        return self.path(file_id) + ".part"
+
+    @staticmethod
+    def received(part):
+        """Bytes of an unfinished upload already stored in its open part file."""
+        return os.fstat(part.fileno()).st_size
+
+    def transfer_error(self, row, msg):
+        """
+        Why the FILE_PUT or FILE_GET `msg` for the files table row `row`
+        (None if unknown) cannot go ahead, or None if it can.
+        """
+        key = msg.get("key")
+        if row is None or not isinstance(key, str) or not FILE_KEY.fullmatch(key):
+            return "Unknown file"
+        if not hmac.compare_digest(row[5], key):
+            return "Unknown file"
+        size, complete = row[4], row[6]
+        if msg.get("type") == FILE_PUT:
+            return "File already uploaded" if complete else None
+        if not complete:
+            return "File not uploaded yet"
+        offset = msg.get("offset", 0)
+        if type(offset) is not int or not 0 <= offset <= size:
+            return "Bad offset"
+        return None
+
+    def begin_upload(self, file_id):
+        """
+        Claims the upload of file_id and returns its part file, open for
+        appending. The claim is an exclusive flock on the part file, so it
+        holds across processes (cluster workers) too. Returns None if
+        another connection is uploading the file, or has just finished it.
+        """
+        with self.lock:
+            if file_id in self.uploading:
+                return None
+            self.uploading.add(file_id)
+        path = self.part_path(file_id)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            part = open(path, "ab")
+        except OSError as e:
+            logger.error("[FILE] Cannot open %s: %s", path, e)
+            with self.lock:
+                self.uploading.discard(file_id)
+            return None
+        try:
+            if fcntl is not None:
+                fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Whoever held the lock before may have renamed the part file
+            if os.fstat(part.fileno()).st_ino != os.stat(path).st_ino:
+                raise FileNotFoundError(path)
+        except OSError:
+            self.end_upload(file_id, part)
+            return None
+        return part
+
+    def end_upload(self, file_id, part):
+        """Closes the part file, which releases the claim."""
+        part.close()
+        with self.lock:
+            self.uploading.discard(file_id)
+
+    def finish(self, part, file_id):
+        """Syncs a complete part file and gives it its final name."""
+        part.flush()
+        os.fsync(part.fileno())
+        if fcntl is None:
+            part.close()  # Windows cannot rename an open file
+        os.replace(self.part_path(file_id), self.path(file_id))
+        with self.lock:
+            self.stats_data["uploads"] += 1
+
+    def receive(self, sock, part, file_id, size):
+        """
+        Appends what arrives on `sock` to the claimed part file until it
+        holds `size` bytes. Returns True once the upload is complete.
+        """
+        offset = self.received(part)
+        buffer = memoryview(bytearray(FILE_CHUNK_SIZE))
+        pacer = Pacer(self.rate)
+        while offset < size:
+            count = sock.recv_into(buffer, min(len(buffer), size - offset))
+            if not count:
+                return False
+            part.write(buffer[:count])
+            offset += count
+            self.count("bytes_in", count)
+            time.sleep(pacer.delay(count))
+        self.finish(part, file_id)
+        return True
+
+    def send(self, sock, file_id, offset, size):
+        """Sends bytes offset..size of a complete file with sendfile."""
+        pacer = Pacer(self.rate)
+        with open(self.path(file_id), "rb") as f:
+            while offset < size:
+                count = sock.sendfile(f, offset, min(FILE_CHUNK_SIZE, size - offset))
+                if not count:
+                    raise TransferError(f"file {file_id} is shorter than {size} bytes")
+                offset += count
+                self.count("bytes_out", count)
+                time.sleep(pacer.delay(count))
+        self.count("downloads", 1)
+
+    def count(self, name, value):
+        with self.lock:
+            self.stats_data[name] += value
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.stats_data)
+        stats["active_uploads"] = len(self.uploading)
+        return stats
+
+
+def upload_file(host, port, file_id, key, path, rate=0):
+    """
+    Client side of FILE_PUT: sends the part of the local file at `path` the
+    server does not have yet. Returns the bytes sent.
+    """
+    with socket.create_connection((host, port), TRANSFER_TIMEOUT) as sock:
+        send_message(sock, {"type": FILE_PUT, "file_id": file_id, "key": key})
+        reply = receive_message(sock)
+        if reply is None or reply.get("type") != FILE_OFFSET:
+            raise TransferError(reply.get("content") if reply else "connection lost")
+        offset = start = reply["offset"]
+        pacer = Pacer(rate)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            while offset < size:
+                count = sock.sendfile(f, offset, min(FILE_CHUNK_SIZE, size - offset))
+                if not count:
+                    raise TransferError(f"{path} shrank while uploading")
+                offset += count
+                time.sleep(pacer.delay(count))
+        reply = receive_message(sock)
+        if reply is None or reply.get("type") != FILE_DONE:
+            raise TransferError(reply.get("content") if reply else "connection lost")
+        return offset - start
+
+
+def download_file(host, port, file_id, key, path):
+    """
+    Client side of FILE_GET: fetches a file into `path`, continuing from
+    "<path>.part" if an earlier attempt was interrupted. Returns the bytes
+    received.
+    """
+    part = path + ".part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    with socket.create_connection((host, port), TRANSFER_TIMEOUT) as sock:
+        send_message(
+            sock, {"type": FILE_GET, "file_id": file_id, "key": key, "offset": offset}
+        )
+        header = receive_message(sock)
+        if header is None or header.get("type") != FILE_DATA:
+            raise TransferError(header.get("content") if header else "connection lost")
+        size = header["size"]
+        start = offset
+        buffer = memoryview(bytearray(FILE_CHUNK_SIZE))
+        with open(part, "ab") as f:
+            while offset < size:
+                count = sock.recv_into(buffer, min(len(buffer), size - offset))
+                if not count:
+                    raise TransferError("connection lost")
+                f.write(buffer[:count])
+                offset += count
+    os.replace(part, path)
+    return offset - start